@@ -0,0 +1,125 @@
+import os
+import glob
+import importlib
+import re
+from abc import ABC, abstractmethod
+from typing import Dict, Any, List, Optional
+
+rules: Dict[str, Any] = {}
+modules = glob.glob(os.path.dirname(__file__) + "/*.py")
+__all__ = [os.path.basename(f)[:-3] for f in modules]
+
+# Rule class name -> name of the module registering it, read from the
+# register() calls of the sources, so that get_rule() imports only that one.
+_index: Optional[Dict[str, str]] = None
+_REGISTER = re.compile(r'^register\((\w+)\)', re.MULTILINE)
+
+class Rule(ABC):
+    """
+    One Rule for all, This Class is the masterClass and all rules 
+    are gets inherited from this class
+
+    Generic Rules Class: 
+    All other rules should inherit from here, passing
+    their **kwargs up to the super constructor.
+    """
+    # True when a built rule can be pickled into a compiled configuration
+    # (see config.defndConfig.compile) and used as is by another process:
+    # building it has no side effects and it holds no process resources.
+    cacheable = False
+
+    def __init__(self, **kwargs: Any) -> None:
+        self.action = kwargs.get('action')
+
+    @abstractmethod
+    def __call__(self, defnd_packet: Any) -> bool:
+        """
+        Return False to pass packet down the chain, "ACCEPT" to
+        explicitly accept and "DROP" to explicitly drop.
+        """
+        pass
+
+    def match_space(self) -> Any:
+        """
+        Describe the packets this rule can match, for the chain optimizer.
+
+        Returns a dict mapping a dimension to the values the rule accepts:
+        'protocol' (a frozenset of IP protocol numbers), 'src_port' and
+        'dst_port' (an int bitmask with bit N set for port N), 'src_ip' and
+        'dst_ip' (an inclusive (first, last) integer address range).  A
+        missing dimension matches anything.  Return None if the rule is
+        stateful or has side effects, so it is never reordered.
+        """
+        return None
+
+    def containers(self) -> Dict[str, Any]:
+        """
+        Return the containers this rule keeps that can grow while it runs, by
+        name, so their memory can be accounted for (see diagnostics).
+        """
+        return {}
+
+    def inputs(self) -> List[str]:
+        """
+        Return the files this rule read when it was built, so that a compiled
+        configuration holding it is stale once they change.
+        """
+        return []
+
+    def placed(self, chain_name: str, index: int) -> None:
+        """
+        Called when the rule is added to a chain, as the rule at index of
+        chain_name.  Rules that name something after their place (a file,
+        a log line) override this.
+        """
+        pass
+
+class SimpleRule(Rule):
+    """
+    Class for Simple Rules, it performs one action based on the 
+    condition it meets, otherwise passes the action to other chain
+    """
+    def __call__(self, defnd_packet: Any) -> bool:
+        if self.filter_condition(defnd_packet):
+            return self.action
+        else:
+            return False
+
+    @abstractmethod
+    def filter_condition(self, defnd_packet: Any) -> bool:
+        """
+        Return True to perform default action, return False to pass packet
+        down the chain. Override this to define correct behavior for your rule.
+        """
+        return True
+
+def register(rule_class: Any) -> None:
+    rules[rule_class.__name__] = rule_class
+
+def module_index() -> Dict[str, str]:
+    """
+    Return the rule class names of this package and their modules, without
+    importing any.
+    """
+    global _index
+    if _index is None:
+        _index = {}
+        for filename in sorted(modules):
+            module = os.path.basename(filename)[:-3]
+            if module == '__init__':
+                continue
+            with open(filename) as source:
+                for name in _REGISTER.findall(source.read()):
+                    _index[name] = module
+    return _index
+
+def get_rule(name: str) -> Any:
+    """
+    Return the rule class registered as name, importing its module of this
+    package if needed.
+    """
+    if name not in rules and name in module_index():
+        importlib.import_module('rules.' + module_index()[name])
+    if name not in rules:
+        raise ValueError('Unknown rule "%s"' % name)
+    return rules[name]
@@ -0,0 +1,206 @@
+"""Sampled packet capture into an in-memory ring, saved as pcap on demand."""
+from __future__ import print_function
+from array import array
+import logging
+import signal
+import socket
+import struct
+import threading
+import time
+
+import netaddr
+
+from rules import register, SimpleRule
+import control
+import pcap
+
+# Every CaptureRule of this process, so one signal flushes all of them.
+_captures = []
+# Serializes the writers of all CaptureRules: two rules may be configured
+# with the same filename.
+_write_lock = threading.Lock()
+
+_PROTOCOLS = {'TCP': socket.IPPROTO_TCP, 'UDP': socket.IPPROTO_UDP,
+              'ICMP': socket.IPPROTO_ICMP}
+
+
+def flush_all():
+    """Flush the ring of every CaptureRule in this process.
+
+    Returns the threads doing the writing.
+
+    """
+    return [capture.flush() for capture in _captures]
+
+
+def _on_signal(signum, frame):
+    flush_all()
+
+
+def _flush_command():
+    """The 'capture_flush' control command: flush every ring, and report the
+    files being written."""
+    flush_all()
+    return {'flushed': [capture.filename for capture in _captures]}
+
+
+control.register_command('capture_flush', _flush_command)
+
+
+class CaptureRule(SimpleRule):
+    """Copies sampled packets into a preallocated ring buffer.
+
+    Replaces PrintRule for visibility: nothing is formatted or written while
+    packets are filtered.  The ring keeps the last `slots` captured packets,
+    each truncated to `snaplen` bytes.  Sending the process `signal` (SIGUSR1
+    by default), or the 'capture_flush' control command, snapshots the ring
+    and writes it to `filename` as a pcap from a background thread.  The
+    default filename is named after the rule's place, e.g.
+    'defnd-capture-INPUT-0.pcap', so rules never overwrite each other.
+
+    Arguments:
+    - sample_rate: capture one in every N packets passing the filter.
+    - snaplen, slots: bytes kept per packet, and ring capacity.
+    - protocol: 'TCP', 'UDP', 'ICMP' or an IP protocol number.
+    - src_ip, dst_ip: CIDR ranges.
+    - src_port, dst_port: TCP/UDP ports.
+
+    Like PrintRule, the action is never applied.
+
+    """
+
+    def __init__(self, **kwargs):
+        """Create the ring and install the flush signal handler."""
+        SimpleRule.__init__(self, **kwargs)
+        self._sample_rate = int(kwargs.get('sample_rate', 1))
+        self._snaplen = int(kwargs.get('snaplen', 256))
+        self._slots = int(kwargs.get('slots', 1024))
+        self._default_filename = 'filename' not in kwargs
+        self.filename = kwargs.get('filename',
+                                   'defnd-capture-%d.pcap' % len(_captures))
+        if self._sample_rate < 1 or self._snaplen < 20 or self._slots < 1:
+            raise ValueError('sample_rate and slots must be positive and'
+                             ' snaplen at least 20')
+
+        protocol = kwargs.get('protocol', None)
+        self._protocol = _PROTOCOLS.get(protocol, protocol)
+        self._src_ip = self._address_range(kwargs.get('src_ip', None))
+        self._dst_ip = self._address_range(kwargs.get('dst_ip', None))
+        self._src_port = kwargs.get('src_port', None)
+        self._dst_port = kwargs.get('dst_port', None)
+
+        self._ring = bytearray(self._slots * self._snaplen)
+        self._caplens = array('I', [0]) * self._slots
+        self._lengths = array('I', [0]) * self._slots
+        self._stamps = array('d', [0.0]) * self._slots
+        self._next = 0
+        self._captured = 0
+        self._seen = 0
+
+        _captures.append(self)
+        signum = getattr(signal, kwargs.get('signal', 'SIGUSR1'))
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signum, _on_signal)
+
+    def placed(self, chain_name, index):
+        """Name the default capture file after the chain and index."""
+        if self._default_filename:
+            self.filename = 'defnd-capture-%s-%d.pcap' % (chain_name, index)
+
+    def containers(self):
+        """The ring is preallocated, but report it anyway."""
+        return {'ring': self._ring}
+
+    def _address_range(self, cidr_range):
+        """Convert a CIDR string to an inclusive integer range, or None."""
+        if cidr_range is None:
+            return None
+        network = netaddr.IPNetwork(cidr_range)
+        return network.first, network.last
+
+    def _matches(self, buf, pywall_packet):
+        """Apply the protocol, address and port filter."""
+        if self._protocol is not None and \
+                pywall_packet.get_protocol() != self._protocol:
+            return False
+        if self._src_ip is not None:
+            src = struct.unpack('!I', buf[12:16])[0]
+            if not self._src_ip[0] <= src <= self._src_ip[1]:
+                return False
+        if self._dst_ip is not None:
+            dst = struct.unpack('!I', buf[16:20])[0]
+            if not self._dst_ip[0] <= dst <= self._dst_ip[1]:
+                return False
+        if self._src_port is not None or self._dst_port is not None:
+            payload = pywall_packet.get_payload()
+            if payload is None:
+                return False
+            if self._src_port is not None and \
+                    payload.get_src_port() != self._src_port:
+                return False
+            if self._dst_port is not None and \
+                    payload.get_dst_port() != self._dst_port:
+                return False
+        return True
+
+    def filter_condition(self, pywall_packet):
+        """Copy the packet into the ring if it is sampled.  Never matches."""
+        buf = pywall_packet.buf
+        if not self._matches(buf, pywall_packet):
+            return False
+        self._seen += 1
+        if self._seen % self._sample_rate:
+            return False
+
+        slot = self._next
+        caplen = min(len(buf), self._snaplen)
+        offset = slot * self._snaplen
+        self._ring[offset:offset + caplen] = memoryview(buf)[:caplen]
+        self._caplens[slot] = caplen
+        self._lengths[slot] = len(buf)
+        self._stamps[slot] = time.time()
+        self._next = (slot + 1) % self._slots
+        self._captured += 1
+        return False
+
+    def snapshot(self):
+        """Copy the ring and its bookkeeping.  This is the only part of a
+        flush that runs on the packet filtering thread."""
+        return (bytes(self._ring), self._caplens[:], self._lengths[:],
+                self._stamps[:], self._next, self._captured)
+
+    def records(self, snapshot):
+        """Return (timestamp, orig_len, data) records of a snapshot, oldest
+        first."""
+        ring, caplens, lengths, stamps, next_slot, captured = snapshot
+        count = min(captured, self._slots)
+        start = (next_slot - count) % self._slots
+        records = []
+        for i in range(count):
+            slot = (start + i) % self._slots
+            offset = slot * self._snaplen
+            records.append((stamps[slot], lengths[slot],
+                            ring[offset:offset + caplens[slot]]))
+        return records
+
+    def flush(self):
+        """Write a snapshot of the ring to the pcap file in the background.
+
+        Returns the thread doing the writing.
+
+        """
+        writer = threading.Thread(target=self._write, args=(self.snapshot(),))
+        writer.daemon = True
+        writer.start()
+        return writer
+
+    def _write(self, snapshot):
+        records = self.records(snapshot)
+        with _write_lock:
+            pcap.write_pcap(self.filename, records, snaplen=self._snaplen)
+        logging.getLogger('defnd.capture').info(
+            'CaptureRule: wrote %d packets to %s' %
+            (len(records), self.filename))
+
+
+register(CaptureRule)
@@ -0,0 +1,212 @@
+"""Contains a rule matching TCP/UDP payloads against many byte patterns.
+
+All the patterns of a rule are compiled into one Aho-Corasick automaton: a
+trie of the patterns whose states also know the longest proper suffix that is
+still a prefix of some pattern (the failure link).  A payload is scanned once,
+byte by byte, whatever the number of patterns, and the scan stops at the
+first match.  When the patterns start with few distinct bytes, a regular
+expression of those skips ahead, in C, whenever the automaton is back at its
+root.
+
+"""
+import os
+import re
+import socket
+
+from rules import register
+from rules import SimpleRule
+
+_PROTOCOLS = {'TCP': socket.IPPROTO_TCP, 'UDP': socket.IPPROTO_UDP}
+
+# Patterns starting with at most this many distinct bytes are searched with
+# the skip-ahead expression.
+_SKIP_FANOUT = 32
+
+# Bytes between pipes in a pattern are hexadecimal, as in Snort rules:
+# "GET /|2e 2e|/" is b"GET /../".
+_HEX = re.compile(r'\|([0-9A-Fa-f\s]*)\|')
+
+
+def parse_pattern(text):
+    """Return the bytes of a pattern, decoding |hex| sections."""
+    result = b''
+    position = 0
+    for match in _HEX.finditer(text):
+        result += text[position:match.start()].encode('utf-8')
+        result += bytes.fromhex(match.group(1))
+        position = match.end()
+    result += text[position:].encode('utf-8')
+    if not result:
+        raise ValueError('Empty content pattern')
+    return result
+
+
+class Automaton(object):
+    """An Aho-Corasick automaton over byte patterns.
+
+    States are numbered from 0, the root.  For each state, goto maps a byte
+    to the next state, fail is the failure link, and match is the index of a
+    pattern ending there (directly or through failure links), or -1.
+
+    """
+
+    def __init__(self, patterns, nocase=False):
+        self.patterns = list(patterns)
+        self.goto = [{}]
+        self.match = [-1]
+        for index, pattern in enumerate(self.patterns):
+            self._insert(index, pattern.lower() if nocase else pattern,
+                         nocase)
+        self.fail = [0] * len(self.goto)
+        self._link()
+        first = sorted(self.goto[0])
+        self._skip = None
+        if len(first) <= _SKIP_FANOUT:
+            self._skip = re.compile(b'[' + b''.join(re.escape(bytes([byte]))
+                                                   for byte in first) + b']')
+
+    def _insert(self, index, pattern, nocase):
+        goto = self.goto
+        state = 0
+        for byte in pattern:
+            following = goto[state].get(byte)
+            if following is None:
+                following = len(goto)
+                goto.append({})
+                self.match.append(-1)
+                goto[state][byte] = following
+                if nocase and 0x61 <= byte <= 0x7a:
+                    goto[state][byte - 0x20] = following
+            state = following
+        if self.match[state] < 0:
+            self.match[state] = index
+
+    def _link(self):
+        """Compute the failure links, breadth first."""
+        goto, fail, match = self.goto, self.fail, self.match
+        # States one byte deep fail to the root.  A state may be reached by
+        # two bytes (nocase): link it once.
+        queue = sorted(set(goto[0].values()))
+        seen = set(queue)
+        for state in queue:
+            for byte, following in goto[state].items():
+                if following in seen:
+                    continue
+                seen.add(following)
+                link = fail[state]
+                while link and byte not in goto[link]:
+                    link = fail[link]
+                fail[following] = goto[link].get(byte, 0)
+                if match[following] < 0:
+                    match[following] = match[fail[following]]
+                queue.append(following)
+
+    def search(self, data):
+        """Return the index of a pattern found in data, or -1.
+
+        data is any bytes-like object; a memoryview is scanned in place.
+
+        """
+        if self._skip is not None:
+            return self._search_skipping(data)
+        goto, fail, match = self.goto, self.fail, self.match
+        state = 0
+        for byte in data:
+            following = goto[state].get(byte)
+            while following is None and state:
+                state = fail[state]
+                following = goto[state].get(byte)
+            # No state goes back to the root, 0.
+            state = following or 0
+            if match[state] >= 0:
+                return match[state]
+        return -1
+
+    def _search_skipping(self, data):
+        goto, fail, match = self.goto, self.fail, self.match
+        skip = self._skip.search
+        end = len(data)
+        position = 0
+        state = 0
+        while position < end:
+            if not state:
+                found = skip(data, position)
+                if found is None:
+                    return -1
+                position = found.start()
+            byte = data[position]
+            following = goto[state].get(byte)
+            while following is None and state:
+                state = fail[state]
+                following = goto[state].get(byte)
+            state = following or 0
+            if match[state] >= 0:
+                return match[state]
+            position += 1
+        return -1
+
+
+class ContentMatchRule(SimpleRule):
+    """Matches TCP/UDP packets whose payload contains one of many patterns.
+
+    Takes:
+    - patterns: a list of strings; |hex| sections stand for raw bytes.
+    - patterns_file: a file with one more pattern per line (blank lines and
+      lines starting with '#' are skipped).
+    - protocol: 'TCP' or 'UDP' (both by default).
+    - offset: bytes of the payload to skip before searching (0).
+    - depth: bytes of the payload to search from offset (all of it).
+    - nocase: match ASCII letters in either case (false).
+
+    """
+
+    cacheable = True
+
+    def __init__(self, **kwargs):
+        SimpleRule.__init__(self, action=kwargs.get('action', 'DROP'))
+        texts = list(kwargs.get('patterns', []))
+        self._inputs = []
+        if kwargs.get('patterns_file'):
+            self._inputs.append(os.path.abspath(kwargs['patterns_file']))
+            with open(kwargs['patterns_file']) as patterns_file:
+                texts.extend(line.rstrip('\r\n') for line in patterns_file
+                             if line.strip() and not line.startswith('#'))
+        if not texts:
+            raise ValueError('ContentMatchRule needs "patterns" or'
+                             ' "patterns_file".')
+        protocol = kwargs.get('protocol', None)
+        if protocol is None:
+            self._protocols = frozenset(_PROTOCOLS.values())
+        elif protocol in _PROTOCOLS:
+            self._protocols = frozenset([_PROTOCOLS[protocol]])
+        else:
+            raise ValueError('protocol should be either TCP or UDP')
+        self._offset = int(kwargs.get('offset', 0))
+        depth = kwargs.get('depth', None)
+        self._end = None if depth is None else self._offset + int(depth)
+        if self._offset < 0 or (self._end is not None and
+                                self._end < self._offset):
+            raise ValueError('offset and depth should not be negative')
+        self._automaton = Automaton([parse_pattern(text) for text in texts],
+                                    bool(kwargs.get('nocase', False)))
+
+    def filter_condition(self, packet):
+        """Condition to jump to action chain."""
+        if packet.get_protocol() not in self._protocols:
+            return False
+        payload = packet.get_payload()
+        if payload is None:
+            return False
+        body = payload.get_body_view()[self._offset:self._end]
+        return self._automaton.search(body) >= 0
+
+    def match_space(self):
+        """Describe the protocols this rule matches."""
+        return {'protocol': self._protocols}
+
+    def inputs(self):
+        """The patterns file, if any."""
+        return self._inputs
+
+
+register(ContentMatchRule)
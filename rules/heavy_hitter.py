@@ -0,0 +1,65 @@
+"""Contains a rule matching the heavy hitters found by accounting."""
+from rules import register, SimpleRule
+import accounting
+
+
+class HeavyHitterRule(SimpleRule):
+    """Matches packets from the current heavy hitters of a dimension.
+
+    Needs an "accounting" object in the configuration (see accounting).
+    Takes:
+    - dimension: an ingress accounting dimension ('src' by default).
+    - metric: 'bytes' (the default) or 'packets'.
+    - threshold: the count, in the current window, above which a key is a
+      heavy hitter.
+    - top: only consider the top N keys (all of the top-K table by default).
+    - window: 'current' (the default), or 'previous' to use the last
+      complete window.
+
+    The set of heavy hitters is updated once per batch of packets.
+
+    """
+
+    def __init__(self, **kwargs):
+        SimpleRule.__init__(self, **kwargs)
+        self._accountant = accounting.get_accountant()
+        if self._accountant is None:
+            raise ValueError('HeavyHitterRule needs an "accounting" object'
+                             ' in the configuration.')
+        self._dimension = kwargs.get('dimension', 'src')
+        if self._dimension not in self._accountant.dimensions:
+            raise ValueError('Dimension "%s" is not counted on ingress.' %
+                             self._dimension)
+        self._metric = kwargs.get('metric', 'bytes')
+        if self._metric not in accounting.METRICS:
+            raise ValueError('Unknown metric "%s".' % self._metric)
+        if 'threshold' not in kwargs:
+            raise ValueError('HeavyHitterRule needs a "threshold".')
+        self._threshold = kwargs['threshold']
+        self._top = kwargs.get('top', None)
+        self._window = kwargs.get('window', 'current')
+        if self._window not in ('current', 'previous'):
+            raise ValueError('Unknown window "%s".' % self._window)
+        self._key_of = accounting.KEYS[self._dimension]
+        self._version = None
+        self._heavy = frozenset()
+
+    def heavy_hitters(self):
+        """Return the keys over the threshold, recomputed after a flush."""
+        accountant = self._accountant
+        if accountant.version != self._version:
+            self._version = accountant.version
+            index = 1 if self._metric == 'packets' else 2
+            top = accountant.top(self._dimension, self._metric,
+                                 self._top or accountant.top_size,
+                                 self._window)
+            self._heavy = frozenset(entry[0] for entry in top
+                                    if entry[index] > self._threshold)
+        return self._heavy
+
+    def filter_condition(self, pywall_packet):
+        heavy = self.heavy_hitters()
+        return bool(heavy) and self._key_of(pywall_packet.buf) in heavy
+
+
+register(HeavyHitterRule)
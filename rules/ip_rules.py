@@ -2,20 +2,29 @@
 import netaddr
 
 from rules import register, SimpleRule
+from blocklist import Blocklist
 
 
 class IPRangeRule(SimpleRule):
     """Filter IP packets based on source/dest address."""
 
+    cacheable = True
+
     def __init__(self, **kwargs):
         """Create an IPRangeRule, taking the cidr_range."""
         SimpleRule.__init__(self, **kwargs)
         self._ip_range = netaddr.IPNetwork(kwargs['cidr_range'])
 
+    def match_space(self):
+        """Describe the address range this rule matches."""
+        return {self._dimension: (self._ip_range.first, self._ip_range.last)}
+
 
 class SourceIPRule(IPRangeRule):
     """Filter IP packets based on source address"""
 
+    _dimension = 'src_ip'
+
     def __init__(self, **kwargs):
         """Takes single argument, 'cidr_range', passed to super."""
         IPRangeRule.__init__(self, **kwargs)
@@ -30,6 +39,8 @@ class SourceIPRule(IPRangeRule):
 class DestinationIPRule(IPRangeRule):
     """Filter IP packets based on destination address"""
 
+    _dimension = 'dst_ip'
+
     def __init__(self, **kwargs):
         """Takes single argument, 'cidr_range', passed to super."""
         IPRangeRule.__init__(self, **kwargs)
@@ -38,5 +49,37 @@ class DestinationIPRule(IPRangeRule):
         """True if destination address falls within the ip_range."""
         return pywall_packet.get_dst_ip() in self._ip_range
 
+
+class BlocklistRule(SimpleRule):
+    """Filter IP packets against a compiled, memory-mapped blocklist.
+
+    Takes 'path', a file written by blocklist.py, and 'direction': 'src'
+    (the default), 'dst' or 'both'.  The file is re-mapped when a new version
+    is moved into place, checked every 'check_interval' seconds.
+
+    """
+
+    def __init__(self, **kwargs):
+        """Map the blocklist file."""
+        SimpleRule.__init__(self, **kwargs)
+        direction = kwargs.get('direction', 'src')
+        if direction not in ('src', 'dst', 'both'):
+            raise ValueError('direction should be "src", "dst" or "both"')
+        self._check_src = direction in ('src', 'both')
+        self._check_dst = direction in ('dst', 'both')
+        self._blocklist = Blocklist(kwargs['path'],
+                                    kwargs.get('check_interval', 5.0))
+
+    def filter_condition(self, pywall_packet):
+        """True if the source or destination address is blocklisted."""
+        buf = pywall_packet.buf
+        if self._check_src and \
+                int.from_bytes(buf[12:16], 'big') in self._blocklist:
+            return True
+        return self._check_dst and \
+            int.from_bytes(buf[16:20], 'big') in self._blocklist
+
+
 register(SourceIPRule)
-register(DestinationIPRule)
\ No newline at end of file
+register(DestinationIPRule)
+register(BlocklistRule)
\ No newline at end of file
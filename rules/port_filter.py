@@ -6,15 +6,41 @@ from rules import register
 from rules import SimpleRule
 
 
+def port_mask(port_lo, port_hi):
+    """Return an int with the bits for ports [port_lo, port_hi] set."""
+    return ((1 << (port_hi - port_lo + 1)) - 1) << port_lo
+
+
+# Named groups of ports that may be used in the port lists of PortSetRule.
+SERVICE_GROUPS = {
+    'dns': [53],
+    'ssh': [22],
+    'web': [80, 443, 8000, 8080, 8443],
+    'mail': [25, 110, 143, 465, 587, 993, 995],
+    'ntp': [123],
+    'netbios': ['137-139', 445],
+    'rpc': [111, 135],
+    'databases': [1433, 1521, 3306, 5432, 6379, 9042, 27017],
+    'well_known': ['0-1023'],
+    'registered': ['1024-49151'],
+    'ephemeral': ['49152-65535'],
+}
+
+_PROTOCOLS = {'TCP': socket.IPPROTO_TCP, 'UDP': socket.IPPROTO_UDP}
+
+
 class PortRule(SimpleRule):
     """Class for filtering out packets to/from a single port"""
 
+    cacheable = True
+
     def __init__(self, **kwargs):
         """Create a rule for a single source and/or destination port."""
+        SimpleRule.__init__(self, action=kwargs.get('action', 'DROP'))
         protocol = kwargs.get('protocol', None)
         self._src_port = kwargs.get('src_port', None)
         self._dst_port = kwargs.get('dst_port', None)
-        self._action = kwargs.get('action', 'DROP')
+        self._action = self.action
 
         if protocol == 'TCP':
             self._protocol = socket.IPPROTO_TCP
@@ -39,12 +65,24 @@ class PortRule(SimpleRule):
             print('PortRule: %s' % str(self._action))
         return match
 
+    def match_space(self):
+        """Describe the protocol and ports this rule matches."""
+        space = {'protocol': frozenset([self._protocol])}
+        if self._src_port is not None:
+            space['src_port'] = port_mask(self._src_port, self._src_port)
+        if self._dst_port is not None:
+            space['dst_port'] = port_mask(self._dst_port, self._dst_port)
+        return space
+
 
 class PortRangeRule(SimpleRule):
     """Blocks all packets with given protocol on inclusive range [lo, hi]."""
 
+    cacheable = True
+
     def __init__(self, **kwargs):
         """Creates a rule that takes matches port ranges."""
+        SimpleRule.__init__(self, action=kwargs.get('action', 'DROP'))
         protocol = kwargs.get('protocol', None)
         self._src_lo = kwargs.get('src_lo', None)
         self._src_hi = kwargs.get('src_hi', None)
@@ -52,7 +90,7 @@ class PortRangeRule(SimpleRule):
         self._dst_hi = kwargs.get('dst_hi', None)
         self._src_range = (self._src_lo, self._src_hi)
         self._dst_range = (self._dst_lo, self._dst_hi)
-        self._action = kwargs.get('action', 'DROP')
+        self._action = self.action
 
         if protocol == 'TCP':
             self._protocol = socket.IPPROTO_TCP
@@ -71,10 +109,10 @@ class PortRangeRule(SimpleRule):
 
     def _is_port_range_valid(self, port_lo, port_hi):
         """Return true if a port range is valid."""
-        valid = (port_hi is None and port_lo is None) or \
-                (port_hi is not None and port_lo is not None)
-        valid = valid and (port_lo <= port_hi)
-        return valid
+        if port_hi is None and port_lo is None:
+            return True
+        return port_hi is not None and port_lo is not None and \
+            port_lo <= port_hi
 
     def filter_condition(self, packet):
         """Condition to jump to action chain."""
@@ -88,6 +126,141 @@ class PortRangeRule(SimpleRule):
             print('PortRangeRule: %s' % str(self._action))
         return match
 
+    def match_space(self):
+        """Describe the protocol and port ranges this rule matches."""
+        space = {'protocol': frozenset([self._protocol])}
+        if self._src_range != (None, None):
+            space['src_port'] = port_mask(self._src_lo, self._src_hi)
+        if self._dst_range != (None, None):
+            space['dst_port'] = port_mask(self._dst_lo, self._dst_hi)
+        return space
+
+
+class PortSetRule(SimpleRule):
+    """Matches TCP/UDP ports against a precompiled 65536-bit bitmap.
+
+    One PortSetRule replaces any number of PortRule and PortRangeRule
+    objects with the same action: matching is a single bit test per port,
+    however many ports and ranges were given.
+
+    Arguments:
+    - protocol: 'TCP', 'UDP' or a list of both.
+    - src_ports, dst_ports: lists of ports.  An entry may be a port number,
+      a range ("1000-2000" or [1000, 2000]), the name of a service group
+      (see SERVICE_GROUPS) or a service name known to the system ("https").
+      Either may also be a dict mapping a protocol to such a list; a
+      protocol in neither dict is not matched.
+    - groups: extra named groups, added to SERVICE_GROUPS for this rule.
+
+    When both src_ports and dst_ports are given, both must match.
+
+    """
+
+    cacheable = True
+
+    def __init__(self, **kwargs):
+        """Compile the port lists into one bitmap per protocol and side."""
+        SimpleRule.__init__(self, action=kwargs.get('action', 'DROP'))
+        protocols = kwargs.get('protocol', None)
+        if not isinstance(protocols, list):
+            protocols = [protocols]
+        src_ports = kwargs.get('src_ports', None)
+        dst_ports = kwargs.get('dst_ports', None)
+        self._groups = dict(SERVICE_GROUPS)
+        self._groups.update(kwargs.get('groups', {}))
+
+        if src_ports is None and dst_ports is None:
+            raise ValueError('At least one of src_ports or dst_ports should'
+                             ' be non-None')
+        self._maps = {}
+        for protocol in protocols:
+            if protocol not in _PROTOCOLS:
+                raise ValueError('protocol should be either TCP or UDP')
+            maps = (self._compile(src_ports, protocol),
+                    self._compile(dst_ports, protocol))
+            # A protocol left out of every port dict has no ports to match;
+            # keeping it would match all of its packets.
+            if maps != (None, None):
+                self._maps[_PROTOCOLS[protocol]] = maps
+        if not self._maps:
+            raise ValueError('No ports for protocol %s' %
+                             ', '.join(str(protocol) for protocol in protocols))
+
+    def _compile(self, entries, protocol):
+        """Build the bitmap for a list of entries, or None for no list."""
+        if isinstance(entries, dict):
+            entries = entries.get(protocol, None)
+        if entries is None:
+            return None
+        mask = 0
+        for port_lo, port_hi in self._expand(entries, protocol, set()):
+            if not 0 <= port_lo <= port_hi <= 65535:
+                raise ValueError('Invalid port range %d-%d' %
+                                 (port_lo, port_hi))
+            mask |= port_mask(port_lo, port_hi)
+        return bytearray(mask.to_bytes(8192, 'little'))
+
+    def _expand(self, entries, protocol, seen):
+        """Yield (lo, hi) ranges for a list of port entries."""
+        for entry in entries:
+            if isinstance(entry, int):
+                yield entry, entry
+            elif isinstance(entry, list) and len(entry) == 2:
+                yield int(entry[0]), int(entry[1])
+            elif isinstance(entry, str) and entry.isdigit():
+                yield int(entry), int(entry)
+            elif isinstance(entry, str) and '-' in entry and \
+                    entry.replace('-', '', 1).isdigit():
+                port_lo, port_hi = entry.split('-')
+                yield int(port_lo), int(port_hi)
+            elif isinstance(entry, str) and entry in self._groups:
+                if entry in seen:
+                    raise ValueError('Service group "%s" includes itself' %
+                                     entry)
+                for port_range in self._expand(self._groups[entry], protocol,
+                                               seen | set([entry])):
+                    yield port_range
+            elif isinstance(entry, str):
+                try:
+                    port = socket.getservbyname(entry, protocol.lower())
+                except OSError:
+                    raise ValueError('Unknown port or service "%s"' % entry)
+                yield port, port
+            else:
+                raise ValueError('Invalid port entry %r' % (entry,))
+
+    def filter_condition(self, packet):
+        """Condition to jump to action chain."""
+        maps = self._maps.get(packet.get_protocol())
+        if maps is None:
+            return False
+        payload = packet.get_payload()
+        if payload is None:
+            return False
+        src_map, dst_map = maps
+        if src_map is not None:
+            port = payload.get_src_port()
+            if not src_map[port >> 3] & (1 << (port & 7)):
+                return False
+        if dst_map is not None:
+            port = payload.get_dst_port()
+            if not dst_map[port >> 3] & (1 << (port & 7)):
+                return False
+        return True
+
+    def match_space(self):
+        """Describe the protocols and (combined) port sets of this rule."""
+        space = {'protocol': frozenset(self._maps)}
+        for index, dimension in enumerate(('src_port', 'dst_port')):
+            bitmaps = [maps[index] for maps in self._maps.values()]
+            if None in bitmaps:
+                continue
+            space[dimension] = 0
+            for bitmap in bitmaps:
+                space[dimension] |= int.from_bytes(bitmap, 'little')
+        return space
+
 
 register(PortRule)
-register(PortRangeRule)
\ No newline at end of file
+register(PortRangeRule)
+register(PortSetRule)
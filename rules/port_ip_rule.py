@@ -7,6 +7,8 @@ from rules.ip_rules import SourceIPRule, DestinationIPRule
 
 class IPPortRule(SimpleRule):
 
+    cacheable = True
+
     def __init__(self, **kwargs):
         """Creates a combination of rules."""
         SimpleRule.__init__(self, **kwargs)
@@ -41,4 +43,12 @@ class IPPortRule(SimpleRule):
             res = res and self.ip_dst_rule.filter_condition(packet)
         return res
 
+    def match_space(self):
+        """Combine the match spaces of the port and IP rules."""
+        space = self.port_rule.match_space()
+        for ip_rule in (self.ip_src_rule, self.ip_dst_rule):
+            if ip_rule:
+                space.update(ip_rule.match_space())
+        return space
+
 register(IPPortRule)
\ No newline at end of file
@@ -22,6 +22,8 @@ class PortKnocking(Rule):
 
     """
 
+    cacheable = True
+
     def __init__(self, **kwargs):
         """Create the port knocking rule."""
         self._protocol = self._proto_to_const(kwargs.get('protocol', None))
@@ -32,6 +34,10 @@ class PortKnocking(Rule):
         self._doors = self._convert_doors(kwargs.get('doors', []))
         self._activity = {}  # IP -> (state, timestamp)
 
+    def containers(self):
+        """The per-source knock state grows with the number of knockers."""
+        return {'activity': self._activity}
+
     def _proto_to_const(self, protocol_str):
         """Convert a string protocol to the IP Protocol number."""
         if protocol_str == 'TCP':
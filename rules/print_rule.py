@@ -7,14 +7,17 @@ from rules import register, SimpleRule
 class PrintRule(SimpleRule):
     """Rule that just prints the socket and its payload.
 
-    This is mostly irrelevent now that logging is enabled.
+    This is mostly irrelevent now that logging is enabled.  It prints every
+    packet, which is very slow; use CaptureRule to look at live traffic.
 
     """
 
+    cacheable = True
+
     def filter_condition(self, pywall_packet):
         """Prints out packet information at the IP level."""
-        print(unicode(pywall_packet))
-        print(unicode(pywall_packet.get_payload()))
+        print(str(pywall_packet))
+        print(str(pywall_packet.get_payload()))
         # Action should not be applied. Ever.
         return False
 
@@ -1,17 +1,25 @@
 """Contains rules that match TCP packets, and track state."""
 import socket
+import time
 
 from rules import register, SimpleRule
 from packets import to_tuple
 from defnd import get_pipe
+import latency
 
 
 class TCPRule(SimpleRule):
     """Returns True when a packet is TCP."""
 
+    cacheable = True
+
     def filter_condition(self, pywall_packet):
         return pywall_packet.get_protocol() == socket.IPPROTO_TCP
 
+    def match_space(self):
+        """Match every TCP packet."""
+        return {'protocol': frozenset([socket.IPPROTO_TCP])}
+
 
 class TCPStateRule(TCPRule):
     """A rule that matches TCP packets in a certain state.
@@ -49,13 +57,23 @@ class TCPStateRule(TCPRule):
         if not TCPRule.filter_condition(self, defnd_packet):
             return False
         pipe = get_pipe()
+        trace = latency.active
+        if trace is not None:
+            start = time.perf_counter_ns()
         pipe.send(to_tuple(defnd_packet))
         state = pipe.recv()
+        if trace is not None:
+            trace.tracer.record('tracker_query',
+                                time.perf_counter_ns() - start)
         if self.match_if:
             return state in self.match_if
         else:
             return state not in self.match_if_not
 
+    def match_space(self):
+        """Depends on connection tracker state, so never reorder."""
+        return None
+
 
 register(TCPRule)
 register(TCPStateRule)
\ No newline at end of file
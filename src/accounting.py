@@ -0,0 +1,324 @@
+"""Traffic accounting: the top talkers, in fixed memory.
+
+Counting the packets and bytes of every source address, port or flow in a
+dict would take one entry per key, and a flood from spoofed sources would
+make it grow without bound.  Instead, each dimension counts into a count-min
+sketch (depth rows of width counters: an estimate is never below the true
+count, and is above it by at most 2 * total / width with high probability),
+and keeps the keys with the largest estimates in a top-K table that, like
+space-saving, replaces its smallest entry when a larger key comes along.
+Memory depends only on width, depth and top, never on the traffic.
+
+Counting happens in time windows of `window` seconds.  When one ends it
+becomes the previous window, still queryable, and counting starts over.
+
+The ingress and egress workers each have an Accountant when the
+configuration has an "accounting" object:
+
+    "accounting": {
+        "ingress": ["src", "dst_port"],
+        "egress": ["dst", "src_port"],
+        "width": 2048, "depth": 4, "top": 64, "window": 60
+    }
+
+Dimensions are 'src' and 'dst' (addresses), 'src_port' and 'dst_port' (TCP
+and UDP ports), and 'flow' (addresses, ports and protocol).  Workers call
+add() with each raw packet, and flush() at the end of each batch, so that a
+key seen several times in a batch is counted into the sketch once.  The
+'top' control command queries the top N, and rules.heavy_hitter.
+HeavyHitterRule drops the current heavy hitters.
+
+"""
+from array import array
+import socket
+import struct
+import time
+
+import control
+import diagnostics
+
+DEFAULTS = {
+    'ingress': ['src', 'dst_port'],
+    'egress': ['dst', 'src_port'],
+    'width': 2048,
+    'depth': 4,
+    'top': 64,
+    'window': 60.0,
+}
+
+METRICS = ('packets', 'bytes')
+
+_PORTS = struct.Struct('!HH')
+
+# The Accountant of this process, if any.
+_accountant = None
+
+
+def get_accountant():
+    """Return the Accountant of this process, or None."""
+    return _accountant
+
+
+def settings(spec):
+    """Return the settings of an "accounting" object, with defaults."""
+    unknown = set(spec) - set(DEFAULTS)
+    if unknown:
+        raise ValueError('Unknown accounting settings: %s' %
+                         ', '.join(sorted(unknown)))
+    result = dict(DEFAULTS)
+    result.update(spec)
+    for direction in ('ingress', 'egress'):
+        for dimension in result[direction]:
+            if dimension not in KEYS:
+                raise ValueError('Unknown accounting dimension "%s"' %
+                                 dimension)
+    return result
+
+
+def _ports(buf):
+    """Return the (source, destination) ports of a TCP or UDP packet."""
+    ihl = (buf[0] & 0xF) * 4
+    if buf[9] in (6, 17) and len(buf) >= ihl + 4:
+        return _PORTS.unpack_from(buf, ihl)
+    return None, None
+
+
+def _flow(buf):
+    ihl = (buf[0] & 0xF) * 4
+    return bytes(buf[12:20]) + bytes(buf[ihl:ihl + 4]) + bytes(buf[9:10])
+
+
+# Dimension -> function returning the key of a raw IP packet, or None.
+KEYS = {
+    'src': lambda buf: bytes(buf[12:16]),
+    'dst': lambda buf: bytes(buf[16:20]),
+    'src_port': lambda buf: _ports(buf)[0],
+    'dst_port': lambda buf: _ports(buf)[1],
+    'flow': _flow,
+}
+
+
+def format_key(dimension, key):
+    """Return a key as a readable string or number."""
+    if dimension in ('src', 'dst'):
+        return socket.inet_ntoa(key)
+    elif dimension == 'flow':
+        src_port, dst_port = _PORTS.unpack(key[8:12])
+        return '%s:%d > %s:%d %d' % (socket.inet_ntoa(key[:4]), src_port,
+                                     socket.inet_ntoa(key[4:8]), dst_port,
+                                     key[12])
+    return key
+
+
+def _keys(counts):
+    """Return the keys of a dict that the packet thread may be changing."""
+    while True:
+        try:
+            return list(counts)
+        except RuntimeError:
+            # Changed size while copied, from another thread.
+            continue
+
+
+class CountMinSketch(object):
+    """depth rows of width counters.
+
+    The row indexes of a key are computed once, by indexes(), and shared by
+    every sketch of the same shape.
+
+    """
+
+    def __init__(self, width, depth):
+        self.width = width
+        self.depth = depth
+        self.rows = [array('q', bytes(8 * width)) for _ in range(depth)]
+
+    def indexes(self, key):
+        """Return the counter index of a key in each row."""
+        # Two halves of one hash make all the row hashes (Kirsch and
+        # Mitzenmacher).  The tuple mixes small ints, which hash to
+        # themselves.
+        digest = hash((key,))
+        first = digest & 0xFFFFFFFF
+        step = (digest >> 32) & 0xFFFFFFFF | 1
+        return [(first + row * step) % self.width
+                for row in range(self.depth)]
+
+    def add(self, indexes, count):
+        for row, index in zip(self.rows, indexes):
+            row[index] += count
+
+    def estimate(self, indexes):
+        return min(row[index] for row, index in zip(self.rows, indexes))
+
+    def clear(self):
+        for row in self.rows:
+            row[:] = array('q', bytes(8 * self.width))
+
+
+class TopK(object):
+    """The k keys with the largest counts seen.
+
+    A key not in the table replaces the smallest entry when its count is
+    larger.  Counts only grow within a window, so the smallest entry is only
+    looked for again when it was replaced or grew.
+
+    """
+
+    def __init__(self, k):
+        self.k = k
+        self.counts = {}
+        self._min_key = None
+
+    def offer(self, key, count):
+        """Update the count of a key, entering it in the table if it is
+        large enough."""
+        counts = self.counts
+        if key in counts or len(counts) < self.k:
+            counts[key] = count
+            if key == self._min_key:
+                self._min_key = None
+            return
+        if self._min_key is None:
+            self._min_key = min(counts, key=counts.get)
+        if count > counts[self._min_key]:
+            del counts[self._min_key]
+            counts[key] = count
+            self._min_key = None
+
+    def clear(self):
+        self.counts.clear()
+        self._min_key = None
+
+
+class _Dimension(object):
+    """The sketches and top-K tables of one dimension, in one window."""
+
+    def __init__(self, width, depth, top):
+        self.sketches = dict((metric, CountMinSketch(width, depth))
+                             for metric in METRICS)
+        self.tops = dict((metric, TopK(top)) for metric in METRICS)
+
+    def add(self, key, packets, nbytes):
+        packet_sketch = self.sketches['packets']
+        byte_sketch = self.sketches['bytes']
+        indexes = packet_sketch.indexes(key)
+        packet_sketch.add(indexes, packets)
+        byte_sketch.add(indexes, nbytes)
+        self.tops['packets'].offer(key, packet_sketch.estimate(indexes))
+        self.tops['bytes'].offer(key, byte_sketch.estimate(indexes))
+
+    def top(self, metric, n):
+        """Return the n largest (key, packets, bytes), by metric."""
+        # The counts of the table are those of the last update of each key;
+        # the sketch may have grown since, through collisions.  Queries run
+        # on the control thread while the packet thread updates the table,
+        # so it is copied first.
+        packet_sketch = self.sketches['packets']
+        byte_sketch = self.sketches['bytes']
+        result = []
+        for key in _keys(self.tops[metric].counts):
+            indexes = packet_sketch.indexes(key)
+            result.append((key, packet_sketch.estimate(indexes),
+                           byte_sketch.estimate(indexes)))
+        column = 1 if metric == 'packets' else 2
+        result.sort(key=lambda entry: entry[column], reverse=True)
+        return result[:n]
+
+    def clear(self):
+        for sketch in self.sketches.values():
+            sketch.clear()
+        for top in self.tops.values():
+            top.clear()
+
+
+class Accountant(object):
+    """Counts the packets of one worker along some dimensions."""
+
+    def __init__(self, dimensions, width=2048, depth=4, top=64, window=60.0,
+                 clock=None):
+        self.dimensions = list(dimensions)
+        self.top_size = top
+        self.window = window
+        self._clock = clock or time.monotonic
+        self.current = dict((dimension, _Dimension(width, depth, top))
+                            for dimension in self.dimensions)
+        self.previous = dict((dimension, _Dimension(width, depth, top))
+                             for dimension in self.dimensions)
+        self.window_start = self._clock()
+        self.windows = 0
+        # Bumped by every flush, so that users can cache what they derive.
+        self.version = 0
+        self._pending = {}
+        self._keys = [(dimension, KEYS[dimension])
+                      for dimension in self.dimensions]
+
+    def add(self, buf):
+        """Count a raw IP packet, until the next flush()."""
+        length = len(buf)
+        pending = self._pending
+        for dimension, key_of in self._keys:
+            key = key_of(buf)
+            if key is None:
+                continue
+            counts = pending.get((dimension, key))
+            if counts is None:
+                pending[(dimension, key)] = [1, length]
+            else:
+                counts[0] += 1
+                counts[1] += length
+
+    def flush(self):
+        """Add the packets counted since the last flush to the window."""
+        now = self._clock()
+        if now - self.window_start >= self.window:
+            self.rotate(now)
+        current = self.current
+        for (dimension, key), (packets, nbytes) in self._pending.items():
+            current[dimension].add(key, packets, nbytes)
+        self._pending.clear()
+        self.version += 1
+
+    def rotate(self, now=None):
+        """End the current window."""
+        self.previous, self.current = self.current, self.previous
+        for dimension in self.current.values():
+            dimension.clear()
+        self.window_start = self._clock() if now is None else now
+        self.windows += 1
+
+    def top(self, dimension, metric='bytes', n=10, window='current'):
+        """Return the n largest (key, packets, bytes) of a dimension."""
+        if dimension not in self.current:
+            raise ValueError('Dimension "%s" is not counted' % dimension)
+        if metric not in METRICS:
+            raise ValueError('Unknown metric "%s"' % metric)
+        if window not in ('current', 'previous'):
+            raise ValueError('Unknown window "%s"' % window)
+        tables = self.current if window == 'current' else self.previous
+        return tables[dimension].top(metric, int(n))
+
+    def query(self, dimension=None, metric='bytes', n=10, window='current'):
+        """The 'top' control command, run on the control thread."""
+        dimensions = [dimension] if dimension else self.dimensions
+        return {'window': window, 'metric': metric,
+                'window_seconds': self.window,
+                'window_age': self._clock() - self.window_start,
+                'top': dict((name, [[format_key(name, key), packets, nbytes]
+                                    for key, packets, nbytes in
+                                    self.top(name, metric, n, window)])
+                            for name in dimensions)}
+
+
+def create(direction, spec):
+    """Create the Accountant of a worker ('ingress' or 'egress') from the
+    settings of an "accounting" object, and make it the one of this
+    process."""
+    global _accountant
+    options = settings(spec)
+    _accountant = Accountant(options[direction], options['width'],
+                             options['depth'], options['top'],
+                             options['window'])
+    control.register_command('top', _accountant.query)
+    diagnostics.register_subsystem('accounting.pending', _accountant._pending)
+    return _accountant
@@ -0,0 +1,202 @@
+"""Compiled, memory-mapped IPv4 blocklists.
+
+Threat intelligence feeds list millions of addresses, CIDR ranges and
+"first-last" ranges.  Parsing them into netaddr objects in every process is
+slow and memory hungry, so a feed is compiled once into a binary file of
+sorted, merged [start, end] integer intervals:
+
+    header: magic "DFBL", version, byte order, interval count
+    starts: count unsigned 32 bit integers, ascending
+    ends:   count unsigned 32 bit integers
+
+A Blocklist maps that file read-only and binary-searches it directly, so
+loading takes no time and the page cache is shared by every process using the
+same file.  Compiling writes a temporary file and renames it over the old
+one; open Blocklists notice the new file and switch to it.
+
+Compile a feed with:
+
+    python blocklist.py feed.txt feed.dfbl
+
+"""
+from __future__ import print_function
+from array import array
+from bisect import bisect_right
+import argparse
+import logging
+import mmap
+import os
+import socket
+import struct
+import sys
+import time
+
+MAGIC = b'DFBL'
+VERSION = 1
+_HEADER = struct.Struct('<4sBBHQ')
+_BYTE_ORDERS = {'little': 0, 'big': 1}
+
+
+def _address(text):
+    """Convert a dotted quad to an integer."""
+    return struct.unpack('!I', socket.inet_aton(text))[0]
+
+
+def parse_entry(entry):
+    """Convert one feed entry to an inclusive (start, end) integer range.
+
+    Accepts an address, a CIDR range or a "first-last" range.  Raises
+    ValueError (or OSError, for a bad address) on anything else.
+
+    """
+    if '/' in entry:
+        address, prefix = entry.split('/', 1)
+        prefix = int(prefix)
+        if not 0 <= prefix <= 32:
+            raise ValueError('Invalid prefix length in %r' % entry)
+        size = 1 << (32 - prefix)
+        start = _address(address) & ~(size - 1) & 0xffffffff
+        return start, start + size - 1
+    if '-' in entry:
+        first, last = entry.split('-', 1)
+        start, end = _address(first.strip()), _address(last.strip())
+        if start > end:
+            raise ValueError('Empty range %r' % entry)
+        return start, end
+    start = _address(entry)
+    return start, start
+
+
+def merge(intervals):
+    """Sort intervals and merge those that overlap or touch."""
+    intervals.sort()
+    merged = []
+    for start, end in intervals:
+        if merged and start <= merged[-1][1] + 1:
+            if end > merged[-1][1]:
+                merged[-1][1] = end
+        else:
+            merged.append([start, end])
+    return merged
+
+
+def compile_feed(feed_filename, output_filename):
+    """Compile a text feed into a blocklist file.
+
+    Blank lines and comments (from "#" or ";") are ignored, as is anything
+    after the first token of a line.  Returns (intervals, skipped), where
+    skipped counts lines that could not be parsed, such as IPv6 entries.
+
+    """
+    intervals = []
+    skipped = 0
+    with open(feed_filename) as feed:
+        for line in feed:
+            line = line.split('#', 1)[0].split(';', 1)[0].strip()
+            if not line:
+                continue
+            try:
+                intervals.append(parse_entry(line.split()[0]))
+            except (ValueError, OSError):
+                skipped += 1
+    merged = merge(intervals)
+    write_blocklist(output_filename, merged)
+    return len(merged), skipped
+
+
+def write_blocklist(filename, merged):
+    """Write sorted, merged intervals to filename atomically."""
+    starts = array('I', [start for start, _ in merged])
+    ends = array('I', [end for _, end in merged])
+    tmp_filename = '%s.%d.tmp' % (filename, os.getpid())
+    with open(tmp_filename, 'wb') as out:
+        out.write(_HEADER.pack(MAGIC, VERSION, _BYTE_ORDERS[sys.byteorder], 0,
+                               len(merged)))
+        starts.tofile(out)
+        ends.tofile(out)
+    os.replace(tmp_filename, filename)
+
+
+class Blocklist(object):
+    """A read-only, memory-mapped blocklist file.
+
+    `address in blocklist` is a binary search over the mapped intervals.
+    Every `check_interval` seconds the file is stat()ed, and if it was
+    replaced the new version is mapped instead.  A new version that cannot
+    be mapped is logged, and the previous one is kept.
+
+    """
+
+    def __init__(self, filename, check_interval=5.0):
+        """Map the blocklist file."""
+        self.filename = filename
+        self.check_interval = check_interval
+        self._identity = None
+        self._intervals = None
+        self._next_check = 0.0
+        self._load()
+
+    def _load(self):
+        """Map the current file and swap it in."""
+        with open(self.filename, 'rb') as blocklist_file:
+            stat = os.fstat(blocklist_file.fileno())
+            mapping = mmap.mmap(blocklist_file.fileno(), 0,
+                                access=mmap.ACCESS_READ)
+        magic, version, byte_order, _, count = _HEADER.unpack_from(mapping)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('%s: not a blocklist file' % self.filename)
+        if byte_order != _BYTE_ORDERS[sys.byteorder]:
+            raise ValueError('%s: compiled on a host with a different byte'
+                             ' order' % self.filename)
+        if len(mapping) != _HEADER.size + 8 * count:
+            raise ValueError('%s: truncated blocklist file' % self.filename)
+        view = memoryview(mapping)
+        starts = view[_HEADER.size:_HEADER.size + 4 * count].cast('I')
+        ends = view[_HEADER.size + 4 * count:].cast('I')
+        # One assignment, so lookups never see half of a swap.
+        self._intervals = (starts, ends)
+        self._identity = (stat.st_dev, stat.st_ino, stat.st_mtime_ns)
+
+    def reload_if_changed(self):
+        """Map the file again if it was replaced.  Returns True if so."""
+        try:
+            stat = os.stat(self.filename)
+        except OSError:
+            return False
+        identity = (stat.st_dev, stat.st_ino, stat.st_mtime_ns)
+        if identity == self._identity:
+            return False
+        try:
+            self._load()
+        except (OSError, ValueError, struct.error) as e:
+            logging.getLogger('defnd.blocklist').warning(
+                'Keeping the previous version of %s: %s' % (self.filename, e))
+            # Not tried again until it is replaced once more.
+            self._identity = identity
+            return False
+        return True
+
+    def __len__(self):
+        return len(self._intervals[0])
+
+    def __contains__(self, address):
+        """True if the integer address is on the blocklist."""
+        now = time.monotonic()
+        if now >= self._next_check:
+            self._next_check = now + self.check_interval
+            self.reload_if_changed()
+        starts, ends = self._intervals
+        i = bisect_right(starts, address) - 1
+        return i >= 0 and address <= ends[i]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Compile an IPv4 feed into a DefNd blocklist file')
+    parser.add_argument('feed', help='text feed of addresses and ranges')
+    parser.add_argument('output', help='blocklist file to write')
+    args = parser.parse_args()
+    start = time.time()
+    intervals, skipped = compile_feed(args.feed, args.output)
+    print('Wrote %d intervals to %s in %.1fs (%d lines skipped)' %
+          (intervals, args.output, time.time() - start, skipped))
@@ -0,0 +1,187 @@
+"""Compiles chains of rules into straight-line Python functions.
+
+Evaluating a chain rule by rule goes through Rule.__call__,
+SimpleRule.__call__ and filter_condition for every rule, with attribute
+lookups and repeated packet.get_payload() calls along the way.  For the
+stateless rules of rules.port_filter, rules.ip_rules, rules.port_ip_rule and
+TCPRule, the generator here emits their conditions inline instead, with their
+constants as literals.  The packet fields a chain needs are read once, at the
+top of the function.
+
+Any other rule (stateful, custom, or a subclass of the rules above) is called
+as usual from the generated code, so compiled chains always give the same
+verdict as interpreted ones.  Rules that print when they match still do.
+
+"""
+import linecache
+
+import rules
+
+
+class _Chain(object):
+    """State of the code generator for one chain."""
+
+    def __init__(self, chain_name):
+        self.chain_name = chain_name
+        self.namespace = {'_print': print}
+        self.fields = set()
+
+    def constant(self, value):
+        """Bind a value in the namespace of the function, returning its
+        name."""
+        name = '_k%d' % len(self.namespace)
+        self.namespace[name] = value
+        return name
+
+    def port_condition(self, protocol, src, dst):
+        """Condition for a protocol and optional (lo, hi) port ranges."""
+        self.fields.add('proto')
+        terms = ['proto == %d' % protocol]
+        for field, port_range in (('src_port', src), ('dst_port', dst)):
+            if port_range is None:
+                continue
+            self.fields.add(field)
+            port_lo, port_hi = port_range
+            if port_lo == port_hi:
+                terms.append('%s == %d' % (field, port_lo))
+            else:
+                terms.append('%d <= %s <= %d' % (port_lo, field, port_hi))
+        return ' and '.join(terms)
+
+    def ip_condition(self, field, ip_range):
+        self.fields.add(field)
+        return '%d <= %s <= %d' % (ip_range.first, field, ip_range.last)
+
+
+def _block(condition, body, prefix=()):
+    """Lines for `if condition:` followed by prefix and body, indented."""
+    return ['if %s:' % condition] + \
+        ['    ' + line for line in list(prefix) + body]
+
+
+def _match_lines(rule, chain, body):
+    """Return the lines evaluating rule, running body if it matches.
+
+    Returns None for rules that cannot be inlined.
+
+    """
+    # Rules are recognized by their registered name, and only when they are
+    # exactly the registered class, never a subclass.
+    kind = type(rule).__name__
+    if rules.rules.get(kind) is not type(rule):
+        return None
+    if kind == 'PortRule':
+        src = dst = None
+        if rule._src_port is not None:
+            src = (rule._src_port, rule._src_port)
+        if rule._dst_port is not None:
+            dst = (rule._dst_port, rule._dst_port)
+        return _block(chain.port_condition(rule._protocol, src, dst), body,
+                      ['_print(%r)' % ('PortRule: %s' % rule._action)])
+    elif kind == 'PortRangeRule':
+        src = rule._src_range if rule._src_range != (None, None) else None
+        dst = rule._dst_range if rule._dst_range != (None, None) else None
+        return _block(chain.port_condition(rule._protocol, src, dst), body,
+                      ['_print(%r)' % ('PortRangeRule: %s' % rule._action)])
+    elif kind == 'PortSetRule':
+        chain.fields.add('proto')
+        alternatives = []
+        for protocol, bitmaps in sorted(rule._maps.items()):
+            terms = ['proto == %d' % protocol]
+            for field, bitmap in zip(('src_port', 'dst_port'), bitmaps):
+                if bitmap is not None:
+                    chain.fields.add(field)
+                    # A packet without ports reads as port -1.
+                    terms.append('%s >= 0 and %s[%s >> 3] & (1 << (%s & 7))'
+                                 % (field, chain.constant(bitmap), field,
+                                    field))
+            alternatives.append('(%s)' % ' and '.join(terms))
+        return _block(' or '.join(alternatives), body)
+    elif kind in ('SourceIPRule', 'DestinationIPRule'):
+        field = 'src_addr' if kind == 'SourceIPRule' else 'dst_addr'
+        return _block(chain.ip_condition(field, rule._ip_range), body)
+    elif kind == 'IPPortRule':
+        inner = []
+        if rule.ip_src_rule:
+            inner.append(chain.ip_condition('src_addr',
+                                            rule.ip_src_rule._ip_range))
+        if rule.ip_dst_rule:
+            inner.append(chain.ip_condition('dst_addr',
+                                            rule.ip_dst_rule._ip_range))
+        if inner:
+            body = _block(' and '.join(inner), body)
+        return _match_lines(rule.port_rule, chain, body)
+    elif kind == 'TCPRule':
+        chain.fields.add('proto')
+        return _block('proto == 6', body)
+    return None
+
+
+_FIELDS = [
+    ('proto', ['proto = packet.get_protocol()']),
+    ('ports', ['payload = packet.get_payload()',
+               'if payload is not None:',
+               '    src_port = payload.get_src_port()',
+               '    dst_port = payload.get_dst_port()',
+               'else:',
+               '    src_port = dst_port = -1']),
+    ('src_addr', ["src_addr = int.from_bytes(packet.buf[12:16], 'big')"]),
+    ('dst_addr', ["dst_addr = int.from_bytes(packet.buf[16:20], 'big')"]),
+]
+
+
+def generate_chain(chain_name, chain_rules):
+    """Return (source, namespace) of the function evaluating a chain.
+
+    The function is named `chain`; it takes an IPPacket and returns the
+    verdict or chain to jump to, or False to fall through to the default.
+
+    """
+    chain = _Chain(chain_name)
+    body = []
+    inlined = 0
+    for index, rule in enumerate(chain_rules):
+        body.append('# %d: %s' % (index, type(rule).__name__))
+        action = getattr(rule, 'action', None)
+        on_match = ['return %r' % action] if action else ['pass']
+        lines = _match_lines(rule, chain, on_match)
+        if lines is None:
+            name = chain.constant(rule)
+            lines = ['result = %s(packet)' % name,
+                     'if result:', '    return result']
+        else:
+            inlined += 1
+        body.extend(lines)
+    body.append('return False')
+
+    if chain.fields & set(('src_port', 'dst_port')):
+        chain.fields.add('ports')
+    header = []
+    for field, lines in _FIELDS:
+        if field in chain.fields:
+            header.extend(lines)
+    source = '\n'.join(
+        ['# chain %r: %d of %d rules inlined' %
+         (chain_name, inlined, len(chain_rules)), 'def chain(packet):'] +
+        ['    ' + line for line in header + body]) + '\n'
+    return source, chain.namespace
+
+
+def compile_chain(chain_name, chain_rules):
+    """Generate and compile the function evaluating a chain."""
+    source, namespace = generate_chain(chain_name, chain_rules)
+    filename = '<defnd chain %s>' % chain_name
+    # Let tracebacks and debuggers show the generated source.
+    linecache.cache[filename] = (len(source), None,
+                                 source.splitlines(True), filename)
+    exec(compile(source, filename, 'exec'), namespace)
+    function = namespace['chain']
+    function.source = source
+    return function
+
+
+def compile_chains(chains):
+    """Compile every chain of a DefNd's chains dict."""
+    return dict((chain_name, compile_chain(chain_name, chain_rules))
+                for chain_name, chain_rules in chains.items()
+                if chain_rules is not None)
@@ -1,7 +1,216 @@
 """ DEFND instnace creation using Config File"""
 
-import json
 from __future__ import print_function
+import copy
+import hashlib
+import json
+import logging
+import os
+import pickle
+import sys
+import accounting
 import rules
-from rules import *
-from defnd import defnd
+from defnd import DefNd
+import receiver
+import startup
+import synflood
+
+# Top level keys of a configuration file that are not chains.
+OPTIONS = ('default_chain', 'compile_chains', 'syn_protection', 'queue',
+           'accounting')
+
+# The compiled configuration of FILE is FILE + COMPILED_SUFFIX.
+COMPILED_SUFFIX = '.compiled'
+COMPILED_FORMAT = 2
+
+
+def _digest(filename):
+    with open(filename, 'rb') as source:
+        return hashlib.sha256(source.read()).hexdigest()
+
+
+class defndConfig(object):
+    """Parses a JSON configuration file and builds a DefNd from it.
+
+    The file maps chain names to lists of rules.  Each rule is an object with
+    a "name" key naming a registered rule class; the remaining keys are passed
+    to its constructor.  The optional "default_chain" key sets the chain used
+    when no rule matches (DROP if absent).  Chains are compiled to Python
+    functions (see codegen) unless "compile_chains" is false.  The optional
+    "syn_protection" object turns on SYN-flood protection (see synflood), and
+    the optional "queue" object tunes the receive loop (see receiver).  The
+    optional "accounting" object counts the top talkers (see accounting).
+
+    Rule classes are looked up with rules.get_rule, which imports only the
+    modules of the rules used.  compile() writes the built rules next to the
+    file; create_defnd() then loads them instead of building them again, as
+    long as neither the file nor the modules of those rules changed.
+
+    """
+
+    def __init__(self, filename):
+        """Read the configuration file."""
+        self.filename = filename
+        with open(filename, 'rb') as config_file:
+            data = config_file.read()
+        self.digest = hashlib.sha256(data).hexdigest()
+        self.config = json.loads(data.decode('utf-8'))
+        self.compiled_filename = filename + COMPILED_SUFFIX
+
+    def chain_specs(self):
+        """Return a dict of chain name to the list of rule specifications."""
+        return dict((name, value) for name, value in self.config.items()
+                    if name not in OPTIONS)
+
+    def build_rule(self, rule_spec):
+        """Construct a rule object from its specification."""
+        rule_spec = copy.deepcopy(rule_spec)
+        name = rule_spec.pop('name')
+        return rules.get_rule(name)(**rule_spec)
+
+    def syn_protection(self):
+        """Return the SYN-flood protection settings, or None when off."""
+        spec = self.config.get('syn_protection')
+        if spec is None:
+            return None
+        return synflood.settings(spec)
+
+    def queue_settings(self):
+        """Return the settings of the receive loop of both workers."""
+        return receiver.settings(self.config.get('queue', {}))
+
+    def create_defnd(self, packet_queue, query_pipe, attack_flag=None,
+                     compiled=True):
+        """Create a DefNd with the chains of this configuration.
+
+        attack_flag is the shared under-attack flag of the trackers (see
+        synflood); without it, the DefNd has no SYN guard.  The rules are
+        loaded from the compiled configuration if it is up to date, unless
+        compiled is false.
+
+        """
+        the_wall = DefNd(packet_queue, query_pipe,
+                         default=self.config.get('default_chain', 'DROP'))
+        protection = self.syn_protection()
+        if protection is not None and attack_flag is not None:
+            the_wall.syn_guard = synflood.SynGuard(attack_flag, **protection)
+        # Before the rules: HeavyHitterRule uses the accountant.
+        if 'accounting' in self.config:
+            the_wall.accountant = accounting.create('ingress',
+                                                    self.config['accounting'])
+        startup.mark('config')
+        built = self.load_compiled() if compiled else None
+        for chain_name, rule_list in self.chain_specs().items():
+            if chain_name not in the_wall.chains:
+                the_wall.add_chain(chain_name)
+            for index, rule_spec in enumerate(rule_list):
+                rule = built[chain_name][index] if built else None
+                if rule is None:
+                    rule = self.build_rule(rule_spec)
+                the_wall.add_rule(chain_name, rule)
+        startup.mark('rules')
+        if self.config.get('compile_chains', True):
+            the_wall.compile()
+            startup.mark('codegen')
+        return the_wall
+
+    def validate(self, the_wall):
+        """Check that every chain a rule or the default jumps to exists."""
+        targets = [('default_chain', the_wall.default)]
+        for chain_name, rule_list in the_wall.chains.items():
+            for index, rule in enumerate(rule_list or []):
+                action = getattr(rule, 'action', None)
+                if action:
+                    targets.append(('%s[%d]' % (chain_name, index), action))
+        for where, target in targets:
+            if target not in the_wall.chains:
+                raise ValueError('%s jumps to unknown chain "%s"' %
+                                 (where, target))
+
+    def compile(self, filename=None):
+        """Build the rules and write them to a compiled configuration.
+
+        Rules that are not cacheable (see rules.Rule) are written as their
+        specification, and built again when loaded.  Returns the number of
+        rules written built, and the total.
+
+        """
+        filename = filename or self.compiled_filename
+        the_wall = self.create_defnd(None, None, compiled=False)
+        self.validate(the_wall)
+        chains = {}
+        sources = {}
+        inputs = {}
+        cached = total = 0
+        for chain_name, rule_list in self.chain_specs().items():
+            chains[chain_name] = []
+            for rule in the_wall.chains[chain_name]:
+                total += 1
+                if not type(rule).cacheable:
+                    chains[chain_name].append(None)
+                    continue
+                cached += 1
+                chains[chain_name].append(rule)
+                for cls in type(rule).__mro__:
+                    module = sys.modules.get(cls.__module__)
+                    path = getattr(module, '__file__', None)
+                    if path and cls.__module__ not in sources:
+                        sources[cls.__module__] = (path, _digest(path))
+                for path in rule.inputs():
+                    inputs[path] = _digest(path)
+        # The modules and input files go first, so that they can be checked
+        # before the rules are unpickled.
+        header = {'format': COMPILED_FORMAT,
+                  'python': tuple(sys.version_info[:2]),
+                  'config': self.digest, 'sources': sources,
+                  'inputs': inputs}
+        tmp_filename = '%s.%d.tmp' % (filename, os.getpid())
+        with open(tmp_filename, 'wb') as out:
+            pickle.dump(header, out, pickle.HIGHEST_PROTOCOL)
+            pickle.dump(chains, out, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_filename, filename)
+        return cached, total
+
+    def load_compiled(self, filename=None):
+        """Return the chains of rules of the compiled configuration, with
+        None for the rules to build, or None if it is missing or stale."""
+        filename = filename or self.compiled_filename
+        log = logging.getLogger('defnd.config')
+        try:
+            compiled = open(filename, 'rb')
+        except IOError:
+            return None
+        with compiled:
+            try:
+                header = pickle.load(compiled)
+                stale = self._stale(header)
+                if stale is None:
+                    return pickle.load(compiled)
+            except (EOFError, pickle.UnpicklingError, ImportError,
+                    AttributeError, ValueError) as e:
+                stale = 'could not be read (%s)' % e
+        log.warning('Ignoring %s, which %s; run --compile-config' %
+                    (filename, stale))
+        return None
+
+    def _stale(self, header):
+        """Return why a compiled configuration is stale, or None."""
+        if not isinstance(header, dict) or \
+                header.get('format') != COMPILED_FORMAT or \
+                header.get('python') != tuple(sys.version_info[:2]):
+            return 'was written by another version'
+        if header.get('config') != self.digest:
+            return 'is older than %s' % self.filename
+        for module, (path, digest) in header['sources'].items():
+            if not os.path.exists(path) or _digest(path) != digest:
+                return 'is older than module %s' % module
+        for path, digest in header['inputs'].items():
+            if not os.path.exists(path) or _digest(path) != digest:
+                return 'is older than %s' % path
+        return None
+
+    def save(self, filename):
+        """Write the (possibly modified) configuration to a file."""
+        with open(filename, 'w') as config_file:
+            json.dump(self.config, config_file, indent=4)
+            config_file.write('\n')
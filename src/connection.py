@@ -3,21 +3,180 @@ from __future__ import print_function
 import select
 import logging
 
+import control
+import diagnostics
+import latency
+import startup
+import synflood
+
+# Connections moved into the table, or closed ones removed from it, per step
+# once the table is no longer frozen (see DefndTracker.freeze).
+MERGE_BATCH = 2000
+
 class DefndTracker(object):
     #Central TCP CONNECTION tracking process and class
-    def __init__(self, ingress_queue, egress_queue, query_pipe):
+    def __init__(self, ingress_queue, egress_queue, query_pipe,
+                 protection=None, attack_flag=None):
         self.ingress_queue = ingress_queue
         self.egress_queue = egress_queue
         self.query_pipe = query_pipe
         self.connections = {}
-    
+        # The state of a connection: state_of(tup, 'CLOSED').
+        self.state_of = self.connections.get
+        # While frozen (see freeze), the connections opened since, and the
+        # closed ones still in the table.
+        self.added = None
+        self._closed = None
+        self._frozen = 0
+        self.state_counts = {}
+        self.readers = {}
+        self.writers = {}
+        self.watchers = []
+        self.timers = []
+        # SYN-flood protection settings (see synflood), or None.
+        self.limiter = None
+        if protection is not None:
+            self.limiter = synflood.HalfOpenLimiter(self, attack_flag,
+                                                    **protection)
+            self.add_watcher(self.limiter.on_state)
+            self.add_timer(self.limiter.expire, self.limiter.timeout)
+        self.add_timer(self._merge, self._merge_timeout)
+        diagnostics.register_subsystem('tracker.connections', self.connections)
+        diagnostics.register_subsystem('tracker.ingress_queue', ingress_queue)
+        diagnostics.register_subsystem('tracker.egress_queue', egress_queue)
+        control.register_command('stats', self.stats)
+
+    def add_reader(self, fileobj, callback):
+        """Call callback() from run() whenever fileobj is readable."""
+        self.readers[fileobj.fileno()] = callback
+
+    def remove_reader(self, fileobj):
+        """Stop watching fileobj (before closing it)."""
+        self.readers.pop(fileobj.fileno(), None)
+
+    def add_writer(self, fileobj, callback):
+        """Call callback() from run() whenever fileobj is writable."""
+        self.writers[fileobj.fileno()] = callback
+
+    def remove_writer(self, fileobj):
+        """Stop waiting for fileobj to be writable (before closing it)."""
+        self.writers.pop(fileobj.fileno(), None)
+
+    def add_watcher(self, callback):
+        """Call callback(tup, old, new) on every change of state, before the
+        table is updated."""
+        self.watchers.append(callback)
+
+    def add_timer(self, tick, timeout):
+        """Call tick() from run() at least every timeout() seconds.
+
+        timeout() may return None to wait for input only.
+        """
+        self.timers.append((tick, timeout))
+
+    def set_state(self, tup, new):
+        """Record the new state of a connection.
+
+        Every change to the table goes through here.  CLOSED connections are
+        removed, since that is what a missing entry means anyway.
+        """
+        counts = self.state_counts
+        old = self.state_of(tup, 'CLOSED')
+        if old == new:
+            return
+        for watcher in self.watchers:
+            watcher(tup, old, new)
+        if old != 'CLOSED':
+            counts[old] -= 1
+        if new != 'CLOSED':
+            counts[new] = counts.get(new, 0) + 1
+        connections = self.connections
+        added = self.added
+        if added is not None and tup in added:
+            if new == 'CLOSED':
+                del added[tup]
+            else:
+                added[tup] = new
+        elif new != 'CLOSED':
+            if self._frozen and tup not in connections:
+                added[tup] = new
+            else:
+                connections[tup] = new
+        elif self._frozen:
+            # Marked rather than removed, to keep the keys in place.
+            connections[tup] = 'CLOSED'
+            self._closed.append(tup)
+        else:
+            del connections[tup]
+
+    def freeze(self):
+        """Keep the keys of the table in place until as many thaw() calls, so
+        that an iterator over it stays valid between the steps of the loop.
+
+        Meanwhile closed connections stay in the table as 'CLOSED', and new
+        ones go to self.added; state_of() looks at both.  Once thawed, the
+        table catches up MERGE_BATCH connections per step.
+        """
+        if self.added is None:
+            self.added = {}
+            self._closed = []
+            self.state_of = self._frozen_state_of
+        self._frozen += 1
+
+    def thaw(self):
+        """Undo one freeze()."""
+        self._frozen -= 1
+
+    def _frozen_state_of(self, tup, default=None):
+        state = self.connections.get(tup)
+        if state is None:
+            return self.added.get(tup, default)
+        return state
+
+    def _merge(self):
+        if self._frozen or self.added is None:
+            return
+        connections, added, closed = self.connections, self.added, self._closed
+        for _ in range(min(MERGE_BATCH, len(added))):
+            tup, state = added.popitem()
+            connections[tup] = state
+        for tup in closed[-MERGE_BATCH:]:
+            # Unless it was opened again.
+            if connections.get(tup) == 'CLOSED':
+                del connections[tup]
+        del closed[-MERGE_BATCH:]
+        if not added and not closed:
+            self.added = self._closed = None
+            self.state_of = connections.get
+
+    def _merge_timeout(self):
+        if self._frozen or self.added is None:
+            return None
+        return 0.0
+
+    def items(self):
+        """Return the (tuple, state) of every connection, as a list."""
+        if self.added is None:
+            return list(self.connections.items())
+        return [(tup, state) for tup, state in self.connections.items()
+                if state != 'CLOSED'] + list(self.added.items())
+
+    def stats(self):
+        """Return the size of the table and the number of connections in each
+        state."""
+        return {'connections': sum(self.state_counts.values()),
+                'states': dict((state, count) for state, count
+                               in self.state_counts.items() if count)}
+
     def handle_ingress(self, report):
         tup, syn, ack, fin = report
-        curr = self.connections.get(tup, 'CLOSED')
+        curr = self.state_of(tup, 'CLOSED')
         l = logging.getLogger('defnd.connection')
         new = None
         if curr == "CLOSED":
             if syn:
+                if self.limiter is not None and not self.limiter.admit(tup):
+                    return
                 new = 'SYN_RCVD1'
             else:
                 new = 'ESTABLISHED'
@@ -61,8 +220,8 @@ class DefndTracker(object):
         else:
             l.debug('RCV: %r (%s): syn=%r, ack=%r, fin=%r => %s' %
                     (tup, curr, syn, ack, fin, new))
-        self.connections[tup] = new
-        
+        self.set_state(tup, new)
+
     def handle_egress(self, report):
         #Handle an egress packet 'report'.
 
@@ -70,7 +229,7 @@ class DefndTracker(object):
         #TCP state diagram (only including transitions for egress packets).
 
         tup, syn, ack, fin = report
-        curr = self.connections.get(tup, 'CLOSED')
+        curr = self.state_of(tup, 'CLOSED')
         l = logging.getLogger('defnd.connection')
         new = None
         if curr == 'CLOSED':
@@ -126,30 +285,66 @@ class DefndTracker(object):
             l.debug('SND: %r (%s): syn=%r, ack=%r, fin=%r => %s' %
                     (tup, curr, syn, ack, fin, new))
 
-        self.connections[tup] = new 
-        
-    def handle_query(self, con_tuple):
-        self.query_pipe.send(self.connections.get(con_tuple, 'CLOSED'))
-    
+        self.set_state(tup, new)
+
+    def add_query_pipe(self, pipe):
+        """Answer the queries of another pipe too, e.g. the shadow's."""
+        self.add_reader(pipe, lambda: self.handle_query(pipe.recv(), pipe))
+
+    def handle_query(self, con_tuple, pipe=None):
+        """Answer a query from the pipe (query_pipe by default) with the state
+        of the connection."""
+        pipe = pipe or self.query_pipe
+        pipe.send(self.state_of(con_tuple, 'CLOSED'))
+
     def run(self):
         """Run the connection tracking process.
 
         Selects on the IPC, waiting for input.
         """
+        egress_fd = self.egress_queue._reader.fileno()
+        ingress_fd = self.ingress_queue._reader.fileno()
+        query_fd = self.query_pipe.fileno()
+        startup.ready()
         while True:
-            egress_fd = self.egress_queue._reader.fileno()
-            ingress_fd = self.ingress_queue._reader.fileno()
-            query_fd = self.query_pipe.fileno()
+            fds = [egress_fd, ingress_fd, query_fd] + list(self.readers)
 
-            # Use select to get a list of file descriptors ready to be read.
-            ready, _, _ = select.select([egress_fd, ingress_fd, query_fd], [], [])
+            # Use select to get a list of file descriptors ready to be read
+            # or written, waking up in time for the next timer.
+            timeout = None
+            for tick, next_timeout in self.timers:
+                tick()
+                wait = next_timeout()
+                if wait is not None and (timeout is None or wait < timeout):
+                    timeout = wait
+            ready, writable, _ = select.select(fds, list(self.writers), [],
+                                               timeout)
             for ready_fd in ready:
                 if ready_fd == egress_fd:
                     egress_packet = self.egress_queue.get_nowait()
-                    self.handle_egress(egress_packet)
+                    # Workers may send a list of reports at once.
+                    if type(egress_packet) is not list:
+                        egress_packet = [egress_packet]
+                    for report in egress_packet:
+                        trace = latency.tracer.start()
+                        self.handle_egress(report)
+                        if trace is not None:
+                            trace.mark('handle_egress')
                 elif ready_fd == ingress_fd:
                     ingess_packet = self.ingress_queue.get_nowait()
-                    self.handle_ingress(ingess_packet)
+                    if type(ingess_packet) is not list:
+                        ingess_packet = [ingess_packet]
+                    for report in ingess_packet:
+                        trace = latency.tracer.start()
+                        self.handle_ingress(report)
+                        if trace is not None:
+                            trace.mark('handle_ingress')
                 elif ready_fd == query_fd:
                     self.handle_query(self.query_pipe.recv())
+                elif ready_fd in self.readers:
+                    # A reader may have been removed by an earlier callback.
+                    self.readers[ready_fd]()
+            for ready_fd in writable:
+                if ready_fd in self.writers:
+                    self.writers[ready_fd]()
                        
\ No newline at end of file
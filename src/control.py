@@ -0,0 +1,438 @@
+"""Control sockets: run diagnostic commands inside a running DefNd process.
+
+Each process started with a control directory (`main.py --control-dir DIR`)
+listens on a UNIX socket in it: defnd.sock, egress.sock and tracker-N.sock.
+Without a control directory no socket is created and nothing here runs.
+
+The protocol is one JSON request per connection, {"command": name, "args":
+{...}}, answered by JSON lines.  A command handler returns a JSON value,
+which is sent as {"ok": true, "result": value}.  A handler may instead return
+a generator: each value it yields is sent as {"ok": true, "chunk": value},
+followed by {"ok": true, "end": true}.  Errors are sent as {"ok": false,
+"error": message}.  In a select loop (see ControlServer.attach), generators
+are resumed once per pump(), between the loop's other work, and may yield
+None to give the loop back without sending anything.
+
+Commands are registered with register_command, much like rules are.  From a
+shell:
+
+    python control.py /run/defnd/tracker-0.sock memory
+    python control.py /run/defnd/defnd.sock tracemalloc action=start
+
+With --trackers, the command goes to every tracker shard of a control
+directory, and the replies are merged (see request_trackers):
+
+    python control.py --trackers /run/defnd stats
+
+"""
+from __future__ import print_function
+import argparse
+import glob
+import json
+import logging
+import os
+import socket
+import sys
+import threading
+import types
+
+commands = {}
+
+# Longest request accepted, and reply bytes buffered for a client beyond
+# which its stream is paused.
+MAX_REQUEST = 65536
+HIGH_WATER = 65536
+
+
+def register_command(name, handler):
+    """Make handler(**args) available as a control command."""
+    commands[name] = handler
+
+
+def _help():
+    return sorted(commands)
+
+
+register_command('help', _help)
+
+
+class _Client(object):
+    """A connection being answered from a select loop."""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.request = b''
+        self.output = bytearray()
+        self.writing = False
+        # The generator of a streaming command, until it ends.
+        self.chunks = None
+        # Close once the output is sent.
+        self.done = False
+
+
+class ControlServer(object):
+    """Listens on a UNIX socket and runs the commands it receives.
+
+    Either call serve_in_thread(), for processes whose main thread blocks
+    elsewhere, or attach() the server to a select loop.  In a select loop no
+    call ever blocks: client sockets are non-blocking, requests and replies
+    are buffered, and generator commands are resumed once per pump(), only
+    while their client keeps up with the replies.
+
+    """
+
+    def __init__(self, path):
+        """Bind the socket, replacing a stale one."""
+        self.path = path
+        self._loop = None
+        self._clients = set()
+        if os.path.exists(path):
+            os.unlink(path)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.bind(path)
+        self._sock.listen(8)
+
+    def fileno(self):
+        return self._sock.fileno()
+
+    def serve_in_thread(self):
+        """Handle connections from a daemon thread."""
+        thread = threading.Thread(target=self._serve_forever)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _serve_forever(self):
+        while True:
+            self.handle_ready()
+
+    def handle_ready(self):
+        """Accept one connection and answer its request, blocking."""
+        client, _ = self._sock.accept()
+        try:
+            client.settimeout(5.0)
+            self._answer(client, self._read_request(client))
+        except (OSError, ValueError) as e:
+            logging.getLogger('defnd.control').warning(
+                'Control request failed: %s' % e)
+        finally:
+            client.close()
+
+    def attach(self, loop):
+        """Serve from a select loop.
+
+        The loop must provide add_reader(fileobj, callback), add_writer(),
+        remove_reader(fileobj), remove_writer() and add_timer(tick,
+        timeout), like connection.DefndTracker.
+
+        """
+        self._loop = loop
+        self._sock.setblocking(False)
+        loop.add_reader(self._sock, self._accept)
+        loop.add_timer(self.pump, self.timeout)
+
+    def _accept(self):
+        try:
+            sock, _ = self._sock.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        sock.setblocking(False)
+        client = _Client(sock)
+        self._clients.add(client)
+        self._loop.add_reader(sock, lambda: self._read(client))
+
+    def _read(self, client):
+        try:
+            data = client.sock.recv(4096)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            self._drop(client, e)
+            return
+        if not data:
+            self._drop(client, 'connection closed before the request')
+            return
+        client.request += data
+        if len(client.request) > MAX_REQUEST:
+            self._drop(client, 'request over %d bytes' % MAX_REQUEST)
+            return
+        if not client.request.endswith(b'\n'):
+            return
+        self._loop.remove_reader(client.sock)
+        try:
+            result = _run(json.loads(client.request.decode('utf-8')))
+        except Exception as e:
+            result = None
+            self._queue(client, _error(e))
+            client.done = True
+        if isinstance(result, types.GeneratorType):
+            client.chunks = result
+        elif not client.done:
+            self._queue(client, {'ok': True, 'result': result})
+            client.done = True
+
+    def _queue(self, client, reply):
+        client.output += _encode(reply)
+        if not client.writing:
+            client.writing = True
+            self._loop.add_writer(client.sock, lambda: self._write(client))
+
+    def _write(self, client):
+        try:
+            sent = client.sock.send(client.output)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            self._drop(client, e)
+            return
+        del client.output[:sent]
+        if not client.output:
+            client.writing = False
+            self._loop.remove_writer(client.sock)
+            if client.done:
+                self._drop(client)
+
+    def _drop(self, client, reason=None):
+        if reason is not None:
+            logging.getLogger('defnd.control').warning(
+                'Control request failed: %s' % reason)
+        self._loop.remove_reader(client.sock)
+        self._loop.remove_writer(client.sock)
+        client.sock.close()
+        self._clients.discard(client)
+
+    def _runnable(self, client):
+        return client.chunks is not None and len(client.output) < HIGH_WATER
+
+    def pump(self):
+        """Resume every stream whose client is not behind."""
+        for client in list(self._clients):
+            if not self._runnable(client):
+                continue
+            try:
+                chunk = next(client.chunks)
+            except StopIteration:
+                reply = {'ok': True, 'end': True}
+            except Exception as e:
+                reply = _error(e)
+            else:
+                if chunk is not None:
+                    self._queue(client, {'ok': True, 'chunk': chunk})
+                continue
+            client.chunks = None
+            client.done = True
+            self._queue(client, reply)
+
+    def timeout(self):
+        """Seconds until pump() has something to do, or None."""
+        if any(self._runnable(client) for client in self._clients):
+            return 0.0
+        return None
+
+    def _read_request(self, client):
+        data = b''
+        while not data.endswith(b'\n'):
+            chunk = client.recv(4096)
+            if not chunk:
+                break
+            data += chunk
+        return json.loads(data.decode('utf-8'))
+
+    def _answer(self, client, request):
+        """Answer a request to the end."""
+        try:
+            result = _run(request)
+            if isinstance(result, types.GeneratorType):
+                for chunk in result:
+                    if chunk is not None:
+                        client.sendall(_encode({'ok': True, 'chunk': chunk}))
+                client.sendall(_encode({'ok': True, 'end': True}))
+            else:
+                client.sendall(_encode({'ok': True, 'result': result}))
+        except OSError:
+            raise
+        except Exception as e:
+            client.sendall(_encode(_error(e)))
+
+    def close(self):
+        for client in list(self._clients):
+            self._drop(client)
+        if self._loop is not None:
+            self._loop.remove_reader(self._sock)
+        self._sock.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+def _run(request):
+    """Run the command of a request, returning its result."""
+    name = request.get('command')
+    if name not in commands:
+        raise ValueError('Unknown command "%s"' % name)
+    return commands[name](**request.get('args', {}))
+
+
+def _error(e):
+    return {'ok': False, 'error': '%s: %s' % (type(e).__name__, e)}
+
+
+def _encode(reply):
+    return (json.dumps(reply, default=str) + '\n').encode('utf-8')
+
+
+def start_server(control_dir, name, in_thread=True):
+    """Start the control server of a process, if control_dir is set.
+
+    Without in_thread, the caller attaches the server to its select loop.
+    Returns the server, or None.
+
+    """
+    if not control_dir:
+        return None
+    server = ControlServer(os.path.join(control_dir, name + '.sock'))
+    if in_thread:
+        server.serve_in_thread()
+    return server
+
+
+def request(path, command, **args):
+    """Send a command to a control socket and yield its replies."""
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(path)
+    try:
+        client.sendall((json.dumps({'command': command, 'args': args}) +
+                        '\n').encode('utf-8'))
+        reader = client.makefile('r')
+        for line in reader:
+            yield json.loads(line)
+    finally:
+        client.close()
+
+
+def tracker_sockets(control_dir):
+    """Return the paths of the tracker-N.sock sockets of a control
+    directory, by shard."""
+    paths = glob.glob(os.path.join(control_dir, 'tracker-*.sock'))
+    return sorted(paths, key=lambda path: int(
+        os.path.basename(path)[len('tracker-'):-len('.sock')]))
+
+
+def request_trackers(control_dir, command, **args):
+    """Send a command to every tracker shard and yield the merged replies.
+
+    Results are merged by merge_results.  'flows' lists the shards one after
+    the other, with cursors [shard, cursor of the shard]; its limit applies
+    to the whole listing.  The chunks of other streaming commands are passed
+    on as they are.
+
+    """
+    paths = tracker_sockets(control_dir)
+    if not paths:
+        yield {'ok': False, 'error': 'No tracker socket in %s' % control_dir}
+        return
+    if command == 'flows':
+        for reply in _request_flows(paths, **args):
+            yield reply
+        return
+    results = []
+    for path in paths:
+        for reply in request(path, command, **args):
+            if not reply['ok']:
+                reply['error'] = '%s: %s' % (os.path.basename(path),
+                                             reply['error'])
+                yield reply
+                return
+            if 'result' in reply:
+                results.append(reply['result'])
+            elif 'chunk' in reply:
+                yield reply
+    if results:
+        yield {'ok': True, 'result': merge_results(results)}
+    else:
+        yield {'ok': True, 'end': True}
+
+
+def _request_flows(paths, cursor=0, limit=1000, **args):
+    shard, shard_cursor = cursor or (0, 0)
+    remaining = int(limit)
+    for index in range(int(shard), len(paths)):
+        shard_args = dict(args, limit=remaining)
+        if shard_cursor:
+            shard_args['cursor'] = shard_cursor
+        done = False
+        for reply in request(paths[index], 'flows', **shard_args):
+            if not reply['ok']:
+                yield reply
+                return
+            if 'chunk' not in reply:
+                continue
+            chunk = reply['chunk']
+            remaining -= len(chunk['flows'])
+            done = chunk.get('done', False)
+            result = {'flows': chunk['flows'],
+                      'cursor': [index, chunk['cursor']]}
+            if done:
+                result['cursor'] = [index + 1, 0]
+                if index == len(paths) - 1:
+                    result['done'] = True
+            yield {'ok': True, 'chunk': result}
+        if not done or remaining <= 0:
+            break
+        shard_cursor = 0
+    yield {'ok': True, 'end': True}
+
+
+def merge_results(results):
+    """Merge the results of a command from several processes.
+
+    Numbers are summed, dicts merged key by key, and other values kept when
+    they are the same everywhere, or else listed in order.
+
+    """
+    if all(isinstance(result, dict) for result in results):
+        keys = []
+        for result in results:
+            keys.extend(key for key in result if key not in keys)
+        return dict((key, merge_results([result[key] for result in results
+                                         if key in result]))
+                    for key in keys)
+    if all(isinstance(result, (int, float)) and
+           not isinstance(result, bool) for result in results):
+        return sum(results)
+    if all(result == results[0] for result in results):
+        return results[0]
+    return results
+
+
+def _parse_value(text):
+    try:
+        return json.loads(text)
+    except ValueError:
+        return text
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Send a command to a DefNd control socket')
+    parser.add_argument('socket', help='path of the control socket, or the'
+                        ' control directory with --trackers')
+    parser.add_argument('-t', '--trackers', action='store_true',
+                        help='send the command to every tracker shard and'
+                        ' merge the replies')
+    parser.add_argument('command', help='command name ("help" lists them)')
+    parser.add_argument('args', nargs='*', help='arguments as key=value')
+    args = parser.parse_args()
+
+    kwargs = dict((key, _parse_value(value)) for key, value in
+                  (arg.split('=', 1) for arg in args.args))
+    failed = False
+    send = request_trackers if args.trackers else request
+    for reply in send(args.socket, args.command, **kwargs):
+        if not reply['ok']:
+            print(reply['error'], file=sys.stderr)
+            failed = True
+        elif 'result' in reply:
+            print(json.dumps(reply['result'], indent=2, default=str))
+        elif 'chunk' in reply:
+            print(json.dumps(reply['chunk'], default=str))
+    sys.exit(1 if failed else 0)
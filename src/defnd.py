@@ -1,4 +1,219 @@
+"""Contains the DefNd class, the ingress filtering process of the firewall."""
 from __future__ import print_function
 import os
 import logging
-import netfilterqueue as nfq
\ No newline at end of file
+import time
+
+from packets import IPPacket, TCPPacket, to_tuple
+import codegen
+import diagnostics
+import latency
+import queue_backend
+import receiver
+
+# Query pipe to the connection tracker, shared with TCPStateRule.
+_pipe = None
+
+
+def get_pipe():
+    """Return the pipe used to query the connection tracker."""
+    return _pipe
+
+
+class DefNd(object):
+    """The main class for DefNd.
+
+    Holds every chain of rules, receives INPUT packets from NFQUEUE and runs
+    them through the chains to decide a verdict.  TCP packets are reported to
+    the connection tracker over `packet_queue` before they are filtered.
+
+    """
+
+    def __init__(self, packet_queue, query_pipe, default='DROP', queue_num=1):
+        """Create a DefNd, specifying the default chain."""
+        self.chains = {'INPUT': [], 'ACCEPT': None, 'DROP': None}
+        self.default = default
+        self.queue_num = queue_num
+        self.packet_queue = packet_queue
+        self.query_pipe = query_pipe
+        self.profiler = None
+        self.compiled = {}
+        self.syn_guard = None
+        self.accountant = None
+        # Hands sampled packets to the shadow process (see shadow), or None.
+        self.shadow = None
+        self._nfq_init = 'iptables -I INPUT -j NFQUEUE --queue-num %d'
+        self._nfq_close = 'iptables -D INPUT -j NFQUEUE --queue-num %d'
+        global _pipe
+        _pipe = query_pipe
+
+    def add_chain(self, chain_name):
+        """Add a new, empty chain."""
+        if chain_name in self.chains:
+            raise KeyError('Chain named "%s" already exists.' % chain_name)
+        self.chains[chain_name] = []
+
+    def add_rule(self, chain_name, rule):
+        """Append a rule to a chain."""
+        self.chains[chain_name].append(rule)
+        self.compiled.pop(chain_name, None)
+        rule.placed(chain_name, len(self.chains[chain_name]) - 1)
+
+    def register_diagnostics(self):
+        """Account for the ingress queue and the state kept by rules."""
+        diagnostics.register_subsystem('defnd.ingress_queue',
+                                       self.packet_queue)
+        for chain_name, rules in self.chains.items():
+            for index, rule in enumerate(rules or []):
+                for name, container in rule.containers().items():
+                    diagnostics.register_subsystem(
+                        'rules.%s[%d].%s.%s' % (chain_name, index,
+                                                type(rule).__name__, name),
+                        container)
+
+    def compile(self):
+        """Replace the rule-by-rule evaluation of every chain with generated
+        code (see codegen).  Adding a rule to a chain undoes this for that
+        chain."""
+        self.compiled = codegen.compile_chains(self.chains)
+
+    def evaluate(self, chain_name, defnd_packet, trace=None):
+        """Run a packet through a chain and return 'ACCEPT' or 'DROP'.
+
+        A rule that returns the name of another chain jumps to it.  When no
+        rule of a chain matches, the packet goes to the default chain.  With
+        a latency Trace, rules are run one by one and each is timed.
+
+        """
+        visited = set()
+        while chain_name not in ('ACCEPT', 'DROP'):
+            if chain_name in visited:
+                raise ValueError('Chain loop through "%s"' % chain_name)
+            visited.add(chain_name)
+            rules = self.chains[chain_name]
+            if trace is not None:
+                result = self._traced_chain(chain_name, rules, defnd_packet,
+                                            trace)
+            elif self.profiler is not None:
+                result = self.profiler.run_chain(chain_name, rules,
+                                                 defnd_packet)
+            elif chain_name in self.compiled:
+                result = self.compiled[chain_name](defnd_packet)
+            else:
+                result = False
+                for rule in rules:
+                    result = rule(defnd_packet)
+                    if result:
+                        break
+            chain_name = result if result else self.default
+        return chain_name
+
+    def _traced_chain(self, chain_name, rules, defnd_packet, trace):
+        """Run a chain rule by rule, marking a trace stage per rule."""
+        for index, rule in enumerate(rules):
+            result = rule(defnd_packet)
+            trace.mark('rule.%s[%d].%s' % (chain_name, index,
+                                           type(rule).__name__))
+            if result:
+                return result
+        return False
+
+    def report(self, ip_packet):
+        """Send the TCP flags of a packet to the connection tracker."""
+        tcp_packet = ip_packet.get_payload()
+        if type(tcp_packet) is TCPPacket:
+            self.packet_queue.put((to_tuple(ip_packet),
+                                   bool(tcp_packet.flag_syn),
+                                   bool(tcp_packet.flag_ack),
+                                   bool(tcp_packet.flag_fin)))
+
+    def handle_batch(self, packets):
+        """Decide the verdicts of a batch of ingress packets, then issue
+        them (see receiver).
+
+        Each packet is still reported to the tracker just before it is
+        evaluated, so stateful rules see the same state as without batches.
+
+        """
+        guard = self.syn_guard
+        accountant = self.accountant
+        shadow = self.shadow
+        log = logging.getLogger('defnd.defnd')
+        verdicts = []
+        for packet in packets:
+            payload = packet.get_payload()
+            if accountant is not None:
+                accountant.add(payload)
+            if guard is not None and not guard.check(payload):
+                verdicts.append('DROP')
+                continue
+            trace = latency.tracer.start()
+            if trace is not None:
+                self.traced_callback(packet, trace)
+                verdicts.append(None)
+                continue
+            ip_packet = IPPacket(payload)
+            log.debug(str(ip_packet))
+            self.report(ip_packet)
+            if shadow is not None and shadow.sample():
+                start = time.perf_counter_ns()
+                verdict = self.evaluate('INPUT', ip_packet)
+                shadow.submit(payload, verdict,
+                              time.perf_counter_ns() - start)
+                verdicts.append(verdict)
+                continue
+            verdicts.append(self.evaluate('INPUT', ip_packet))
+        for packet, verdict in zip(packets, verdicts):
+            if verdict == 'ACCEPT':
+                packet.accept()
+            elif verdict is not None:
+                packet.drop()
+        if accountant is not None:
+            accountant.flush()
+
+    def traced_callback(self, packet, trace):
+        """handle_batch() for a packet sampled by the latency tracer."""
+        trace.delivery(packet)
+        ip_packet = IPPacket(packet.get_payload())
+        trace.mark('parse')
+        logging.getLogger('defnd.defnd').debug(str(ip_packet))
+        self.report(ip_packet)
+        trace.mark('report')
+        latency.active = trace
+        try:
+            verdict = self.evaluate('INPUT', ip_packet, trace)
+        finally:
+            latency.active = None
+        if verdict == 'ACCEPT':
+            packet.accept()
+        else:
+            packet.drop()
+        trace.mark('verdict')
+        trace.finish()
+
+    def erect(self, **kwargs):
+        """Set up IPTables and filter ingress packets until interrupted.
+
+        The 'backend' keyword selects the queue backend (see queue_backend),
+        and 'queue' holds the settings of the receive loop (see receiver).
+
+        """
+        backend = queue_backend.get_backend(kwargs.get('backend', 'nfqueue'))
+        engine = receiver.Receiver(backend, self.queue_num, self.handle_batch,
+                                   **kwargs.get('queue', {}))
+        self.register_diagnostics()
+        setup = self._nfq_init % self.queue_num + engine.iptables_options()
+        teardown = self._nfq_close % self.queue_num + \
+            engine.iptables_options()
+
+        backend.iptables(setup)
+        print('Set up IPTables: ' + setup)
+        try:
+            engine.run()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            backend.iptables(teardown)
+            print('\nTore down IPTables: ' + teardown + '\n')
+            if self.profiler is not None:
+                self.profiler.dump()
@@ -0,0 +1,141 @@
+"""Memory accounting per subsystem, and tracemalloc on demand.
+
+Subsystems register the containers that can grow (the tracker's connection
+table, rule state, IPC queues, ...) with register_subsystem.  Registration
+only keeps a reference, so it costs nothing until someone asks.  The
+'memory' control command then reports, for this process, the entry count and
+estimated size of each container, and the 'tracemalloc' command starts,
+stops and snapshots tracemalloc.
+
+"""
+import itertools
+import sys
+import tracemalloc
+
+import control
+
+# Subsystem name -> container, or a function returning one.
+subsystems = {}
+
+_SAMPLE = 64
+_snapshots = []
+
+
+def register_subsystem(name, container):
+    """Account for a container (or a callable returning one) under name."""
+    if container is not None:
+        subsystems[name] = container
+
+
+def _deep_size(obj):
+    """Size of an object plus, one level down, of the items it holds."""
+    size = sys.getsizeof(obj)
+    if isinstance(obj, (tuple, list, set, frozenset)):
+        size += sum(sys.getsizeof(item) for item in obj)
+    elif isinstance(obj, dict):
+        size += sum(sys.getsizeof(key) + sys.getsizeof(value)
+                    for key, value in obj.items())
+    return size
+
+
+def estimate(container):
+    """Return (entries, estimated bytes) for a container.
+
+    Dicts, lists and sets are measured from the size of the container plus the
+    average size of a sample of their items.  Queues only report their
+    backlog, since their items live in a pipe.  Bytes are None when unknown.
+
+    """
+    if hasattr(container, 'qsize'):
+        try:
+            return container.qsize(), None
+        except NotImplementedError:
+            return None, None
+    if isinstance(container, (bytes, bytearray)):
+        return len(container), sys.getsizeof(container)
+    entries = len(container)
+    if not entries:
+        return 0, sys.getsizeof(container)
+    for _ in range(3):
+        try:
+            if isinstance(container, dict):
+                sample = list(itertools.islice(container.items(), _SAMPLE))
+            else:
+                sample = list(itertools.islice(container, _SAMPLE))
+            break
+        except RuntimeError:
+            # Changed size while sampled, from another thread.
+            continue
+    else:
+        return entries, None
+    item_size = sum(_deep_size(item) for item in sample) / float(len(sample))
+    return entries, int(sys.getsizeof(container) + entries * item_size)
+
+
+def _rss():
+    """Resident set size of this process in bytes, if known."""
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def memory():
+    """The 'memory' command: RSS and per-subsystem estimates."""
+    report = {}
+    for name, container in sorted(subsystems.items()):
+        if callable(container):
+            container = container()
+        entries, size = estimate(container)
+        report[name] = {'entries': entries, 'bytes': size}
+    return {'rss': _rss(), 'tracemalloc': tracemalloc.is_tracing(),
+            'subsystems': report}
+
+
+def _format_stats(stats, limit):
+    return [str(stat) for stat in stats[:limit]]
+
+
+def trace(action='snapshot', nframes=1, limit=20, key_type='lineno'):
+    """The 'tracemalloc' command.
+
+    action is one of:
+    - start: start tracing with nframes frames per allocation.
+    - stop: stop tracing and forget the snapshots.
+    - snapshot: the top `limit` allocation sites.
+    - diff: the top changes since the previous snapshot or diff.
+
+    """
+    if action == 'start':
+        tracemalloc.start(int(nframes))
+        return {'tracing': True}
+    elif action == 'stop':
+        tracemalloc.stop()
+        del _snapshots[:]
+        return {'tracing': False}
+    if not tracemalloc.is_tracing():
+        raise ValueError('tracemalloc is not started')
+    snapshot = tracemalloc.take_snapshot().filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__)])
+    previous = _snapshots[-1] if _snapshots else None
+    _snapshots[:] = [snapshot]
+    current, peak = tracemalloc.get_traced_memory()
+    result = {'traced': current, 'peak': peak}
+    if action == 'snapshot':
+        result['top'] = _format_stats(snapshot.statistics(key_type), limit)
+    elif action == 'diff':
+        if previous is None:
+            raise ValueError('No previous snapshot to compare with')
+        result['diff'] = _format_stats(
+            snapshot.compare_to(previous, key_type), limit)
+    else:
+        raise ValueError('Unknown tracemalloc action "%s"' % action)
+    return result
+
+
+control.register_command('memory', memory)
+control.register_command('tracemalloc', trace)
@@ -0,0 +1,205 @@
+"""Listing the connection table of a tracker, a few entries at a time.
+
+The 'flows' control command of a tracker streams the connections matching a
+filter, in chunks.  The table may hold millions of entries, so it is never
+copied or walked in one go: each chunk scans at most `budget` entries, and
+the tracker's select loop handles its queues and pipe between chunks (see
+ControlServer.pump).
+
+A listing keeps an iterator over the table, which the tracker freezes while
+the listing is open (see DefndTracker.freeze): connections are not removed
+or added to it meanwhile, only marked closed or set aside, so the iterator
+stays valid whatever the traffic.  A listing returns at most `limit`
+connections per request.  Every chunk carries a cursor; passing it back
+continues the same listing, with the same filter, and the last chunk has
+"done": true once the whole table was scanned.  A connection that stays open
+during the whole listing is returned exactly once; connections opened
+meanwhile are not returned, and those closed meanwhile may or may not be.  A
+listing whose cursor is not used for IDLE_TIMEOUT seconds is dropped.
+
+Filters, all optional:
+- state: state names, separated by commas, with shell wildcards
+  ("SYN_SENT*,SYN_RCVD*").
+- remote_cidr, local_cidr: networks of the remote or local address.
+- remote_port, local_port: ports.
+
+    python control.py /run/defnd/tracker-0.sock flows remote_cidr=10.1.0.0/16 state='SYN_SENT*'
+
+"""
+import fnmatch
+import itertools
+import socket
+import struct
+import time
+
+import control
+
+# Seconds an open listing waits for its cursor.
+IDLE_TIMEOUT = 60.0
+
+
+def _address(ip):
+    return struct.unpack('!I', socket.inet_aton(ip))[0]
+
+
+def _network(cidr):
+    """Return the (first, last) addresses of an "a.b.c.d/n" network."""
+    address, _, length = cidr.partition('/')
+    length = int(length) if length else 32
+    if not 0 <= length <= 32:
+        raise ValueError('Invalid network "%s"' % cidr)
+    size = 1 << (32 - length)
+    first = _address(address) & ~(size - 1) & 0xffffffff
+    return first, first + size - 1
+
+
+class FlowFilter(object):
+    """Matches (tuple, state) entries of the connection table."""
+
+    def __init__(self, state=None, remote_cidr=None, local_cidr=None,
+                 remote_port=None, local_port=None):
+        self.states = None
+        if state:
+            self.states = [pattern.strip() for pattern in state.split(',')]
+        self.ranges = []
+        for field, cidr in ((0, remote_cidr), (2, local_cidr)):
+            if cidr:
+                self.ranges.append((field,) + _network(cidr))
+        self.ports = [(field, int(port)) for field, port in
+                      ((1, remote_port), (3, local_port))
+                      if port is not None]
+        self._state_cache = {}
+
+    def _state_matches(self, state):
+        matches = self._state_cache.get(state)
+        if matches is None:
+            matches = any(fnmatch.fnmatchcase(state, pattern)
+                          for pattern in self.states)
+            self._state_cache[state] = matches
+        return matches
+
+    def __call__(self, tup, state):
+        if self.states is not None and not self._state_matches(state):
+            return False
+        for field, port in self.ports:
+            if tup[field] != port:
+                return False
+        for field, first, last in self.ranges:
+            if not first <= _address(tup[field]) <= last:
+                return False
+        return True
+
+
+class Listing(object):
+    """An open listing: an iterator over the frozen table, and a filter."""
+
+    def __init__(self, listings, number, flow_filter):
+        self.listings = listings
+        self.number = number
+        self.flow_filter = flow_filter
+        self.entries = iter(listings.tracker.connections.items())
+        self.used = time.monotonic()
+
+    def close(self):
+        self.listings.close(self)
+
+
+class Listings(object):
+    """The open listings of a tracker, by cursor."""
+
+    def __init__(self, tracker):
+        self.tracker = tracker
+        self.open = {}
+        self._last = 0
+        tracker.add_timer(self.expire, self.timeout)
+
+    def start(self, flow_filter):
+        """Freeze the table and open a listing over it."""
+        self._last += 1
+        self.tracker.freeze()
+        listing = Listing(self, self._last, flow_filter)
+        self.open[listing.number] = listing
+        return listing
+
+    def resume(self, cursor):
+        listing = self.open.get(int(cursor))
+        if listing is None:
+            raise ValueError('Unknown or expired cursor %s' % cursor)
+        return listing
+
+    def close(self, listing):
+        if self.open.pop(listing.number, None) is not None:
+            self.tracker.thaw()
+
+    def expire(self):
+        """Drop the listings idle for IDLE_TIMEOUT seconds."""
+        limit = time.monotonic() - IDLE_TIMEOUT
+        for listing in list(self.open.values()):
+            if listing.used <= limit:
+                self.close(listing)
+
+    def timeout(self):
+        if not self.open:
+            return None
+        oldest = min(listing.used for listing in self.open.values())
+        return max(0.0, oldest + IDLE_TIMEOUT - time.monotonic())
+
+
+def scan(listing, limit=1000, budget=2000, chunk=200):
+    """Yield chunks of the connections of a listing matching its filter.
+
+    Each step looks at no more than budget entries, skipped ones included,
+    and yields a chunk {"flows": [[remote_ip, remote_port, local_ip,
+    local_port, state], ...], "cursor": cursor} when it has chunk matches,
+    or None to let the caller do other work.  The listing is closed once
+    the table was scanned, or when the generator is dropped mid-page.
+
+    """
+    flow_filter = listing.flow_filter
+    found = []
+    returned = 0
+    while True:
+        listing.used = time.monotonic()
+        scanned = 0
+        for tup, state in itertools.islice(listing.entries, budget):
+            scanned += 1
+            if state != 'CLOSED' and flow_filter(tup, state):
+                found.append(list(tup) + [state])
+                if returned + len(found) >= limit:
+                    break
+        done = scanned < budget and returned + len(found) < limit
+        if done:
+            listing.close()
+        if found and (len(found) >= chunk or done or
+                      returned + len(found) >= limit):
+            returned += len(found)
+            result = {'flows': found, 'cursor': listing.number}
+            found = []
+            if done:
+                result['done'] = True
+        elif done:
+            result = {'flows': [], 'cursor': listing.number, 'done': True}
+        else:
+            result = None
+        try:
+            yield result
+        except GeneratorExit:
+            # The client went away in the middle of a page.
+            listing.close()
+            raise
+        if done or returned >= limit:
+            return
+
+
+def register(tracker):
+    """Add the 'flows' command, listing the table of a tracker."""
+    listings = Listings(tracker)
+
+    def flows(cursor=0, limit=1000, budget=2000, **filters):
+        if cursor:
+            listing = listings.resume(cursor)
+        else:
+            listing = listings.start(FlowFilter(**filters))
+        return scan(listing, int(limit), int(budget))
+
+    control.register_command('flows', flows)
@@ -0,0 +1,187 @@
+"""Sampled per-packet latency tracing, aggregated into histograms.
+
+One packet in `sample_rate` is traced: the time it spends in each stage of
+its path through the process is recorded, in nanoseconds, into a histogram
+per stage.  Packets that are not sampled cost one counter decrement, and
+nothing at all when tracing is off (sample_rate 0, the default).
+
+The histograms are log-bucketed, like HdrHistogram: every power of two is
+split into 32 linear sub-buckets, so any recorded value is known within about
+3%, whatever its magnitude, in a few hundred buckets at most.
+
+Each process has its own tracer (the module level `tracer`), exported and
+reset with the 'latency' control command:
+
+    python control.py /run/defnd/defnd.sock latency
+    python control.py /run/defnd/defnd.sock latency action=reset
+
+"""
+import time
+
+import control
+
+_SUB_BITS = 5
+_SUB = 1 << _SUB_BITS
+
+# The Trace of the packet being handled by this process, if it is sampled.
+# Lets code deep in the path (TCPStateRule) time itself without being passed
+# the trace.
+active = None
+
+
+def _bucket(value):
+    """Return the index of the bucket holding a value."""
+    if value < 2 * _SUB:
+        return value
+    shift = value.bit_length() - _SUB_BITS - 1
+    return (shift + 1) * _SUB + (value >> shift) - _SUB
+
+
+def _bucket_range(index):
+    """Return the (lowest, highest) values held by a bucket."""
+    if index < 2 * _SUB:
+        return index, index
+    shift = index // _SUB - 1
+    mantissa = index % _SUB + _SUB
+    return mantissa << shift, ((mantissa + 1) << shift) - 1
+
+
+class Histogram(object):
+    """A log-bucketed histogram of non-negative integers."""
+
+    def __init__(self):
+        self.counts = {}
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def record(self, value):
+        """Add a value."""
+        value = max(int(value), 0)
+        index = _bucket(value)
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, percent):
+        """Return the value below which `percent` percent of the values are,
+        or None when empty."""
+        if not self.count:
+            return None
+        rank = percent / 100.0 * self.count
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                return min(_bucket_range(index)[1], self.max)
+        return self.max
+
+    def export(self, buckets=False):
+        """Return a JSON-able summary, with the non-empty buckets as
+        [lowest, highest, count] if requested."""
+        summary = {'count': self.count, 'min': self.min, 'max': self.max,
+                   'mean': self.total // self.count if self.count else None}
+        for percent in (50, 90, 99, 99.9):
+            summary['p%s' % percent] = self.percentile(percent)
+        if buckets:
+            summary['buckets'] = [list(_bucket_range(index)) + [count]
+                                  for index, count in
+                                  sorted(self.counts.items())]
+        return summary
+
+
+class Trace(object):
+    """The stage timestamps of one sampled packet."""
+
+    __slots__ = ('tracer', 'start', 'last')
+
+    def __init__(self, tracer):
+        self.tracer = tracer
+        self.start = self.last = time.perf_counter_ns()
+
+    def mark(self, stage):
+        """Record the time since the previous mark as `stage`."""
+        now = time.perf_counter_ns()
+        self.tracer.record(stage, now - self.last)
+        self.last = now
+
+    def delivery(self, packet):
+        """Record how long ago the kernel queued a packet, from its
+        timestamp (seconds since the epoch, 0 when unknown)."""
+        timestamp = packet.get_timestamp()
+        if timestamp:
+            self.tracer.record('delivery', (time.time() - timestamp) * 1e9)
+
+    def finish(self):
+        """Record the time since the trace started as 'total'."""
+        self.tracer.record('total', time.perf_counter_ns() - self.start)
+
+
+class Tracer(object):
+    """Samples one packet in sample_rate, and holds a histogram per stage."""
+
+    def __init__(self, sample_rate=0):
+        self.histograms = {}
+        self.configure(sample_rate)
+
+    def configure(self, sample_rate):
+        """Trace one packet in sample_rate, or none when 0."""
+        self.sample_rate = int(sample_rate)
+        self._countdown = self.sample_rate
+
+    def sample(self):
+        """Return True for one call in sample_rate."""
+        if not self.sample_rate:
+            return False
+        self._countdown -= 1
+        if self._countdown:
+            return False
+        self._countdown = self.sample_rate
+        return True
+
+    def start(self):
+        """Return a Trace if this packet is sampled, else None."""
+        if self.sample():
+            return Trace(self)
+        return None
+
+    def record(self, stage, nanoseconds):
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            histogram = self.histograms[stage] = Histogram()
+        histogram.record(nanoseconds)
+
+    def export(self, buckets=False):
+        return {'sample_rate': self.sample_rate, 'unit': 'ns',
+                'stages': dict((stage, histogram.export(buckets))
+                               for stage, histogram in
+                               self.histograms.items())}
+
+    def reset(self):
+        self.histograms = {}
+
+
+tracer = Tracer()
+
+
+def configure(sample_rate):
+    """Set the sample rate of this process's tracer."""
+    tracer.configure(sample_rate)
+
+
+def _command(action='show', buckets=False):
+    """The 'latency' control command: show or reset the histograms."""
+    if action == 'show':
+        return tracer.export(buckets)
+    elif action == 'reset':
+        tracer.reset()
+        return {'reset': True}
+    raise ValueError('Unknown latency action "%s"' % action)
+
+
+control.register_command('latency', _command)
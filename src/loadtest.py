@@ -0,0 +1,296 @@
+"""End-to-end throughput harness for the full DefNd process topology.
+
+Runs main.main (connection tracker, logger, ingress and egress workers) on the
+'local' queue backend, injects synthetic or pcap packets into the ingress and
+egress queues and collects every verdict.  Reports packets per second and
+verdict latency percentiles, measured from injection to verdict.
+
+    python loadtest.py examples/connection_Tracker.json --flows 2000
+    python loadtest.py examples/port_blocking.json --pcap traffic.pcap
+
+The harness forks the topology, so it only works with the 'fork' start
+method (the default on Linux).
+
+"""
+from __future__ import print_function
+import argparse
+import multiprocessing as mp
+import os
+import queue
+import random
+import signal
+import socket
+import struct
+import time
+
+import main
+import pcap
+import queue_backend
+
+INGRESS_QUEUE = 1
+EGRESS_QUEUE = 2
+
+_FIN, _SYN, _PSH, _ACK = 0x01, 0x02, 0x08, 0x10
+
+
+def build_ip_packet(src_ip, dst_ip, protocol, src_port=0, dst_port=0,
+                    flags=0, body=b''):
+    """Build a raw IPv4 packet with a TCP or UDP payload."""
+    if protocol == socket.IPPROTO_TCP:
+        transport = struct.pack('!HHIIHHHH', src_port, dst_port, 0, 0,
+                                (5 << 12) | flags, 65535, 0, 0) + body
+    elif protocol == socket.IPPROTO_UDP:
+        transport = struct.pack('!HHHH', src_port, dst_port, 8 + len(body),
+                                0) + body
+    else:
+        transport = body
+    return struct.pack('!BBHHHBBH4s4s', 0x45, 0, 20 + len(transport), 0, 0,
+                       64, protocol, 0, socket.inet_aton(src_ip),
+                       socket.inet_aton(dst_ip)) + transport
+
+
+def synthetic_traffic(flows, local_ip='192.168.0.1', udp_fraction=0.2,
+                      seed=0):
+    """Yield (queue_num, packet) for complete TCP conversations and UDP.
+
+    Each TCP flow is a remote client connecting to a local service: a
+    handshake, a request and response, and a close.  Flows are interleaved.
+
+    """
+    rng = random.Random(seed)
+    conversations = []
+    for i in range(flows):
+        remote_ip = '10.%d.%d.%d' % (rng.randint(0, 255), rng.randint(0, 255),
+                                     rng.randint(1, 254))
+        remote_port = rng.randint(1024, 65535)
+        if rng.random() < udp_fraction:
+            conversations.append(iter([
+                (INGRESS_QUEUE, build_ip_packet(
+                    remote_ip, local_ip, socket.IPPROTO_UDP, remote_port, 53,
+                    body=b'q' * 32)),
+                (EGRESS_QUEUE, build_ip_packet(
+                    local_ip, remote_ip, socket.IPPROTO_UDP, 53, remote_port,
+                    body=b'a' * 64))]))
+            continue
+        local_port = rng.choice([22, 80, 443, 8080])
+        inbound = lambda flags, body=b'': (INGRESS_QUEUE, build_ip_packet(
+            remote_ip, local_ip, socket.IPPROTO_TCP, remote_port, local_port,
+            flags, body))
+        outbound = lambda flags, body=b'': (EGRESS_QUEUE, build_ip_packet(
+            local_ip, remote_ip, socket.IPPROTO_TCP, local_port, remote_port,
+            flags, body))
+        conversations.append(iter([
+            inbound(_SYN), outbound(_SYN | _ACK), inbound(_ACK),
+            inbound(_PSH | _ACK, b'GET / HTTP/1.0\r\n\r\n'),
+            outbound(_PSH | _ACK, b'HTTP/1.0 200 OK\r\n\r\n'),
+            outbound(_FIN | _ACK), inbound(_ACK), inbound(_FIN | _ACK),
+            outbound(_ACK)]))
+    while conversations:
+        index = rng.randrange(len(conversations))
+        try:
+            yield next(conversations[index])
+        except StopIteration:
+            conversations[index] = conversations[-1]
+            conversations.pop()
+
+
+def syn_flood(count, local_ip='192.168.0.1', sources=None, seed=1):
+    """Yield (queue_num, packet) for SYNs to local port 80, from `sources`
+    random addresses (a new spoofed address per SYN by default)."""
+    rng = random.Random(seed)
+    pool = None
+    if sources:
+        pool = ['172.%d.%d.%d' % (rng.randint(16, 31), rng.randint(0, 255),
+                                  rng.randint(1, 254)) for _ in range(sources)]
+    for _ in range(count):
+        if pool:
+            remote_ip = rng.choice(pool)
+        else:
+            remote_ip = '172.%d.%d.%d' % (rng.randint(16, 31),
+                                          rng.randint(0, 255),
+                                          rng.randint(1, 254))
+        yield INGRESS_QUEUE, build_ip_packet(
+            remote_ip, local_ip, socket.IPPROTO_TCP,
+            rng.randint(1024, 65535), 80, _SYN)
+
+
+def interleave(streams, seed=2):
+    """Yield from several traffic generators, picking one at random each
+    time."""
+    rng = random.Random(seed)
+    streams = [iter(stream) for stream in streams]
+    while streams:
+        index = rng.randrange(len(streams))
+        try:
+            yield next(streams[index])
+        except StopIteration:
+            streams.pop(index)
+
+
+def pcap_traffic(filename):
+    """Yield (queue_num, packet) for every packet of a capture, as ingress."""
+    for _, buf in pcap.read_pcap(filename):
+        yield INGRESS_QUEUE, buf
+
+
+def percentile(sorted_values, fraction):
+    """Return a percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(fraction * len(sorted_values)))
+    return sorted_values[index]
+
+
+def _run_topology(conf, loglevel, kwargs):
+    """Target of the topology process: main.main in its own process group."""
+    os.setpgrp()
+    main.main(conf, loglevel, None, **kwargs)
+
+
+class LoadTest(object):
+    """Runs the process topology on local channels and measures it."""
+
+    def __init__(self, conf, window=256, loglevel='WARNING', **kwargs):
+        self.conf = conf
+        self.window = window
+        self.loglevel = loglevel
+        self.kwargs = kwargs
+        self.kwargs['backend'] = 'local'
+        self.verdicts = mp.Queue()
+        self.channels = {
+            INGRESS_QUEUE: queue_backend.create_channel(INGRESS_QUEUE,
+                                                        self.verdicts),
+            EGRESS_QUEUE: queue_backend.create_channel(EGRESS_QUEUE,
+                                                       self.verdicts),
+        }
+        self.process = None
+
+    def start(self, timeout=30.0):
+        """Fork the topology and wait until both workers give verdicts."""
+        self.process = mp.Process(target=_run_topology,
+                                  args=(self.conf, self.loglevel,
+                                        self.kwargs))
+        self.process.start()
+        probe = build_ip_packet('127.0.0.1', '127.0.0.1', socket.IPPROTO_UDP,
+                                9, 9)
+        for queue_num, channel in self.channels.items():
+            channel.inject(-1, probe)
+        pending = set(self.channels)
+        deadline = time.time() + timeout
+        while pending:
+            queue_num = self.verdicts.get(timeout=deadline - time.time())[0]
+            pending.discard(queue_num)
+
+    def stop(self):
+        """Close the channels and stop every process of the topology."""
+        for channel in self.channels.values():
+            channel.close()
+        time.sleep(0.5)
+        try:
+            os.killpg(self.process.pid, signal.SIGTERM)
+        except OSError:
+            pass
+        self.process.join(5)
+
+    def run(self, traffic):
+        """Inject traffic, keeping at most `window` packets in flight.
+
+        Returns a dict of results.
+
+        """
+        latencies = {INGRESS_QUEUE: [], EGRESS_QUEUE: []}
+        counts = {}
+        in_flight = 0
+        injected = 0
+        start = time.perf_counter()
+
+        def collect(block):
+            queue_num, _, verdict, inject_time, verdict_time = \
+                self.verdicts.get(timeout=30) if block else \
+                self.verdicts.get_nowait()
+            latencies[queue_num].append(verdict_time - inject_time)
+            counts[verdict] = counts.get(verdict, 0) + 1
+
+        for queue_num, packet in traffic:
+            while in_flight >= self.window:
+                collect(True)
+                in_flight -= 1
+            self.channels[queue_num].inject(injected, packet)
+            injected += 1
+            in_flight += 1
+            try:
+                while True:
+                    collect(False)
+                    in_flight -= 1
+            except queue.Empty:
+                pass
+        while in_flight:
+            collect(True)
+            in_flight -= 1
+        elapsed = time.perf_counter() - start
+
+        results = {'packets': injected, 'seconds': elapsed,
+                   'pps': injected / elapsed if elapsed else 0.0,
+                   'verdicts': counts}
+        for queue_num, name in ((INGRESS_QUEUE, 'ingress'),
+                                (EGRESS_QUEUE, 'egress')):
+            values = sorted(latencies[queue_num])
+            results[name] = dict(
+                ('p%g' % (fraction * 100), percentile(values, fraction) * 1e6)
+                for fraction in (0.5, 0.9, 0.99, 0.999))
+            results[name]['count'] = len(values)
+        return results
+
+
+def format_results(results):
+    """Return a human readable summary of LoadTest.run results."""
+    lines = ['%d packets in %.2fs: %.0f packets/s' %
+             (results['packets'], results['seconds'], results['pps']),
+             'verdicts: %s' % ', '.join('%s=%d' % item for item in
+                                        sorted(results['verdicts'].items()))]
+    for name in ('ingress', 'egress'):
+        latency = results[name]
+        lines.append('%-8s %7d packets, latency us: p50=%.0f p90=%.0f'
+                     ' p99=%.0f p99.9=%.0f' %
+                     (name, latency['count'], latency['p50'], latency['p90'],
+                      latency['p99'], latency['p99.9']))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Measure DefNd throughput on the local queue backend')
+    parser.add_argument('config', help='JSON configuration file')
+    parser.add_argument('--pcap', default=None,
+                        help='replay a capture instead of synthetic flows')
+    parser.add_argument('--flows', type=int, default=1000,
+                        help='number of synthetic flows')
+    parser.add_argument('--window', type=int, default=256,
+                        help='maximum packets in flight')
+    parser.add_argument('-l', '--log-level', default='WARNING',
+                        help='log level of the topology')
+    parser.add_argument('-s', '--tracker-shards', type=int, default=1,
+                        help='number of connection tracker processes')
+    parser.add_argument('--syn-flood', type=int, default=0, metavar='N',
+                        help='mix N spoofed SYNs into the traffic')
+    parser.add_argument('--replicate-to', default=None, metavar='HOST:PORT',
+                        help='replicate the tracker state to a standby')
+    parser.add_argument('--shadow-config', default=None, metavar='FILE',
+                        help='shadow a candidate configuration')
+    args = parser.parse_args()
+
+    test = LoadTest(args.config, window=args.window, loglevel=args.log_level,
+                    tracker_shards=args.tracker_shards,
+                    replicate_to=args.replicate_to,
+                    shadow_config=args.shadow_config)
+    if args.pcap:
+        traffic = pcap_traffic(args.pcap)
+    else:
+        traffic = synthetic_traffic(args.flows)
+    if args.syn_flood:
+        traffic = interleave([traffic, syn_flood(args.syn_flood)])
+    test.start()
+    try:
+        print(format_results(test.run(traffic)))
+    finally:
+        test.stop()
@@ -7,6 +7,8 @@ import time
 from logging import StreamHandler, FileHandler
 from logutils.queue import QueueHandler, QueueListener
 
+import diagnostics
+
 def initialize_logging(level, queue):
     """Setup logging for a process.
 
@@ -17,7 +19,7 @@ def initialize_logging(level, queue):
     """
     formatter = _get_formatter()
 
-    logger = logging.getLogger('pywall')
+    logger = logging.getLogger('defnd')
     if not logger.handlers:  # Check if handler already exists
         logger.setLevel(level)
 
@@ -25,6 +27,7 @@ def initialize_logging(level, queue):
         handler.setFormatter(formatter)
 
         logger.addHandler(handler)
+        diagnostics.register_subsystem('log.queue', queue)
 
 def _get_formatter():
     #creates a formatter with a specified format for log message
@@ -54,8 +57,11 @@ def log_server(level, queue, filename=None, mode='w'):
     listener = QueueListener(queue, *handlers)
     listener.start()
 
+    # The listener handles the records from its thread; stop() handles
+    # those still queued, then ends it.
     try:
-        listener.join()  # Wait for the listener to terminate
+        while True:
+            time.sleep(60)
     except KeyboardInterrupt:
         pass
     finally:
@@ -1,35 +1,93 @@
 from __future__ import print_function
+# First: the startup of the main program is timed from here.
+import startup
 import multiprocessing as mp
 import logging
 import argparse
+import sys
 
 import config
+import control
+import flows
+import latency
+import profiler
+import replication
+import shadow
 import tcp_egress
 import connection
+import sharding
+import synflood
 from logger import initialize_logging, log_server
 
 
 def run_defnd(conf, packet_queue, query_pipe, kwargs):
     # Utility function to run Defnd.  (target function for the Process)
     # Get logging information from the kwargs, so we can setup logging.
+    startup.begin('defnd')
     logqueue = kwargs.pop('logqueue', mp.Queue())
     loglevel = kwargs.pop('loglevel', logging.INFO)
     initialize_logging(loglevel, logqueue)
 
+    profile = kwargs.pop('profile', None)
+    shadow_tap = kwargs.pop('shadow', None)
+    control.start_server(kwargs.pop('control_dir', None), 'defnd')
+    latency.configure(kwargs.pop('latency_sample', 0))
+
+    startup.mark('setup')
     cfg = config.defndConfig(conf)
-    the_wall = cfg.create_defnd(packet_queue, query_pipe)
-    the_wall.erect(**kwargs)
+    the_wall = cfg.create_defnd(packet_queue, query_pipe,
+                                kwargs.pop('attack_flag', None))
+    if profile:
+        the_wall.profiler = profiler.ChainProfiler(profile)
+    if shadow_tap is not None:
+        the_wall.shadow = shadow.ShadowTap(*shadow_tap)
+    the_wall.erect(queue=cfg.queue_settings(), **kwargs)
 
 
-def run_egress(packet_queue, loglevel, logqueue):
+def run_egress(packet_queue, loglevel, logqueue, backend='nfqueue',
+               control_dir=None, latency_sample=0, queue=None,
+               accounting_spec=None):
     """Utility function to run the egress function. (target of Process)
 
     Given the queue to report TCP connections, as well as logging variables,
     run the egress monitor.
 
     """
+    startup.begin('egress')
+    initialize_logging(loglevel, logqueue)
+    control.start_server(control_dir, 'egress')
+    latency.configure(latency_sample)
+    ct = tcp_egress.DefNdEgress(packet_queue, backend=backend, queue=queue,
+                                accounting_spec=accounting_spec)
+    ct.run()
+
+
+def run_tracker(ingress_queue, egress_queue, query_pipe, loglevel, logqueue,
+                shard=0, control_dir=None, latency_sample=0,
+                protection=None, attack_flag=None, replicate=None,
+                shadow_pipe=None):
+    """Utility function to run a connection tracker shard. (target of Process)
+
+    Shard 0 is run directly by main, on the master process.  replicate
+    holds the arguments of replication.attach, if any, and shadow_pipe is
+    the query pipe of the shadow process, if any.
+
+    """
+    # Shard 0 is timed as part of the main program.
+    if shard:
+        startup.begin('tracker-%d' % shard)
     initialize_logging(loglevel, logqueue)
-    ct = tcp_egress.DefNdEgress(packet_queue)
+    latency.configure(latency_sample)
+    ct = connection.DefndTracker(ingress_queue, egress_queue, query_pipe,
+                                 protection, attack_flag)
+    server = control.start_server(control_dir, 'tracker-%d' % shard,
+                                  in_thread=False)
+    if server:
+        server.attach(ct)
+        flows.register(ct)
+    if shadow_pipe is not None:
+        ct.add_query_pipe(shadow_pipe)
+    replication.attach(ct, shard=shard, **(replicate or {}))
     ct.run()
 
 
@@ -39,21 +97,76 @@ def main(conf, loglevel, filename, **kwargs):
     Runs a Defnd given a configuration file, a loglevel, and a filename.  This
     spawns three processes (log_process, egress_process, and defnd_process).
     It then runs the connection tracker on thes process (the "master process").
+    The 'backend' keyword selects the packet queue backend of both workers.
+
+    With 'tracker_shards' greater than one, the connection tracker is split
+    into that many shards (see sharding), each with its own queues and pipe.
+    Shard 0 runs on the master process and the rest in their own processes.
+
+    'latency_sample' traces one packet in that many in every process (see
+    latency).  'replicate_to' and 'replicate_listen' make the trackers send
+    their state to a standby, or receive it from the host 'replicate_from'
+    (see replication).
+    'shadow_config' evaluates one ingress packet in 'shadow_sample' with
+    the chains of a candidate configuration too, in another process (see
+    shadow).
 
     """
-    # Create multiprocessing queues for IPC.
-    egress_queue = mp.Queue()
-    ingress_queue = mp.Queue()
+    startup.mark('imports')
+    shards = kwargs.pop('tracker_shards', 1)
+    control_dir = kwargs.get('control_dir', None)
+    latency_sample = kwargs.get('latency_sample', 0)
+    replicate = {'replicate_to': kwargs.pop('replicate_to', None),
+                 'replicate_listen': kwargs.pop('replicate_listen', None),
+                 'replicate_from': kwargs.pop('replicate_from', None)}
+    shadow_config = kwargs.pop('shadow_config', None)
+    shadow_sample = kwargs.pop('shadow_sample', 100)
+    cfg = config.defndConfig(conf)
+    protection = cfg.syn_protection()
+    startup.mark('config')
+    if protection is not None:
+        kwargs['attack_flag'] = synflood.attack_flag()
+        # The caps are for the whole tracker.
+        protection = synflood.per_shard(protection, shards)
+    attack_flag = kwargs.get('attack_flag')
+
+    # Create multiprocessing queues for IPC, one set per tracker shard.
+    egress_queues = [mp.Queue() for _ in range(shards)]
+    ingress_queues = [mp.Queue() for _ in range(shards)]
     log_queue = mp.Queue()
-    query_defnd, query_connection = mp.Pipe()
+    pipes = [mp.Pipe() for _ in range(shards)]
     kwargs['loglevel'] = loglevel
     kwargs['logqueue'] = log_queue
 
-    # Start logging for the connection tracker.
-    initialize_logging(loglevel, log_queue)
+    if shards == 1:
+        egress_queue, ingress_queue = egress_queues[0], ingress_queues[0]
+        query_defnd = pipes[0][0]
+    else:
+        egress_queue = sharding.ShardedQueue(egress_queues)
+        ingress_queue = sharding.ShardedQueue(ingress_queues)
+        query_defnd = sharding.ShardedPipe([pipe[0] for pipe in pipes])
 
-    # Initialize the connection tracker with the IPC channels.
-    ct = connection.DefndTracker(ingress_queue, egress_queue, query_connection)
+    # The shadow process has its own query pipes, and a bounded queue of
+    # samples from the Defnd process.
+    shadow_pipes = [(None, None)] * shards
+    if shadow_config:
+        shadow_pipes = [mp.Pipe() for _ in range(shards)]
+        sample_queue = mp.Queue(shadow.QUEUE_SIZE)
+        kwargs['shadow'] = (sample_queue, shadow_sample)
+        if shards == 1:
+            query_shadow = shadow_pipes[0][0]
+        else:
+            query_shadow = sharding.ShardedPipe([pipe[0] for pipe in
+                                                 shadow_pipes])
+
+    # Create and start the other tracker shards.
+    for shard in range(1, shards):
+        mp.Process(target=run_tracker,
+                   args=(ingress_queues[shard], egress_queues[shard],
+                         pipes[shard][1], loglevel, log_queue, shard,
+                         control_dir, latency_sample, protection,
+                         attack_flag, replicate,
+                         shadow_pipes[shard][1])).start()
 
     # Create and start log_process.
     log_process = mp.Process(target=log_server, args=(loglevel, log_queue,
@@ -62,15 +175,29 @@ def main(conf, loglevel, filename, **kwargs):
 
     # Create and start egress_process.
     egress_process = mp.Process(target=run_egress, args=(egress_queue,
-                                                         loglevel, log_queue))
+                                                         loglevel, log_queue,
+                                                         kwargs.get('backend', 'nfqueue'),
+                                                         control_dir,
+                                                         latency_sample,
+                                                         cfg.queue_settings(),
+                                                         cfg.config.get('accounting')))
     egress_process.start()
 
+    # Create and start the shadow process.
+    if shadow_config:
+        mp.Process(target=shadow.run_shadow,
+                   args=(shadow_config, sample_queue, query_shadow, loglevel,
+                         log_queue, control_dir)).start()
+
     # Create and start Defnd process.
-    defnd_process = mp.Process(target=run_defnd, args=(conf, ingress_queue, query_defnd l, kwargs))
+    defnd_process = mp.Process(target=run_defnd, args=(conf, ingress_queue, query_defnd, kwargs))
     defnd_process.start()
 
     # Run the connection tracker on the "master process."
-    ct.run()
+    startup.mark('workers')
+    run_tracker(ingress_queues[0], egress_queues[0], pipes[0][1], loglevel,
+                log_queue, 0, control_dir, latency_sample, protection,
+                attack_flag, replicate, shadow_pipes[0][1])
 
 
 if __name__ == '__main__':
@@ -82,6 +209,48 @@ if __name__ == '__main__':
                                                       'CRITICAL'],
                         help='set verbosity of logging', default='INFO')
     parser.add_argument('-f', '--log-file', help='set log file', default=None)
+    parser.add_argument('-p', '--profile', default=None,
+                        help='profile the chains, writing a report to this'
+                        ' file on exit')
+    parser.add_argument('-s', '--tracker-shards', type=int, default=1,
+                        help='number of connection tracker processes')
+    parser.add_argument('-c', '--control-dir', default=None,
+                        help='directory for the control sockets of each'
+                        ' process (off by default)')
+    parser.add_argument('--latency-sample', type=int, default=0,
+                        metavar='N', help='trace the stage latencies of one'
+                        ' packet in N (off by default)')
+    parser.add_argument('--replicate-to', default=None, metavar='HOST:PORT',
+                        help='send the tracker state to a standby')
+    parser.add_argument('--replicate-listen', default=None,
+                        metavar='HOST:PORT',
+                        help='receive the tracker state of an active DefNd')
+    parser.add_argument('--replicate-from', default=None, metavar='HOST',
+                        help='the active DefNd, the only host accepted with'
+                        ' --replicate-listen (loopback only by default)')
+    parser.add_argument('--shadow-config', default=None, metavar='FILE',
+                        help='evaluate sampled packets with the chains of'
+                        ' this candidate configuration too, and compare')
+    parser.add_argument('--shadow-sample', type=int, default=100,
+                        metavar='N', help='shadow one packet in N'
+                        ' (default 100)')
+    parser.add_argument('--compile-config', action='store_true',
+                        help='build the rules of the configuration, write'
+                        ' them to CONFIG%s for faster starts, and exit'
+                        % config.COMPILED_SUFFIX)
     args = parser.parse_args()
-    main(args.config, args.log_level, args.log_file)
+    if args.compile_config:
+        cfg = config.defndConfig(args.config)
+        cached, total = cfg.compile()
+        print('Wrote %s: %d of %d rules prebuilt' %
+              (cfg.compiled_filename, cached, total))
+        sys.exit(0)
+    main(args.config, args.log_level, args.log_file, profile=args.profile,
+         tracker_shards=args.tracker_shards, control_dir=args.control_dir,
+         latency_sample=args.latency_sample,
+         replicate_to=args.replicate_to,
+         replicate_listen=args.replicate_listen,
+         replicate_from=args.replicate_from,
+         shadow_config=args.shadow_config,
+         shadow_sample=args.shadow_sample)
     
\ No newline at end of file
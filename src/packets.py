@@ -162,9 +162,16 @@ class Packet(object):
 
 class TransportLayerPacket(Packet):
     #Base class packets at the transport layer.
-    @abstractmethod
+    def get_body_view(self):
+        #Return the payload as a memoryview of the packet buffer, without
+        #copying it.  Made on first use, since most rules never look.
+        if self._body is None:
+            self._body = memoryview(self.buf)[self.get_header_len():]
+        return self._body
+
     def get_body(self):
-        pass
+        #Return a copy of the payload, as bytes.
+        return bytes(self.get_body_view())
 
 class IPPacket(Packet):
     # Base class for all packets.
@@ -175,7 +182,9 @@ class IPPacket(Packet):
         self._dst_ip = socket.inet_ntoa(buf[16:20])
         self._ihl = (unpack('!B', buf[0:1])[0] & 0xF) * 4
         self._proto = unpack('!B', buf[9:10])[0]
-        self._payload = payload_builder(buf[self._ihl:], self._proto)
+        # A view: the transport layer shares the buffer instead of copying.
+        self._payload = payload_builder(memoryview(buf)[self._ihl:],
+                                        self._proto)
 
     def get_src_ip(self):
         return self._src_ip
@@ -201,14 +210,17 @@ class IPPacket(Packet):
 class TCPPacket(TransportLayerPacket):
     #TCP Packet Object
     def __init__(self, buff):
+        self.buf = buff
+        self._body = None
         self._parse_header(buff)
 
     def _parse_header(self, buff):
         header_fields = unpack('!HHIIHHHH', buff[:20])
         self._src_port, self._dst_port, self._seq_num, self._ack_num, flags, self._win_size, self._checksum, self._urg_ptr = header_fields
+        self._data_offset = flags >> 12
         #parse Flags
         self.flag_ns = bool(flags & 0x0100)
-        self.flag.cwr = bool(flags & 0x0080)
+        self.flag_cwr = bool(flags & 0x0080)
         self.flag_ece = bool(flags & 0x0040)
         self.flag_urg = bool(flags & 0x0020)
         self.flag_ack = bool(flags & 0x0010)
@@ -219,7 +231,6 @@ class TCPPacket(TransportLayerPacket):
         # can be parsed later if we care:
         #self._options = buff[20:(self._data_offset * 4)]
         #self._total_length = len(buff)
-        #self._body = buff[self.get_header_len():]
 
     def get_header_len(self):
         return self._data_offset * 4
@@ -233,17 +244,16 @@ class TCPPacket(TransportLayerPacket):
     def get_dst_port(self):
         return self._dst_port
     
-    def get_body(self):
-        return str(self._body)
-    
-    def __unicode__(self):
+    def __str__(self):
         #Returns a printable version of the TCP header
-        return u'TCP from %d to %d' % (self._src_port, self._dst_port)
+        return 'TCP from %d to %d' % (self._src_port, self._dst_port)
 
 class UDPPacket(TransportLayerPacket):
     #UDP Packet Object
 
     def __init__(self, buff):
+        self.buf = buff
+        self._body = None
         self._parse_header(buff)
 
     def _parse_header(self, buff):
@@ -263,12 +273,9 @@ class UDPPacket(TransportLayerPacket):
     def get_dst_port(self):
         return self._dst_port
 
-    def get_body(self):
-        return str(self._body)
-    
-    def __unicode__(self):
+    def __str__(self):
         #Returns a Printable Version Of UDP Header
-        return u'UDP from %d to %d' % (self._src_port, self._dst_port)
+        return 'UDP from %d to %d' % (self._src_port, self._dst_port)
 
 def payload_builder(payload_buff, protocol):
     #If `protocol` is supported, builds packet object from buff
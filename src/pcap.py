@@ -0,0 +1,99 @@
+"""Reading and writing of classic libpcap capture files.
+
+Only IPv4 packets are returned, since that is all DefNd filters.  Ethernet,
+Linux "cooked" and raw IP link types are understood.
+
+"""
+import os
+import struct
+import tempfile
+
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_IPV4 = 228
+
+_MAGIC_US = 0xa1b2c3d4
+_MAGIC_NS = 0xa1b23c4d
+_ETHERTYPE_IPV4 = 0x0800
+_ETHERTYPE_VLAN = 0x8100
+
+
+def _strip_link_header(linktype, frame):
+    """Return the IPv4 datagram inside a link layer frame, or None."""
+    if linktype in (LINKTYPE_RAW, LINKTYPE_IPV4):
+        ip = frame
+    elif linktype == LINKTYPE_ETHERNET:
+        offset = 12
+        ethertype = struct.unpack('!H', frame[offset:offset + 2])[0]
+        while ethertype == _ETHERTYPE_VLAN:
+            offset += 4
+            ethertype = struct.unpack('!H', frame[offset:offset + 2])[0]
+        if ethertype != _ETHERTYPE_IPV4:
+            return None
+        ip = frame[offset + 2:]
+    elif linktype == LINKTYPE_LINUX_SLL:
+        if struct.unpack('!H', frame[14:16])[0] != _ETHERTYPE_IPV4:
+            return None
+        ip = frame[16:]
+    else:
+        raise ValueError('Unsupported pcap link type %d' % linktype)
+    if len(ip) < 20 or ip[0] >> 4 != 4:
+        return None
+    return ip
+
+
+def read_pcap(filename):
+    """Yield (timestamp, ip_bytes) for every IPv4 packet in a pcap file."""
+    with open(filename, 'rb') as pcap_file:
+        header = pcap_file.read(24)
+        if len(header) < 24:
+            raise ValueError('%s: truncated pcap header' % filename)
+        for endian in ('<', '>'):
+            magic = struct.unpack(endian + 'I', header[:4])[0]
+            if magic in (_MAGIC_US, _MAGIC_NS):
+                break
+        else:
+            raise ValueError('%s: not a pcap file' % filename)
+        divisor = 1e9 if magic == _MAGIC_NS else 1e6
+        linktype = struct.unpack(endian + 'I', header[20:24])[0]
+        record = struct.Struct(endian + 'IIII')
+
+        while True:
+            record_header = pcap_file.read(record.size)
+            if len(record_header) < record.size:
+                return
+            sec, frac, incl_len, _ = record.unpack(record_header)
+            frame = pcap_file.read(incl_len)
+            if len(frame) < incl_len:
+                return
+            ip = _strip_link_header(linktype, frame)
+            if ip is not None:
+                yield sec + frac / divisor, ip
+
+
+def write_pcap(filename, records, linktype=LINKTYPE_RAW, snaplen=65535):
+    """Write (timestamp, orig_len, data) records to a pcap file.
+
+    The file is written to a temporary file of its own next to its
+    destination and renamed into place, so a reader never sees a partial
+    capture and concurrent writers never share a temporary file.
+
+    """
+    directory, basename = os.path.split(os.path.abspath(filename))
+    fd, tmp_filename = tempfile.mkstemp(prefix=basename + '.',
+                                        suffix='.tmp', dir=directory)
+    record = struct.Struct('<IIII')
+    try:
+        with os.fdopen(fd, 'wb') as pcap_file:
+            pcap_file.write(struct.pack('<IHHiIII', _MAGIC_US, 2, 4, 0, 0,
+                                        snaplen, linktype))
+            for timestamp, orig_len, data in records:
+                sec = int(timestamp)
+                usec = int((timestamp - sec) * 1e6)
+                pcap_file.write(record.pack(sec, usec, len(data), orig_len))
+                pcap_file.write(data)
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        os.unlink(tmp_filename)
+        raise
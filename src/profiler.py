@@ -0,0 +1,206 @@
+"""Per-rule chain profiling and hit-frequency based rule reordering.
+
+A ChainProfiler is attached to a DefNd (`the_wall.profiler`) and records, for
+every rule of every chain, how often it was evaluated, how often it matched
+and how much time it took.  This can run on live traffic (`main.py
+--profile`) or on a pcap replay (running this module directly).
+
+The optimizer then moves frequently matching rules towards the front of their
+chain.  Only adjacent rules that provably commute are swapped: both must
+describe what they match through `Rule.match_space()`, and they must either
+share the same action or never match the same packet.
+
+"""
+from __future__ import print_function
+import argparse
+import logging
+import time
+
+import config
+import connection
+import pcap
+from packets import IPPacket
+
+
+class RuleStats(object):
+    """Counters for a single rule of a chain."""
+
+    __slots__ = ('evals', 'matches', 'seconds')
+
+    def __init__(self):
+        self.evals = 0
+        self.matches = 0
+        self.seconds = 0.0
+
+
+class ChainProfiler(object):
+    """Collects per-rule evaluation statistics while a DefNd runs."""
+
+    def __init__(self, filename=None):
+        """Create a profiler, writing its report to filename when dumped."""
+        self.filename = filename
+        self.stats = {}  # chain name -> [(rule, RuleStats)]
+
+    def run_chain(self, chain_name, rules, defnd_packet):
+        """Run a packet through the rules of a chain, timing each rule."""
+        entries = self.stats.get(chain_name)
+        if entries is None or len(entries) != len(rules):
+            entries = [(rule, RuleStats()) for rule in rules]
+            self.stats[chain_name] = entries
+        clock = time.perf_counter
+        for rule, stats in entries:
+            start = clock()
+            result = rule(defnd_packet)
+            stats.seconds += clock() - start
+            stats.evals += 1
+            if result:
+                stats.matches += 1
+                return result
+        return False
+
+    def ranked(self):
+        """Return (chain, index, rule, stats) tuples, most expensive first."""
+        rows = []
+        for chain_name, entries in self.stats.items():
+            for index, (rule, stats) in enumerate(entries):
+                rows.append((chain_name, index, rule, stats))
+        rows.sort(key=lambda row: row[3].seconds, reverse=True)
+        return rows
+
+    def report(self):
+        """Return a ranked, human readable report."""
+        lines = ['%-12s %5s %-20s %10s %10s %10s %10s' %
+                 ('chain', 'index', 'rule', 'evals', 'matches', 'total_ms',
+                  'avg_us')]
+        for chain_name, index, rule, stats in self.ranked():
+            avg = stats.seconds / stats.evals * 1e6 if stats.evals else 0.0
+            lines.append('%-12s %5d %-20s %10d %10d %10.3f %10.3f' %
+                         (chain_name, index, type(rule).__name__, stats.evals,
+                          stats.matches, stats.seconds * 1e3, avg))
+        return '\n'.join(lines)
+
+    def dump(self):
+        """Write the report to the profiler's file, or log it."""
+        if self.filename:
+            with open(self.filename, 'w') as report_file:
+                report_file.write(self.report() + '\n')
+        else:
+            logging.getLogger('defnd.profiler').info('\n' + self.report())
+
+    def match_counts(self, chain_name):
+        """Return the match count of each rule of a chain, in chain order."""
+        return [stats.matches for _, stats in self.stats.get(chain_name, [])]
+
+
+def _disjoint(space_a, space_b):
+    """True if no packet can lie in both match spaces."""
+    for dimension in set(space_a) & set(space_b):
+        a, b = space_a[dimension], space_b[dimension]
+        if dimension == 'protocol':
+            if not a & b:
+                return True
+        elif dimension in ('src_port', 'dst_port'):
+            if not a & b:
+                return True
+        elif a[1] < b[0] or b[1] < a[0]:
+            return True
+    return False
+
+
+def commutes(rule_a, rule_b):
+    """True if swapping two adjacent rules can never change a verdict."""
+    space_a = rule_a.match_space()
+    space_b = rule_b.match_space()
+    if space_a is None or space_b is None:
+        return False
+    return rule_a.action == rule_b.action or _disjoint(space_a, space_b)
+
+
+def optimize_order(rules, hits):
+    """Return a permutation of range(len(rules)) with hot rules first.
+
+    This is a stable bubble sort that only swaps neighbours which commute, so
+    the reordered chain gives the same verdict as the original for any
+    packet.
+
+    """
+    order = list(range(len(rules)))
+    swapped = True
+    while swapped:
+        swapped = False
+        for i in range(len(order) - 1):
+            a, b = order[i], order[i + 1]
+            if hits[b] > hits[a] and commutes(rules[a], rules[b]):
+                order[i], order[i + 1] = b, a
+                swapped = True
+    return order
+
+
+def optimize_config(cfg, the_wall, profiler):
+    """Reorder the rule lists of cfg in place using the profile counts.
+
+    Returns the number of rules that moved.
+
+    """
+    moved = 0
+    for chain_name, rule_specs in cfg.chain_specs().items():
+        rules = the_wall.chains[chain_name]
+        hits = profiler.match_counts(chain_name) or [0] * len(rules)
+        order = optimize_order(rules, hits)
+        moved += sum(1 for i, j in enumerate(order) if i != j)
+        cfg.config[chain_name] = [rule_specs[i] for i in order]
+    return moved
+
+
+class _TrackerFeed(object):
+    """Stands in for the ingress queue, feeding an in-process tracker."""
+
+    def __init__(self, tracker):
+        self._tracker = tracker
+        self._reply = None
+
+    def put(self, report):
+        self._tracker.handle_ingress(report)
+
+    def send(self, con_tuple):
+        self._reply = self._tracker.state_of(con_tuple, 'CLOSED')
+
+    def recv(self):
+        return self._reply
+
+
+def replay(cfg, filename, profiler):
+    """Build a DefNd from cfg and profile it on the packets of a pcap."""
+    tracker = connection.DefndTracker(None, None, None)
+    feed = _TrackerFeed(tracker)
+    the_wall = cfg.create_defnd(feed, feed)
+    the_wall.profiler = profiler
+    for _, buf in pcap.read_pcap(filename):
+        ip_packet = IPPacket(buf)
+        the_wall.report(ip_packet)
+        the_wall.evaluate('INPUT', ip_packet)
+    return the_wall
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Profile the chains of a configuration on a pcap replay')
+    parser.add_argument('config', help='JSON configuration file')
+    parser.add_argument('pcap', help='capture file to replay')
+    parser.add_argument('-r', '--report', default=None,
+                        help='write the ranked report to a file')
+    parser.add_argument('-o', '--optimize', default=None,
+                        help='write a reordered configuration to a file')
+    args = parser.parse_args()
+
+    cfg = config.defndConfig(args.config)
+    profiler = ChainProfiler(args.report)
+    the_wall = replay(cfg, args.pcap, profiler)
+    if args.report:
+        profiler.dump()
+    else:
+        print(profiler.report())
+    if args.optimize:
+        moved = optimize_config(cfg, the_wall, profiler)
+        cfg.save(args.optimize)
+        print('Moved %d rules, wrote %s' % (moved, args.optimize))
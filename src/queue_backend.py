@@ -0,0 +1,226 @@
+"""Packet queue backends for the ingress and egress workers.
+
+A backend provides three things: a NetFilterQueue class with the interface
+of the netfilterqueue module (bind, run, run_socket, get_fd, unbind, and
+packets with get_payload, retain, accept and drop), a `socket` function
+returning the socket of a bound NetFilterQueue for run_socket, and an
+`iptables` function that applies the rules sending packets to the queue.
+
+- 'nfqueue' is the real thing: netfilterqueue and the iptables command.
+- 'local' is an in-process stand-in for development and load testing.
+  Packets are injected into a LocalChannel, and verdicts are reported back on
+  it.  iptables commands are only logged.
+
+Local channels must be created (create_channel) before the worker processes
+are forked, so that they inherit them.
+
+"""
+from __future__ import print_function
+import errno
+import logging
+import multiprocessing as mp
+import queue
+import socket
+import subprocess
+import time
+
+# Local channels by queue number, inherited by forked workers.
+_channels = {}
+
+
+def get_backend(name):
+    """Return the backend with the given name."""
+    if name == 'nfqueue':
+        return NFQueueBackend()
+    elif name == 'local':
+        return LocalBackend()
+    raise ValueError('Unknown queue backend "%s"' % name)
+
+
+class NFQueueBackend(object):
+    """The kernel's NFQUEUE, through the netfilterqueue module."""
+
+    def __init__(self):
+        import netfilterqueue
+        self.NetFilterQueue = netfilterqueue.NetfilterQueue
+
+    def socket(self, nfqueue_instance):
+        """Return the netlink socket of a bound NetFilterQueue."""
+        return socket.fromfd(nfqueue_instance.get_fd(), socket.AF_NETLINK,
+                             socket.SOCK_RAW)
+
+    def iptables(self, command):
+        """Run an iptables command."""
+        subprocess.run(command, shell=True)
+
+
+class LocalChannel(object):
+    """The packets injected into a local queue, and the verdicts given.
+
+    Verdicts are (queue_num, seq, verdict, inject_time, verdict_time) tuples,
+    with times from time.perf_counter(), which is comparable between
+    processes on Linux.
+
+    """
+
+    def __init__(self, queue_num, verdicts=None):
+        self.queue_num = queue_num
+        self.packets = mp.Queue()
+        self.verdicts = verdicts if verdicts is not None else mp.Queue()
+
+    def inject(self, seq, payload):
+        """Queue a raw IP packet for the worker bound to this channel."""
+        self.packets.put((seq, payload, time.perf_counter()))
+
+    def close(self):
+        """Make the worker's run() return."""
+        self.packets.put(None)
+
+
+def create_channel(queue_num, verdicts=None):
+    """Create the local channel for a queue number."""
+    _channels[queue_num] = LocalChannel(queue_num, verdicts)
+    return _channels[queue_num]
+
+
+class LocalSocket(object):
+    """The "socket" of a LocalQueue: recv() returns the next injected item
+    rather than bytes, and fails with EAGAIN when there is none."""
+
+    def __init__(self, channel):
+        self._packets = channel.packets
+        self._blocking = True
+
+    def fileno(self):
+        return self._packets._reader.fileno()
+
+    def setblocking(self, flag):
+        self._blocking = flag
+
+    def recv(self, bufsize, flags=0):
+        try:
+            return self._packets.get(self._blocking)
+        except queue.Empty:
+            raise BlockingIOError(errno.EAGAIN, 'No packet queued')
+
+
+class LocalPacket(object):
+    """A packet delivered by a LocalQueue."""
+
+    def __init__(self, channel, seq, payload, inject_time):
+        self._channel = channel
+        self._seq = seq
+        self._payload = payload
+        self._inject_time = inject_time
+        self._verdict = None
+        self._mark = 0
+
+    def get_payload(self):
+        return self._payload
+
+    def get_payload_len(self):
+        return len(self._payload)
+
+    def get_timestamp(self):
+        """Injection time in seconds since the epoch, like netfilterqueue."""
+        return time.time() - (time.perf_counter() - self._inject_time)
+
+    def set_payload(self, payload):
+        self._payload = payload
+
+    def get_mark(self):
+        return self._mark
+
+    def set_mark(self, mark):
+        self._mark = mark
+
+    def retain(self):
+        pass
+
+    def _set_verdict(self, verdict):
+        if self._verdict is not None:
+            raise RuntimeError('Verdict already given for this packet')
+        self._verdict = verdict
+        self._channel.verdicts.put((self._channel.queue_num, self._seq,
+                                    verdict, self._inject_time,
+                                    time.perf_counter()))
+
+    def accept(self):
+        self._set_verdict('ACCEPT')
+
+    def drop(self):
+        self._set_verdict('DROP')
+
+    def repeat(self):
+        self._set_verdict('REPEAT')
+
+
+class LocalQueue(object):
+    """Stand-in for netfilterqueue.NetFilterQueue, reading a LocalChannel."""
+
+    def __init__(self):
+        self._channel = None
+        self._callback = None
+
+    def bind(self, queue_num, user_callback, max_len=1024, mode=None,
+             range=65535, sock_len=None):
+        if queue_num not in _channels:
+            raise OSError('No local channel for queue %d' % queue_num)
+        self._channel = _channels[queue_num]
+        self._callback = user_callback
+
+    def unbind(self):
+        self._callback = None
+
+    def get_fd(self):
+        return self._channel.packets._reader.fileno()
+
+    def run(self, block=True):
+        """Deliver packets until the channel is closed.  With block=False,
+        deliver only what is already queued."""
+        packets = self._channel.packets
+        while self._callback is not None:
+            try:
+                item = packets.get() if block else packets.get_nowait()
+            except queue.Empty:
+                return
+            if item is None:
+                return
+            self._deliver(item)
+
+    def run_socket(self, s):
+        """Deliver packets read from s, a LocalSocket, until it would block.
+
+        Like netfilterqueue, retries on ENOBUFS and returns on EAGAIN.  Raises
+        EOFError once the channel is closed.
+
+        """
+        while self._callback is not None:
+            try:
+                item = s.recv(65535)
+            except OSError as e:
+                if e.errno == errno.ENOBUFS:
+                    continue
+                elif e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            if item is None:
+                raise EOFError('Local channel %d closed' %
+                               self._channel.queue_num)
+            self._deliver(item)
+
+    def _deliver(self, item):
+        seq, payload, inject_time = item
+        self._callback(LocalPacket(self._channel, seq, payload, inject_time))
+
+
+class LocalBackend(object):
+    """Local channels instead of NFQUEUE; iptables commands are logged."""
+
+    NetFilterQueue = LocalQueue
+
+    def socket(self, nfqueue_instance):
+        return LocalSocket(nfqueue_instance._channel)
+
+    def iptables(self, command):
+        logging.getLogger('defnd.backend').debug('Skipping: %s' % command)
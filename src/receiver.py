@@ -0,0 +1,152 @@
+"""The receive loop of the ingress and egress workers.
+
+NetFilterQueue.run() hands packets to Python one callback at a time, each
+followed by its verdict, and hides the netlink socket.  Receiver reads the
+socket itself, non-blocking, through NetFilterQueue.run_socket(): each pass
+collects up to batch_size packets, then gives them to the worker's
+handle_batch(), which decides and issues their verdicts together.
+
+The "queue" object of a configuration file sets:
+
+- batch_size: packets read per pass (64).
+- max_len: packets the kernel queues before dropping (or accepting, see
+  fail_open) new ones (1024).
+- sock_len: receive buffer of the netlink socket in bytes (None, for the
+  netfilterqueue default).  When it fills up, the kernel drops packets and
+  recv() fails with ENOBUFS; Receiver counts these.
+- fail_open: accept packets rather than drop them while no worker is bound to
+  the queue, through the iptables --queue-bypass option (False).
+
+The 'receive' control command shows the counters of a worker.
+
+"""
+import errno
+import select
+
+import control
+import startup
+
+DEFAULTS = {
+    'batch_size': 64,
+    'max_len': 1024,
+    'sock_len': None,
+    'fail_open': False,
+}
+
+# Read size for one netlink message; a full packet and its attributes fit.
+_BUFFER_SIZE = 0x10000
+
+
+def settings(spec):
+    """Return the settings of a "queue" object, with defaults."""
+    unknown = set(spec) - set(DEFAULTS)
+    if unknown:
+        raise ValueError('Unknown queue settings: %s' %
+                         ', '.join(sorted(unknown)))
+    result = dict(DEFAULTS)
+    result.update(spec)
+    if result['batch_size'] < 1:
+        raise ValueError('queue batch_size must be at least 1')
+    return result
+
+
+class _BatchSocket(object):
+    """The netlink socket as seen by NetFilterQueue.run_socket().
+
+    run_socket() reads until recv() fails with EAGAIN, and retries on
+    ENOBUFS.  This counts the ENOBUFS failures, and fails with EAGAIN once
+    batch_size messages were read, to end the pass.
+
+    """
+
+    def __init__(self, sock, batch_size):
+        self.sock = sock
+        self.batch_size = batch_size
+        self.received = 0
+        self.enobufs = 0
+
+    def recv(self, bufsize, flags=0):
+        if self.received >= self.batch_size:
+            raise BlockingIOError(errno.EAGAIN, 'Batch is full')
+        try:
+            data = self.sock.recv(bufsize, flags)
+        except OSError as e:
+            if e.errno == errno.ENOBUFS:
+                self.enobufs += 1
+            raise
+        self.received += 1
+        return data
+
+
+class Receiver(object):
+    """Reads a queue in batches for a worker.
+
+    handle_batch is called with a list of packets, and must give each its
+    verdict.  The backend is a queue_backend backend.
+
+    """
+
+    def __init__(self, backend, queue_num, handle_batch, **kwargs):
+        options = settings(kwargs)
+        self.backend = backend
+        self.queue_num = queue_num
+        self.handle_batch = handle_batch
+        self.batch_size = options['batch_size']
+        self.max_len = options['max_len']
+        self.sock_len = options['sock_len']
+        self.fail_open = options['fail_open']
+        self._batch = []
+        self._socket = None
+        self.counters = {'packets': 0, 'batches': 0, 'largest_batch': 0}
+        control.register_command('receive', self.stats)
+
+    def iptables_options(self):
+        """Options to append to the iptables NFQUEUE rule."""
+        return ' --queue-bypass' if self.fail_open else ''
+
+    def _collect(self, packet):
+        # Keep the payload readable after the callback returns.
+        packet.retain()
+        self._batch.append(packet)
+
+    def _flush(self):
+        batch, self._batch = self._batch, []
+        counters = self.counters
+        counters['packets'] += len(batch)
+        counters['batches'] += 1
+        if len(batch) > counters['largest_batch']:
+            counters['largest_batch'] = len(batch)
+        self.handle_batch(batch)
+
+    def run(self):
+        """Bind the queue and handle packets until interrupted."""
+        nfqueue_instance = self.backend.NetFilterQueue()
+        kwargs = {'max_len': self.max_len}
+        if self.sock_len is not None:
+            kwargs['sock_len'] = self.sock_len
+        nfqueue_instance.bind(self.queue_num, self._collect, **kwargs)
+        sock = self.backend.socket(nfqueue_instance)
+        sock.setblocking(False)
+        self._socket = _BatchSocket(sock, self.batch_size)
+        startup.ready()
+        try:
+            while True:
+                select.select([sock], [], [])
+                self._socket.received = 0
+                nfqueue_instance.run_socket(self._socket)
+                if self._batch:
+                    self._flush()
+        except EOFError:
+            # The local backend's channel was closed.
+            if self._batch:
+                self._flush()
+        finally:
+            nfqueue_instance.unbind()
+
+    def stats(self):
+        """Counters of the receive loop."""
+        result = dict(self.counters)
+        result['enobufs'] = self._socket.enobufs if self._socket else 0
+        result['mean_batch'] = (float(result['packets']) / result['batches']
+                                if result['batches'] else 0.0)
+        return result
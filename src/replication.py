@@ -0,0 +1,431 @@
+"""Connection state replication from an active tracker to a standby.
+
+The active DefNd's trackers stream every change of their table to the
+standby's trackers over TCP, so that a standby taking over already knows the
+open connections, and TCPStateRule does not reset them.
+
+- ReplicationSender watches the tracker (DefndTracker.add_watcher) and queues
+  a 13 byte record per change: the connection tuple and the code of its new
+  state, CLOSED meaning expired.  Records are sent in batches, of batch_size
+  records or every `interval` seconds.  After connecting, and reconnecting,
+  it first sends its whole table as a snapshot.
+- ReplicationReceiver listens for the sender and applies the records to its
+  own tracker.  When a snapshot ends, the replicated connections it did not
+  mention are removed.  It only accepts connections from the configured
+  peer (a loopback address by default), and closes the others.
+
+Each message is a header (kind, number of records, and the time the oldest
+of them was queued, in seconds since the epoch) followed by its records.  The
+receiver measures the replication lag from that time, so the clocks of the
+two hosts must be synchronized.
+
+The records are not authenticated or encrypted: listen on a private
+interface, dedicated to the pair, rather than on every address.
+
+Tracker shard N replicates to port + N.  Both sides report their counters
+and the lag histogram through the 'replication' control command.  From a
+shell, a standby with no workers, only trackers:
+
+    python replication.py 127.0.0.1:7400 --tracker-shards 2 -c /tmp/standby
+
+"""
+from __future__ import print_function
+import argparse
+import errno
+import logging
+import multiprocessing as mp
+import select
+import socket
+import struct
+import time
+
+import connection
+import control
+import flows
+import latency
+import startup
+
+# Every tracker state, indexed by its code on the wire.
+STATES = ('CLOSED', 'SYN_RCVD1', 'SYN_RCVD2', 'SYN_SENT1', 'SYN_SENT2',
+          'SYN_SENT3', 'ESTABLISHED', 'CLOSE_WAIT1', 'CLOSE_WAIT2',
+          'LAST_ACK', 'FIN_WAIT_1', 'FIN_WAIT_2', 'FIN_WAIT_3', 'CLOSING',
+          'CLOSING2')
+CODES = dict((state, code) for code, state in enumerate(STATES))
+
+DELTAS, SNAPSHOT, SNAPSHOT_END = 1, 2, 3
+
+_HEADER = struct.Struct('!BId')
+_RECORD = struct.Struct('!4sH4sHB')
+_SNAPSHOT_CHUNK = 4096
+
+
+def parse_address(address, shard=0):
+    """Return (host, port + shard) for a 'host:port' string."""
+    host, _, port = address.rpartition(':')
+    return host or '127.0.0.1', int(port) + shard
+
+
+def encode(tup, state):
+    """Return the record of a connection tuple in a state."""
+    return _RECORD.pack(socket.inet_aton(tup[0]), tup[1],
+                        socket.inet_aton(tup[2]), tup[3], CODES[state])
+
+
+def decode(buf, offset):
+    """Return the (tuple, state) of the record at offset in buf."""
+    src, src_port, dst, dst_port, code = _RECORD.unpack_from(buf, offset)
+    return ((socket.inet_ntoa(src), src_port, socket.inet_ntoa(dst),
+             dst_port), STATES[code])
+
+
+def message(kind, records, queued):
+    """Return a message of a kind with a list of encoded records."""
+    return _HEADER.pack(kind, len(records), queued) + b''.join(records)
+
+
+class ReplicationSender(object):
+    """Streams the changes of a tracker to a standby's receiver.
+
+    The socket is non-blocking, and all of the work happens from the
+    tracker's select loop: a peer that is down or slow never stalls it.
+    While disconnected, changes are not kept, since the snapshot sent on
+    reconnection covers them.  A peer that falls more than max_buffer bytes
+    behind is disconnected, and resynchronized.
+
+    """
+
+    def __init__(self, tracker, host, port, batch_size=256, interval=0.05,
+                 retry=2.0, max_buffer=1 << 24):
+        self.tracker = tracker
+        self.address = (host, port)
+        self.batch_size = batch_size
+        self.interval = interval
+        self.retry = retry
+        self.max_buffer = max_buffer
+        self._sock = None
+        self._connected = False
+        self._next_attempt = 0.0
+        self._pending = []
+        self._pending_since = None
+        self._queued = None
+        self._out = bytearray()
+        self.counters = {'created': 0, 'transitions': 0, 'expired': 0,
+                         'unsent': 0, 'batches': 0, 'bytes': 0,
+                         'snapshots': 0, 'disconnects': 0}
+        tracker.add_watcher(self.on_state)
+        tracker.add_timer(self.tick, self.timeout)
+        control.register_command('replication', self.stats)
+
+    def on_state(self, tup, old, new):
+        """Queue the record of a change (a tracker watcher)."""
+        if not self._connected:
+            self.counters['unsent'] += 1
+            return
+        if old == 'CLOSED':
+            self.counters['created'] += 1
+        elif new == 'CLOSED':
+            self.counters['expired'] += 1
+        else:
+            self.counters['transitions'] += 1
+        if not self._pending:
+            self._pending_since = time.monotonic()
+            self._queued = time.time()
+        self._pending.append(encode(tup, new))
+        if len(self._pending) >= self.batch_size:
+            self._flush()
+
+    def _flush(self):
+        if self._pending:
+            self._out += message(DELTAS, self._pending, self._queued)
+            self.counters['batches'] += 1
+            self._pending = []
+        self._send()
+
+    def _send(self):
+        try:
+            sent = self._sock.send(self._out)
+        except BlockingIOError:
+            sent = 0
+        except OSError as e:
+            self._disconnect('send failed: %s' % e)
+            return
+        self.counters['bytes'] += sent
+        del self._out[:sent]
+        if len(self._out) > self.max_buffer:
+            self._disconnect('peer is %d bytes behind' % len(self._out))
+
+    def _connect(self):
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setblocking(False)
+        self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        result = self._sock.connect_ex(self.address)
+        if result not in (0, errno.EINPROGRESS):
+            self._disconnect('connect failed: %s' % errno.errorcode.get(
+                result, result))
+
+    def _connecting(self):
+        """Finish a non-blocking connect, if it is done."""
+        _, writable, _ = select.select([], [self._sock], [], 0)
+        if not writable:
+            return
+        error = self._sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if error:
+            self._disconnect('connect failed: %s' % errno.errorcode.get(
+                error, error))
+            return
+        self._connected = True
+        self.tracker.add_reader(self._sock, self._readable)
+        logging.getLogger('defnd.replication').info(
+            'Replicating to %s:%d' % self.address)
+        self._snapshot()
+
+    def _snapshot(self):
+        """Queue the whole table, then the end of the snapshot."""
+        now = time.time()
+        records = [encode(tup, state) for tup, state
+                   in self.tracker.items()]
+        for start in range(0, len(records), _SNAPSHOT_CHUNK):
+            self._out += message(SNAPSHOT,
+                                 records[start:start + _SNAPSHOT_CHUNK], now)
+        self._out += message(SNAPSHOT_END, [], now)
+        self.counters['snapshots'] += 1
+        self._send()
+
+    def _readable(self):
+        # The receiver never writes: this is the end of the connection.
+        try:
+            data = self._sock.recv(4096)
+        except OSError:
+            data = None
+        if not data:
+            self._disconnect('closed by peer')
+
+    def _disconnect(self, reason):
+        logging.getLogger('defnd.replication').warning(
+            'Replication to %s:%d stopped: %s' % (self.address + (reason,)))
+        if self._connected:
+            self.tracker.remove_reader(self._sock)
+            self.counters['disconnects'] += 1
+        self._sock.close()
+        self._sock = None
+        self._connected = False
+        self._pending = []
+        self._out = bytearray()
+        self._next_attempt = time.monotonic() + self.retry
+
+    def tick(self):
+        """Connect, or flush a batch that waited long enough."""
+        now = time.monotonic()
+        if self._sock is None:
+            if now >= self._next_attempt:
+                self._connect()
+        elif not self._connected:
+            self._connecting()
+        elif self._pending and now - self._pending_since >= self.interval:
+            self._flush()
+        elif self._out:
+            self._send()
+
+    def timeout(self):
+        """Seconds until tick() has something to do, or None."""
+        now = time.monotonic()
+        if self._sock is None:
+            return max(0.0, self._next_attempt - now)
+        elif not self._connected:
+            return 0.01
+        elif self._pending:
+            return max(0.0, self._pending_since + self.interval - now)
+        elif self._out:
+            return 0.01
+        return None
+
+    def stats(self):
+        """Counters of the sender."""
+        result = dict(self.counters)
+        result.update({'role': 'sender', 'peer': '%s:%d' % self.address,
+                       'connected': self._connected,
+                       'pending': len(self._pending),
+                       'buffered_bytes': len(self._out)})
+        return result
+
+
+class ReplicationReceiver(object):
+    """Applies the changes streamed by an active tracker to a tracker.
+
+    peer is the host of the sender; connections from any other address are
+    refused.  Without it, only loopback addresses are accepted.
+
+    """
+
+    def __init__(self, tracker, host, port, peer=None):
+        self.tracker = tracker
+        self.address = (host, port)
+        self.peer = peer
+        self._peers = None
+        if peer is not None:
+            self._peers = set(info[4][0] for info in socket.getaddrinfo(
+                peer, None, socket.AF_INET, socket.SOCK_STREAM))
+        self._listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._listener.bind(self.address)
+        self._listener.listen(1)
+        self._conn = None
+        self._in = bytearray()
+        # Replicated connection tuple -> generation, the number of the
+        # connection from the sender that last set it.
+        self.replicated = {}
+        self._generation = 0
+        self.lag = latency.Histogram()
+        self.last_lag = None
+        self.counters = {'applied': 0, 'batches': 0, 'snapshots': 0,
+                         'connects': 0, 'refused': 0}
+        tracker.add_reader(self._listener, self._accept)
+        control.register_command('replication', self.stats)
+
+    def _accept(self):
+        conn, peer = self._listener.accept()
+        if not self._accepts(peer[0]):
+            conn.close()
+            self.counters['refused'] += 1
+            logging.getLogger('defnd.replication').warning(
+                'Refused replication from %s:%d' % peer)
+            return
+        if self._conn is not None:
+            # The sender reconnected; it will resend everything.
+            self._close()
+        conn.setblocking(False)
+        self._conn = conn
+        self._in = bytearray()
+        self._generation += 1
+        self.counters['connects'] += 1
+        self.tracker.add_reader(conn, self._readable)
+        logging.getLogger('defnd.replication').info(
+            'Replicating from %s:%d' % peer)
+
+    def _accepts(self, address):
+        if self._peers is None:
+            return address.startswith('127.')
+        return address in self._peers
+
+    def _close(self):
+        self.tracker.remove_reader(self._conn)
+        self._conn.close()
+        self._conn = None
+
+    def _readable(self):
+        try:
+            data = self._conn.recv(1 << 16)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = None
+        if not data:
+            self._close()
+            return
+        self._in += data
+        offset = 0
+        while len(self._in) - offset >= _HEADER.size:
+            kind, count, queued = _HEADER.unpack_from(self._in, offset)
+            end = offset + _HEADER.size + count * _RECORD.size
+            if end > len(self._in):
+                break
+            self._apply(kind, count, queued, offset + _HEADER.size)
+            offset = end
+        del self._in[:offset]
+
+    def _apply(self, kind, count, queued, offset):
+        if kind == SNAPSHOT_END:
+            self._end_snapshot()
+            return
+        replicated = self.replicated
+        generation = self._generation
+        set_state = self.tracker.set_state
+        for index in range(count):
+            tup, state = decode(self._in, offset + index * _RECORD.size)
+            set_state(tup, state)
+            if state == 'CLOSED':
+                replicated.pop(tup, None)
+            else:
+                replicated[tup] = generation
+        self.counters['applied'] += count
+        if kind == DELTAS:
+            self.counters['batches'] += 1
+            self.last_lag = time.time() - queued
+            self.lag.record(self.last_lag * 1e9)
+
+    def _end_snapshot(self):
+        """Remove the replicated connections that the snapshot of this
+        connection did not have."""
+        stale = [tup for tup, generation in self.replicated.items()
+                 if generation != self._generation]
+        for tup in stale:
+            del self.replicated[tup]
+            self.tracker.set_state(tup, 'CLOSED')
+        self.counters['snapshots'] += 1
+
+    def stats(self, buckets=False):
+        """Counters of the receiver, and the lag histogram in ns."""
+        result = dict(self.counters)
+        result.update({'role': 'receiver',
+                       'listen': '%s:%d' % self.address,
+                       'peer': self.peer,
+                       'connected': self._conn is not None,
+                       'replicated': len(self.replicated),
+                       'last_lag': self.last_lag,
+                       'lag': self.lag.export(buckets)})
+        return result
+
+
+def attach(tracker, replicate_to=None, replicate_listen=None,
+           replicate_from=None, shard=0):
+    """Set up the replication of a tracker shard, as sender or receiver.
+
+    A receiver only accepts the sender at host replicate_from.
+
+    """
+    if replicate_to:
+        ReplicationSender(tracker, *parse_address(replicate_to, shard))
+    if replicate_listen:
+        host, port = parse_address(replicate_listen, shard)
+        ReplicationReceiver(tracker, host, port, replicate_from)
+
+
+def run_standby(listen, shard, control_dir, peer=None):
+    """Run a tracker shard fed only by replication. (target of Process)"""
+    startup.begin('standby-%d' % shard)
+    # There are no workers, but the tracker selects on their queues and
+    # pipe: keep both ends of the pipe open.
+    workers_end, tracker_end = mp.Pipe()
+    tracker = connection.DefndTracker(mp.Queue(), mp.Queue(), tracker_end)
+    server = control.start_server(control_dir, 'tracker-%d' % shard,
+                                  in_thread=False)
+    if server:
+        server.attach(tracker)
+        flows.register(tracker)
+    attach(tracker, replicate_listen=listen, replicate_from=peer,
+           shard=shard)
+    tracker.run()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Run standby trackers that only receive replication')
+    parser.add_argument('listen', help='host:port to listen on (shard N'
+                        ' listens on port + N)')
+    parser.add_argument('--replicate-from', default=None, metavar='HOST',
+                        help='the active DefNd, the only host accepted'
+                        ' (loopback only by default)')
+    parser.add_argument('-s', '--tracker-shards', type=int, default=1,
+                        help='number of tracker shards of the active DefNd')
+    parser.add_argument('-c', '--control-dir', default=None,
+                        help='directory for the control sockets')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    for shard in range(1, args.tracker_shards):
+        mp.Process(target=run_standby,
+                   args=(args.listen, shard, args.control_dir,
+                         args.replicate_from)).start()
+    try:
+        run_standby(args.listen, 0, args.control_dir, args.replicate_from)
+    except KeyboardInterrupt:
+        pass
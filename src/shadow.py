@@ -0,0 +1,177 @@
+"""Shadow evaluation of a candidate configuration on sampled live traffic.
+
+With --shadow-config, one ingress packet in `sample_rate` is also evaluated
+by the chains of a candidate configuration, in a separate, low priority
+process, to see how a change would behave before rolling it out:
+
+- The ingress worker (ShadowTap) times the live evaluation of a sampled
+  packet, and puts the raw packet, its live verdict and that time on a
+  bounded queue without waiting.  When the queue is full the sample is
+  dropped and counted; the live verdict never depends on the shadow.
+- The shadow process (ShadowEvaluator) builds a DefNd from the candidate
+  configuration with config.defndConfig, evaluates each sample and counts
+  the verdicts that differ from the live ones.  It queries the tracker over
+  its own pipes, and never reports packets to it.
+
+The 'shadow' control command of the defnd socket shows the tap counters, and
+that of the shadow socket the comparison:
+
+    python control.py /run/defnd/shadow.sock shadow
+
+Stateful rules are compared on an approximation: the tracker may have moved
+on by the time a sample is evaluated, and rules counting traffic (rate
+limits, HeavyHitterRule) only see the samples.
+
+"""
+import collections
+import logging
+import os
+import queue
+import time
+
+import config
+import control
+import latency
+import startup
+from logger import initialize_logging
+from packets import IPPacket
+
+# Samples waiting for the shadow process, beyond which they are dropped.
+QUEUE_SIZE = 1024
+
+# Disagreements kept for the 'shadow' command.
+RECENT = 32
+
+
+class _NoReports(object):
+    """The packet queue of the candidate DefNd: reports go nowhere."""
+
+    def put(self, report):
+        pass
+
+    def qsize(self):
+        return 0
+
+
+class ShadowTap(object):
+    """Hands sampled ingress packets to the shadow process.
+
+    The DefNd calls sample() for each packet it evaluates, and submit() with
+    the verdict and evaluation time of those sampled.
+
+    """
+
+    def __init__(self, sample_queue, sample_rate=100):
+        self.queue = sample_queue
+        self.sample_rate = int(sample_rate)
+        self._countdown = self.sample_rate
+        self.counters = {'sampled': 0, 'dropped': 0}
+        control.register_command('shadow', self.stats)
+
+    def sample(self):
+        """Return True for one call in sample_rate."""
+        self._countdown -= 1
+        if self._countdown:
+            return False
+        self._countdown = self.sample_rate
+        return True
+
+    def submit(self, payload, verdict, nanoseconds):
+        """Queue a sampled packet, or drop it if the shadow is behind."""
+        try:
+            self.queue.put_nowait((bytes(payload), verdict, nanoseconds))
+            self.counters['sampled'] += 1
+        except queue.Full:
+            self.counters['dropped'] += 1
+
+    def stats(self):
+        result = dict(self.counters)
+        result['sample_rate'] = self.sample_rate
+        return result
+
+
+class ShadowEvaluator(object):
+    """Evaluates samples with a candidate DefNd and compares the verdicts."""
+
+    def __init__(self, the_wall):
+        self.the_wall = the_wall
+        self.reset()
+        control.register_command('shadow', self.stats)
+
+    def reset(self):
+        self.compared = 0
+        # (live, candidate) -> count, for the verdicts that differ.
+        self.disagreements = {}
+        self.recent = collections.deque(maxlen=RECENT)
+        self.costs = {'live': latency.Histogram(),
+                      'candidate': latency.Histogram()}
+
+    def handle(self, sample):
+        """Evaluate one (payload, live verdict, live nanoseconds) sample."""
+        payload, live, live_cost = sample
+        the_wall = self.the_wall
+        if the_wall.accountant is not None:
+            the_wall.accountant.add(payload)
+            the_wall.accountant.flush()
+        ip_packet = IPPacket(payload)
+        start = time.perf_counter_ns()
+        candidate = the_wall.evaluate('INPUT', ip_packet)
+        self.costs['candidate'].record(time.perf_counter_ns() - start)
+        self.costs['live'].record(live_cost)
+        self.compared += 1
+        if candidate != live:
+            key = (live, candidate)
+            self.disagreements[key] = self.disagreements.get(key, 0) + 1
+            self.recent.append({'packet': str(ip_packet), 'live': live,
+                                'candidate': candidate})
+
+    def stats(self, reset=False):
+        """The comparison so far; reset=true starts over."""
+        disagreed = sum(self.disagreements.values())
+        live = self.costs['live'].export()
+        candidate = self.costs['candidate'].export()
+        result = {
+            'compared': self.compared,
+            'disagreed': disagreed,
+            'disagreement_rate': (float(disagreed) / self.compared
+                                  if self.compared else 0.0),
+            'disagreements': dict(('%s->%s' % key, count) for key, count in
+                                  self.disagreements.items()),
+            'recent': list(self.recent),
+            'unit': 'ns',
+            'cost': {'live': live, 'candidate': candidate},
+            'cost_ratio': (float(candidate['mean']) / live['mean']
+                           if live['mean'] else None),
+        }
+        if reset:
+            self.reset()
+        return result
+
+
+def run_shadow(candidate_conf, sample_queue, query_pipe, loglevel, logqueue,
+               control_dir=None, niceness=10):
+    """Evaluate the samples of sample_queue with a candidate configuration
+    until the queue is closed. (target of Process)
+
+    query_pipe is the shadow's own pipe (or ShardedPipe) to the tracker.
+
+    """
+    startup.begin('shadow')
+    initialize_logging(loglevel, logqueue)
+    os.nice(niceness)
+    log = logging.getLogger('defnd.shadow')
+    control.start_server(control_dir, 'shadow')
+    cfg = config.defndConfig(candidate_conf)
+    evaluator = ShadowEvaluator(cfg.create_defnd(_NoReports(), query_pipe))
+    log.info('Shadow evaluation of %s started' % candidate_conf)
+    startup.ready()
+    while True:
+        try:
+            sample = sample_queue.get()
+        except (EOFError, OSError):
+            break
+        try:
+            evaluator.handle(sample)
+        except Exception as e:
+            log.warning('Shadow evaluation failed: %s' % e)
+    log.info('Shadow evaluation ended: %s' % evaluator.stats())
@@ -0,0 +1,78 @@
+"""Splitting the connection tracker across several processes.
+
+Each tracker shard is a DefndTracker with its own ingress queue, egress queue
+and query pipe.  A connection is owned by the shard selected by a symmetric
+hash of its 4-tuple, so the ingress tuple of a packet and the flipped egress
+tuple of its reply (packets.to_tuple(flip=True)) land on the same shard.
+
+ShardedQueue and ShardedPipe route reports and queries to the owning shard,
+and are drop-in replacements for the single queue and pipe: DefNd, DefNdEgress
+and TCPStateRule do not know whether the tracker is sharded.
+
+Each shard answers control commands on its own tracker-N.sock; control.py
+--trackers sends a command to all of them and merges the replies, for one
+view of the whole table ('stats', 'flows', 'synflood', ...).
+
+"""
+import zlib
+
+
+def shard_of(con_tuple, shards):
+    """Return the shard number owning a connection tuple.
+
+    The two endpoints are put in a canonical order before hashing, so the
+    result does not depend on the direction of the tuple.  crc32 is used
+    rather than hash(), which is randomized per interpreter.
+
+    """
+    if shards == 1:
+        return 0
+    ip_a, port_a, ip_b, port_b = con_tuple
+    if (ip_a, port_a) > (ip_b, port_b):
+        ip_a, port_a, ip_b, port_b = ip_b, port_b, ip_a, port_a
+    key = '%s:%d-%s:%d' % (ip_a, port_a, ip_b, port_b)
+    return zlib.crc32(key.encode('ascii')) % shards
+
+
+class ShardedQueue(object):
+    """Puts (tuple, syn, ack, fin) reports on the queue of the owning shard.
+
+    A list of reports is split into one list per shard.
+
+    """
+
+    def __init__(self, queues):
+        self.queues = queues
+
+    def put(self, report):
+        shards = len(self.queues)
+        if type(report) is not list:
+            self.queues[shard_of(report[0], shards)].put(report)
+            return
+        batches = {}
+        for item in report:
+            batches.setdefault(shard_of(item[0], shards), []).append(item)
+        for shard, batch in batches.items():
+            self.queues[shard].put(batch)
+
+    def qsize(self):
+        return sum(q.qsize() for q in self.queues)
+
+
+class ShardedPipe(object):
+    """Sends tracker queries to the owning shard.
+
+    send() and recv() behave like a single Connection for connection tuples.
+
+    """
+
+    def __init__(self, pipes):
+        self.pipes = pipes
+        self._last = pipes[0]
+
+    def send(self, con_tuple):
+        self._last = self.pipes[shard_of(con_tuple, len(self.pipes))]
+        self._last.send(con_tuple)
+
+    def recv(self):
+        return self._last.recv()
@@ -0,0 +1,63 @@
+"""Startup time of each process, by phase.
+
+A process calls begin() first thing, mark() at the end of each phase of its
+startup, and ready() once it handles packets.  ready() logs the total and the
+phases, which the 'startup' control command also shows:
+
+    python control.py /run/defnd/defnd.sock startup
+
+The main program is timed from the import of this module, its first import,
+so that its total includes importing everything else.  Processes forked from
+it start over in begin().
+
+"""
+import logging
+import time
+
+import control
+
+_process = 'main'
+_start = _last = time.perf_counter()
+_phases = []
+_total = None
+
+
+def begin(process):
+    """Start timing the startup of this process."""
+    global _process, _start, _last, _phases, _total
+    _process = process
+    _start = _last = time.perf_counter()
+    _phases = []
+    _total = None
+
+
+def mark(phase):
+    """End a phase of the startup."""
+    global _last
+    now = time.perf_counter()
+    _phases.append((phase, now - _last))
+    _last = now
+
+
+def ready():
+    """End the startup, and log how long it took."""
+    global _total
+    if _total is not None:
+        return
+    mark('other')
+    _total = _last - _start
+    logging.getLogger('defnd.startup').info(
+        'Started %s in %.1f ms (%s)' % (
+            _process, _total * 1e3,
+            ', '.join('%s %.1f ms' % (phase, seconds * 1e3)
+                      for phase, seconds in _phases)))
+
+
+def _command():
+    """The 'startup' control command."""
+    return {'process': _process, 'unit': 'ms',
+            'total': None if _total is None else _total * 1e3,
+            'phases': [[phase, seconds * 1e3] for phase, seconds in _phases]}
+
+
+control.register_command('startup', _command)
@@ -0,0 +1,235 @@
+"""SYN-flood protection for the connection tracker and the ingress worker.
+
+Every inbound SYN of a new connection makes the tracker allocate a half-open
+(SYN_RCVD) entry, and costs a report and a tracker query on the way.  A flood
+of SYNs from spoofed sources would grow the table without bound, so when the
+configuration has a "syn_protection" object:
+
+- The tracker (HalfOpenLimiter) caps half-open entries, globally and per
+  source address, and expires them after half_open_timeout seconds.  SYNs over
+  a cap get no entry.  Hitting a cap, or filling the table past three
+  quarters, puts the tracker "under attack" for at least attack_hold seconds,
+  during which half-open entries expire after attack_timeout seconds instead.
+- Under attack, the ingress worker (SynGuard) drops SYNs beyond syn_rate per
+  second, or beyond syn_per_source per second from one address, straight from
+  the raw packet: they are never parsed, reported or looked up.
+
+The caps are for the whole tracker.  With N shards, each shard enforces
+1/N of them (see per_shard): a source's connections spread over the shards
+by 4-tuple hash, so the caps hold on average, not exactly.  The tracker
+shards share the under-attack state with the ingress worker through a
+multiprocessing.Value counting the shards under attack.  Both sides
+report their counters through the 'synflood' control command.
+
+"""
+import collections
+import multiprocessing as mp
+import time
+
+import control
+
+DEFAULTS = {
+    'max_half_open': 10000,
+    'max_half_open_per_source': 64,
+    'half_open_timeout': 30.0,
+    'attack_timeout': 5.0,
+    'attack_hold': 10.0,
+    'syn_rate': 1000,
+    'syn_per_source': 16,
+}
+
+# States of connections opened by a remote SYN and not yet acknowledged.
+HALF_OPEN = frozenset(['SYN_RCVD1', 'SYN_RCVD2'])
+
+_TCP_SYN = 0x02
+_TCP_ACK = 0x10
+
+
+def settings(spec):
+    """Return the settings of a "syn_protection" object, with defaults."""
+    unknown = set(spec) - set(DEFAULTS)
+    if unknown:
+        raise ValueError('Unknown syn_protection settings: %s' %
+                         ', '.join(sorted(unknown)))
+    result = dict(DEFAULTS)
+    result.update(spec)
+    return result
+
+
+def per_shard(options, shards):
+    """Return the settings of one of shards tracker shards: the half-open
+    caps are divided among them, rounding up."""
+    result = dict(options)
+    for name in ('max_half_open', 'max_half_open_per_source'):
+        result[name] = -(-int(options[name]) // shards)
+    return result
+
+
+def attack_flag():
+    """Create the shared count of tracker shards under attack."""
+    return mp.Value('i', 0)
+
+
+class HalfOpenLimiter(object):
+    """Caps and expires the half-open connections of a DefndTracker.
+
+    The tracker calls admit() before creating a half-open entry, on_state()
+    from set_state(), and expire() from its select loop, waiting at most
+    timeout() seconds.
+
+    """
+
+    def __init__(self, tracker, flag, **kwargs):
+        options = settings(kwargs)
+        self.tracker = tracker
+        self.flag = flag
+        self.max_half_open = options['max_half_open']
+        self.max_per_source = options['max_half_open_per_source']
+        self.half_open_timeout = options['half_open_timeout']
+        self.attack_timeout = options['attack_timeout']
+        self.attack_hold = options['attack_hold']
+        # Half-open tuple -> creation time, oldest first.
+        self.half_open = collections.OrderedDict()
+        self.by_source = {}
+        self.under_attack = False
+        self._attack_until = 0.0
+        self.counters = {'refused_global': 0, 'refused_source': 0,
+                         'expired': 0, 'attacks': 0}
+        control.register_command('synflood', self.stats)
+
+    def admit(self, tup):
+        """Return whether a SYN may create a half-open entry for tup."""
+        if len(self.half_open) >= self.max_half_open:
+            self.counters['refused_global'] += 1
+        elif self.by_source.get(tup[0], 0) >= self.max_per_source:
+            self.counters['refused_source'] += 1
+        else:
+            if len(self.half_open) >= self.max_half_open * 3 // 4:
+                self._attacked()
+            return True
+        self._attacked()
+        return False
+
+    def on_state(self, tup, old, new):
+        """Follow a connection into and out of the half-open states."""
+        if (old in HALF_OPEN) == (new in HALF_OPEN):
+            return
+        source = tup[0]
+        if new in HALF_OPEN:
+            self.half_open[tup] = time.monotonic()
+            self.by_source[source] = self.by_source.get(source, 0) + 1
+        else:
+            del self.half_open[tup]
+            if self.by_source[source] == 1:
+                del self.by_source[source]
+            else:
+                self.by_source[source] -= 1
+
+    def _timeout(self):
+        if self.under_attack:
+            return self.attack_timeout
+        return self.half_open_timeout
+
+    def timeout(self):
+        """Return the seconds until the next expiry, or None."""
+        if self.under_attack:
+            return max(0.0, min(self._attack_until,
+                                self._next_expiry()) - time.monotonic())
+        if not self.half_open:
+            return None
+        return max(0.0, self._next_expiry() - time.monotonic())
+
+    def _next_expiry(self):
+        if not self.half_open:
+            return self._attack_until
+        return next(iter(self.half_open.values())) + self._timeout()
+
+    def expire(self):
+        """Close the half-open connections that timed out, and leave the
+        attack mode once its hold time is over."""
+        now = time.monotonic()
+        if self.under_attack and now >= self._attack_until:
+            self.under_attack = False
+            with self.flag.get_lock():
+                self.flag.value -= 1
+        deadline = now - self._timeout()
+        while self.half_open:
+            tup, created = next(iter(self.half_open.items()))
+            if created > deadline:
+                break
+            self.counters['expired'] += 1
+            self.tracker.set_state(tup, 'CLOSED')
+
+    def _attacked(self):
+        self._attack_until = time.monotonic() + self.attack_hold
+        if not self.under_attack:
+            self.under_attack = True
+            self.counters['attacks'] += 1
+            with self.flag.get_lock():
+                self.flag.value += 1
+
+    def stats(self):
+        """Counters of the tracker side."""
+        result = dict(self.counters)
+        result.update({'half_open': len(self.half_open),
+                       'sources': len(self.by_source),
+                       'under_attack': self.under_attack})
+        return result
+
+
+class SynGuard(object):
+    """Drops SYNs over budget in the ingress worker, while under attack.
+
+    check() takes the raw IP packet and returns False when it must be
+    dropped.  Outside of an attack it only reads the shared flag.
+
+    """
+
+    def __init__(self, flag, **kwargs):
+        options = settings(kwargs)
+        self.flag = flag.get_obj()
+        self.syn_rate = options['syn_rate']
+        self.syn_per_source = options['syn_per_source']
+        self._window = None
+        self._total = 0
+        self._sources = {}
+        self.counters = {'passed': 0, 'dropped_global': 0,
+                         'dropped_source': 0}
+        control.register_command('synflood', self.stats)
+
+    def check(self, buf):
+        """Return whether a raw IP packet may go on."""
+        # Unsynchronized read: a stale value only delays the mode change.
+        if not self.flag.value:
+            return True
+        if buf[9] != 6:
+            return True
+        flags_offset = (buf[0] & 0xF) * 4 + 13
+        if len(buf) <= flags_offset:
+            return True
+        flags = buf[flags_offset]
+        if flags & (_TCP_SYN | _TCP_ACK) != _TCP_SYN:
+            return True
+        window = int(time.monotonic())
+        if window != self._window:
+            self._window = window
+            self._total = 0
+            self._sources = {}
+        if self._total >= self.syn_rate:
+            self.counters['dropped_global'] += 1
+            return False
+        source = bytes(buf[12:16])
+        sent = self._sources.get(source, 0)
+        if sent >= self.syn_per_source:
+            self.counters['dropped_source'] += 1
+            return False
+        self._sources[source] = sent + 1
+        self._total += 1
+        self.counters['passed'] += 1
+        return True
+
+    def stats(self):
+        """Counters of the ingress side."""
+        result = dict(self.counters)
+        result['under_attack'] = bool(self.flag.value)
+        return result
@@ -1,50 +1,96 @@
 from __future__ import print_function
 import os
 import logging
-import subprocess
-import netfilterqueue as nfq
 from packets import IPPacket, TCPPacket,to_tuple
+import queue_backend
+import receiver
+import diagnostics
+import latency
+import accounting
 
 class DefNdEgress(object):
     #Egress Monitoring Process
-    def __init__(self, mp_queue,queue_num=2):
-        #Create the Egress Process
+    def __init__(self, mp_queue,queue_num=2, backend='nfqueue', queue=None,
+                 accounting_spec=None):
+        #Create the Egress Process.  queue holds the settings of the receive
+        #loop (see receiver), and accounting_spec the "accounting" object of
+        #the configuration, if any (see accounting).
         self.queue_num = queue_num
+        self.backend = queue_backend.get_backend(backend)
+        self.engine = receiver.Receiver(self.backend, queue_num,
+                                        self.handle_batch, **(queue or {}))
+        self.accountant = None
+        if accounting_spec is not None:
+            self.accountant = accounting.create('egress', accounting_spec)
+        diagnostics.register_subsystem('egress.queue', mp_queue)
         self.mp_queue = mp_queue
         self._nfq_init = 'iptables -I OUTPUT -j NFQUEUE --queue-num %d'
         self._nfq_close = 'iptables -D OUTPUT -j NFQUEUE --queue-num %d'
     
     def run(self):
-        setup = self._nfq_init % self.queue_num
-        teardown = self._nfq_close % self.queue_num
+        setup = self._nfq_init % self.queue_num + \
+            self.engine.iptables_options()
+        teardown = self._nfq_close % self.queue_num + \
+            self.engine.iptables_options()
         
         #setting up IPTables to recieve Egress Packets
-        subprocess.run(setup, shell=True)
+        self.backend.iptables(setup)
         print('Set up IPTables: ' + setup)
-        # Create and run NFQ.
-        nfqueue_instance = nfq.NetFilterQueue()
-        nfqueue_instance.bind(self.queue_num, self.callback())
+        # Read the queue in batches.
         try:
-            nfqueue_instance.run()
+            self.engine.run()
+        except KeyboardInterrupt:
+            pass
         finally:
-            subprocess.run(teardown, shell=True)
+            self.backend.iptables(teardown)
             print('\nTore down IPTables: ' + teardown + '\n')
             
-    def callback(self, packet):
-        """The callback called by IPTables for each egress packet."""
-        # Parse packet
-        ip_packet = IPPacket(packet.get_payload())
-        tcp_packet = ip_packet.get_payload()
-        logging.getLogger('defnd.egress').debug(unicode(ip_packet))
-
-        # Accept non-TCP packets.
-        if type(tcp_packet) is not TCPPacket:
+    def handle_batch(self, packets):
+        """Report a batch of egress packets to the connection tracker, in one
+        message, then accept them (see receiver)."""
+        reports = []
+        accepted = []
+        accountant = self.accountant
+        log = logging.getLogger('defnd.egress')
+        for packet in packets:
+            if accountant is not None:
+                accountant.add(packet.get_payload())
+            trace = latency.tracer.start()
+            if trace is not None:
+                # Keep the reports in order.
+                if reports:
+                    self.mp_queue.put(reports)
+                    reports = []
+                self.traced_callback(packet, trace)
+                continue
+            accepted.append(packet)
+            ip_packet = IPPacket(packet.get_payload())
+            tcp_packet = ip_packet.get_payload()
+            log.debug(str(ip_packet))
+            if type(tcp_packet) is TCPPacket:
+                reports.append((to_tuple(ip_packet, flip=True),
+                                bool(tcp_packet.flag_syn),
+                                bool(tcp_packet.flag_ack),
+                                bool(tcp_packet.flag_fin)))
+        if reports:
+            self.mp_queue.put(reports)
+        for packet in accepted:
             packet.accept()
-            return
+        if accountant is not None:
+            accountant.flush()
 
-        # Send the packet to the connection tracker.
-        tup = to_tuple(ip_packet, flip=True)
-        self.mp_queue.put((tup, bool(tcp_packet.flag_syn),
-                           bool(tcp_packet.flag_ack),
-                           bool(tcp_packet.flag_fin)))
-        packet.accept()
\ No newline at end of file
+    def traced_callback(self, packet, trace):
+        """handle_batch() for a packet sampled by the latency tracer."""
+        trace.delivery(packet)
+        ip_packet = IPPacket(packet.get_payload())
+        tcp_packet = ip_packet.get_payload()
+        trace.mark('parse')
+        if type(tcp_packet) is TCPPacket:
+            tup = to_tuple(ip_packet, flip=True)
+            self.mp_queue.put((tup, bool(tcp_packet.flag_syn),
+                               bool(tcp_packet.flag_ack),
+                               bool(tcp_packet.flag_fin)))
+            trace.mark('queue_put')
+        packet.accept()
+        trace.mark('verdict')
+        trace.finish()
@@ -0,0 +1,15 @@
+"""Unit tests, run from the top of the repository with:
+
+    python -m unittest
+
+The modules of src/ import each other by their plain names, as when run
+from there, so src/ is put on the path first.
+
+"""
+import os
+import sys
+
+_TOP = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for _path in (_TOP, os.path.join(_TOP, 'src')):
+    if _path not in sys.path:
+        sys.path.insert(0, _path)
@@ -0,0 +1,142 @@
+import random
+import struct
+import threading
+import unittest
+
+import accounting
+
+
+def _packet(source, length=60, dst_port=80):
+    """A raw IPv4/UDP packet from a source address."""
+    ip = struct.pack('!BBHHHBBH4s4s', 0x45, 0, length, 0, 0, 64, 17, 0,
+                     bytes(source), bytes([192, 0, 2, 1]))
+    udp = struct.pack('!HHHH', 1234, dst_port, length - 20, 0)
+    return ip + udp + bytes(length - 28)
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class CountMinSketchTest(unittest.TestCase):
+
+    def test_never_underestimates(self):
+        sketch = accounting.CountMinSketch(64, 4)
+        counts = {}
+        rng = random.Random(1)
+        for _ in range(5000):
+            key = rng.randrange(500)
+            counts[key] = counts.get(key, 0) + 1
+            sketch.add(sketch.indexes(key), 1)
+        total = sum(counts.values())
+        for key, count in counts.items():
+            estimate = sketch.estimate(sketch.indexes(key))
+            self.assertGreaterEqual(estimate, count)
+            self.assertLessEqual(estimate, count + total)
+
+    def test_clear(self):
+        sketch = accounting.CountMinSketch(16, 2)
+        sketch.add(sketch.indexes(b'key'), 5)
+        sketch.clear()
+        self.assertEqual(sketch.estimate(sketch.indexes(b'key')), 0)
+
+
+class TopKTest(unittest.TestCase):
+
+    def test_keeps_largest(self):
+        top = accounting.TopK(3)
+        for key, count in [('a', 1), ('b', 5), ('c', 3), ('d', 4), ('e', 2)]:
+            top.offer(key, count)
+        self.assertEqual(sorted(top.counts), ['b', 'c', 'd'])
+
+    def test_growing_key_stays(self):
+        top = accounting.TopK(2)
+        top.offer('a', 1)
+        top.offer('b', 2)
+        top.offer('c', 3)
+        top.offer('b', 10)
+        top.offer('d', 4)
+        self.assertEqual(sorted(top.counts), ['b', 'd'])
+
+
+class AccountantTest(unittest.TestCase):
+
+    def accountant(self, **options):
+        self.clock = Clock()
+        return accounting.Accountant(['src', 'dst_port'], width=256,
+                                     clock=self.clock, **options)
+
+    def test_top_talkers(self):
+        accountant = self.accountant(top=4)
+        for n in range(1, 9):
+            for _ in range(n):
+                accountant.add(_packet([10, 0, 0, n], length=100))
+        accountant.flush()
+        result = accountant.query('src', metric='packets', n=3)
+        self.assertEqual(result['top']['src'],
+                         [['10.0.0.8', 8, 800], ['10.0.0.7', 7, 700],
+                          ['10.0.0.6', 6, 600]])
+
+    def test_window_rotation(self):
+        accountant = self.accountant(window=10)
+        accountant.add(_packet([10, 0, 0, 1]))
+        accountant.flush()
+        self.clock.now = 11
+        accountant.add(_packet([10, 0, 0, 2]))
+        accountant.flush()
+        self.assertEqual(accountant.windows, 1)
+        self.assertEqual([key for key, _, _ in accountant.top('src')],
+                         [bytes([10, 0, 0, 2])])
+        self.assertEqual([key for key, _, _ in
+                          accountant.top('src', window='previous')],
+                         [bytes([10, 0, 0, 1])])
+
+    def test_bad_query(self):
+        accountant = self.accountant()
+        for args in [('flow',), ('src', 'frames'), ('src', 'bytes', 10, 'x')]:
+            with self.assertRaises(ValueError):
+                accountant.top(*args)
+
+    def test_query_while_counting(self):
+        # The control thread queries while the packet thread changes the
+        # top-K tables.
+        accountant = self.accountant(top=32)
+        done = threading.Event()
+        errors = []
+
+        def count():
+            rng = random.Random(2)
+            while not done.is_set():
+                for _ in range(64):
+                    accountant.add(_packet([10, rng.randrange(256),
+                                            rng.randrange(256), 1]))
+                accountant.flush()
+
+        counter = threading.Thread(target=count)
+        counter.start()
+        try:
+            for _ in range(2000):
+                try:
+                    accountant.query('src', n=32)
+                except RuntimeError as error:
+                    errors.append(error)
+                    break
+        finally:
+            done.set()
+            counter.join()
+        self.assertEqual(errors, [])
+
+
+class SettingsTest(unittest.TestCase):
+
+    def test_defaults_and_errors(self):
+        self.assertEqual(accounting.settings({})['top'], 64)
+        with self.assertRaises(ValueError):
+            accounting.settings({'widht': 1})
+        with self.assertRaises(ValueError):
+            accounting.settings({'ingress': ['nope']})
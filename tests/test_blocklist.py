@@ -0,0 +1,117 @@
+import os
+import random
+import shutil
+import struct
+import tempfile
+import unittest
+
+import blocklist
+from packets import IPPacket
+from rules.ip_rules import BlocklistRule
+
+
+def _address(text):
+    return blocklist._address(text)
+
+
+class BlocklistTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.feed = os.path.join(self.directory, 'feed.txt')
+        self.filename = os.path.join(self.directory, 'feed.dfbl')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def compile(self, lines):
+        with open(self.feed, 'w') as feed:
+            feed.write('\n'.join(lines) + '\n')
+        return blocklist.compile_feed(self.feed, self.filename)
+
+    def test_parse_entry(self):
+        self.assertEqual(blocklist.parse_entry('10.0.0.1'),
+                         (_address('10.0.0.1'), _address('10.0.0.1')))
+        self.assertEqual(blocklist.parse_entry('10.0.0.77/24'),
+                         (_address('10.0.0.0'), _address('10.0.0.255')))
+        self.assertEqual(blocklist.parse_entry('0.0.0.0/0'),
+                         (0, 0xffffffff))
+        self.assertEqual(blocklist.parse_entry('10.0.0.5 - 10.0.0.9'),
+                         (_address('10.0.0.5'), _address('10.0.0.9')))
+        for entry in ('10.0.0.0/33', '10.0.0.9-10.0.0.5'):
+            with self.assertRaises(ValueError):
+                blocklist.parse_entry(entry)
+
+    def test_merge(self):
+        self.assertEqual(blocklist.merge([(5, 9), (1, 3), (4, 4), (20, 30),
+                                          (25, 26), (11, 12)]),
+                         [[1, 9], [11, 12], [20, 30]])
+
+    def test_compile_and_lookup(self):
+        intervals, skipped = self.compile([
+            '# a comment', '', '192.0.2.1', '198.51.100.0/24 ; spammers',
+            '203.0.113.10-203.0.113.20 extra tokens', '2001:db8::1',
+            '198.51.101.0/24', 'not an address'])
+        self.assertEqual((intervals, skipped), (3, 2))
+        blocked = blocklist.Blocklist(self.filename)
+        self.assertEqual(len(blocked), 3)
+        for text in ('192.0.2.1', '198.51.100.0', '198.51.101.255',
+                     '203.0.113.10', '203.0.113.20'):
+            self.assertIn(_address(text), blocked, text)
+        for text in ('192.0.2.0', '192.0.2.2', '198.51.102.0',
+                     '203.0.113.9', '203.0.113.21', '0.0.0.0',
+                     '255.255.255.255'):
+            self.assertNotIn(_address(text), blocked, text)
+
+    def test_lookup_matches_brute_force(self):
+        rng = random.Random(5)
+        intervals = []
+        for _ in range(500):
+            start = rng.randrange(1 << 20)
+            intervals.append((start, start + rng.randrange(64)))
+        blocklist.write_blocklist(self.filename,
+                                  blocklist.merge(list(intervals)))
+        blocked = blocklist.Blocklist(self.filename)
+        for _ in range(5000):
+            address = rng.randrange(1 << 20)
+            expected = any(start <= address <= end
+                           for start, end in intervals)
+            self.assertEqual(address in blocked, expected)
+
+    def test_empty(self):
+        self.compile(['# nothing'])
+        self.assertNotIn(0, blocklist.Blocklist(self.filename))
+
+    def test_reload(self):
+        self.compile(['10.0.0.1'])
+        blocked = blocklist.Blocklist(self.filename, check_interval=0)
+        self.assertIn(_address('10.0.0.1'), blocked)
+        self.compile(['10.0.0.2'])
+        self.assertNotIn(_address('10.0.0.1'), blocked)
+        self.assertIn(_address('10.0.0.2'), blocked)
+
+    def test_bad_replacement_keeps_previous(self):
+        self.compile(['10.0.0.1'])
+        blocked = blocklist.Blocklist(self.filename, check_interval=0)
+        with open(self.filename + '.new', 'wb') as bad:
+            bad.write(b'garbage')
+        os.replace(self.filename + '.new', self.filename)
+        with self.assertLogs('defnd.blocklist', 'WARNING'):
+            self.assertIn(_address('10.0.0.1'), blocked)
+        with self.assertRaises((ValueError, struct.error)):
+            blocklist.Blocklist(self.filename)
+
+    def test_rule(self):
+        self.compile(['10.0.0.0/24'])
+        rule = BlocklistRule(path=self.filename, direction='dst',
+                             action='DROP')
+
+        def packet(src, dst):
+            return IPPacket(struct.pack('!BBHHHBBH4s4s', 0x45, 0, 20, 0, 0,
+                                        64, 1, 0, bytes(src), bytes(dst)))
+
+        self.assertEqual(rule(packet([192, 0, 2, 1], [10, 0, 0, 7])),
+                         'DROP')
+        self.assertFalse(rule(packet([10, 0, 0, 7], [192, 0, 2, 1])))
+        with self.assertRaises(ValueError):
+            BlocklistRule(path=self.filename, direction='up')
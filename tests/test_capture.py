@@ -0,0 +1,125 @@
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from defnd import DefNd
+from packets import IPPacket
+from rules import capture_rule
+import pcap
+
+
+def _packet(source, length=60):
+    """A raw IPv4/UDP packet of the given length."""
+    ip = struct.pack('!BBHHHBBH4s4s', 0x45, 0, length, 0, 0, 64, 17, 0,
+                     bytes(source), bytes([192, 0, 2, 1]))
+    udp = struct.pack('!HHHH', 1234, 53, length - 20, 0)
+    return ip + udp + bytes(length - 28)
+
+
+class PcapTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'out.pcap')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_round_trip(self):
+        records = [(1000.5, 60, _packet([10, 0, 0, 1])),
+                   (1001.25, 1500, _packet([10, 0, 0, 2])[:40])]
+        pcap.write_pcap(self.filename, records)
+        read = list(pcap.read_pcap(self.filename))
+        self.assertEqual([data for _, data in read],
+                         [data for _, _, data in records])
+        self.assertAlmostEqual(read[0][0], 1000.5, places=5)
+        self.assertAlmostEqual(read[1][0], 1001.25, places=5)
+        self.assertEqual(os.listdir(self.directory), ['out.pcap'])
+
+    def test_failed_write_leaves_no_file(self):
+        with self.assertRaises(TypeError):
+            pcap.write_pcap(self.filename, [(0.0, 60, None)])
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_concurrent_writers(self):
+        records = [(0.0, 60, _packet([10, 0, 0, n])) for n in range(50)]
+        writers = [threading.Thread(target=pcap.write_pcap,
+                                    args=(self.filename, records))
+                   for _ in range(8)]
+        for writer in writers:
+            writer.start()
+        for writer in writers:
+            writer.join()
+        self.assertEqual(len(list(pcap.read_pcap(self.filename))), 50)
+        self.assertEqual(os.listdir(self.directory), ['out.pcap'])
+
+
+class CaptureRuleTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(self.directory)
+        self.addCleanup(capture_rule._captures.clear)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.directory)
+
+    def test_ring_keeps_last_slots(self):
+        rule = capture_rule.CaptureRule(slots=4, snaplen=40)
+        for n in range(10):
+            self.assertFalse(rule(IPPacket(_packet([10, 0, 0, n]))))
+        records = rule.records(rule.snapshot())
+        self.assertEqual([data[15] for _, _, data in records], [6, 7, 8, 9])
+        self.assertEqual([len(data) for _, _, data in records], [40] * 4)
+        self.assertEqual([orig_len for _, orig_len, _ in records], [60] * 4)
+
+    def test_sampling_and_filter(self):
+        rule = capture_rule.CaptureRule(sample_rate=2, src_ip='10.0.0.0/30')
+        for n in range(8):
+            rule(IPPacket(_packet([10, 0, 0, n])))
+        records = rule.records(rule.snapshot())
+        self.assertEqual([data[15] for _, _, data in records], [1, 3])
+
+    def test_default_filename_from_place(self):
+        the_wall = DefNd(None, None)
+        the_wall.add_chain('OTHER')
+        first = capture_rule.CaptureRule()
+        second = capture_rule.CaptureRule()
+        named = capture_rule.CaptureRule(filename='mine.pcap')
+        the_wall.add_rule('INPUT', first)
+        the_wall.add_rule('INPUT', second)
+        the_wall.add_rule('OTHER', named)
+        self.assertEqual(first.filename, 'defnd-capture-INPUT-0.pcap')
+        self.assertEqual(second.filename, 'defnd-capture-INPUT-1.pcap')
+        self.assertEqual(named.filename, 'mine.pcap')
+
+    def test_flush_all_with_shared_filename(self):
+        rules = [capture_rule.CaptureRule(filename='shared.pcap')
+                 for _ in range(4)]
+        for n, rule in enumerate(rules):
+            rule(IPPacket(_packet([10, 0, 0, n])))
+        for writer in capture_rule.flush_all():
+            writer.join()
+        self.assertEqual(len(list(pcap.read_pcap('shared.pcap'))), 1)
+        self.assertEqual(os.listdir('.'), ['shared.pcap'])
+
+    def test_flush_command(self):
+        the_wall = DefNd(None, None)
+        for _ in range(2):
+            the_wall.add_rule('INPUT', capture_rule.CaptureRule())
+        names = ['defnd-capture-INPUT-0.pcap', 'defnd-capture-INPUT-1.pcap']
+        writers = []
+        flush_all = capture_rule.flush_all
+        with mock.patch.object(capture_rule, 'flush_all',
+                               lambda: writers.extend(flush_all())):
+            self.assertEqual(capture_rule._flush_command(),
+                             {'flushed': names})
+        for writer in writers:
+            writer.join()
+        self.assertEqual(sorted(os.listdir('.')), names)
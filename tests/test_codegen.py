@@ -0,0 +1,111 @@
+import contextlib
+import io
+import random
+import struct
+import unittest
+
+import codegen
+from packets import IPPacket
+from rules.ip_rules import DestinationIPRule, SourceIPRule
+from rules.port_filter import PortRangeRule, PortRule, PortSetRule
+from rules.port_ip_rule import IPPortRule
+from rules.tcp_rules import TCPRule
+
+
+def _packet(rng):
+    """A random TCP, UDP or ICMP packet between 10.0.0.0/24 addresses."""
+    proto = rng.choice([6, 17, 1])
+    ip = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 40, 0, 0, 64, proto, 0,
+                     bytes([10, 0, 0, rng.randrange(256)]),
+                     bytes([10, 0, 0, rng.randrange(256)]))
+    ports = [rng.choice([22, 53, 80, 443, 8080, 65535, rng.randrange(65536)])
+             for _ in range(2)]
+    if proto == 6:
+        transport = struct.pack('!HHIIBBHHH', ports[0], ports[1], 0, 0,
+                                0x50, 0x02, 0, 0, 0)
+    elif proto == 17:
+        transport = struct.pack('!HHHH', ports[0], ports[1], 20, 0) + \
+            bytes(12)
+    else:
+        transport = bytes(20)
+    return IPPacket(ip + transport)
+
+
+class _NoPorts(object):
+    """A TCP packet whose transport header could not be parsed."""
+
+    buf = bytes([0x45]) + bytes(8) + bytes([6]) + bytes(10)
+
+    def get_protocol(self):
+        return 6
+
+    def get_payload(self):
+        return None
+
+    def get_src_ip(self):
+        return '0.0.0.0'
+
+    def get_dst_ip(self):
+        return '0.0.0.0'
+
+
+class _CustomPortRule(PortRule):
+    """A subclass, which is called rather than inlined."""
+
+
+def _chain():
+    return [
+        PortRule(protocol='TCP', dst_port=22, action='ACCEPT'),
+        PortSetRule(protocol=['TCP', 'UDP'], dst_ports=['ephemeral'],
+                    action='DROP'),
+        PortSetRule(protocol='UDP', src_ports={'UDP': [53, '1000-2000']},
+                    dst_ports=[8080], action='ACCEPT'),
+        PortRangeRule(protocol='UDP', src_lo=50, src_hi=60, action='DROP'),
+        IPPortRule(protocol='TCP', dst_lo=80, dst_hi=443,
+                   src_ip='10.0.0.0/26', action='ACCEPT'),
+        SourceIPRule(cidr_range='10.0.0.128/27', action='DROP'),
+        DestinationIPRule(cidr_range='10.0.0.64/30', action='ACCEPT'),
+        _CustomPortRule(protocol='TCP', src_port=443, action='DROP'),
+        TCPRule(action='OTHER'),
+    ]
+
+
+def _interpreted(rules, packet):
+    for rule in rules:
+        result = rule(packet)
+        if result:
+            return result
+    return False
+
+
+class CodegenTest(unittest.TestCase):
+
+    def test_inlines_builtin_rules(self):
+        source, _ = codegen.generate_chain('INPUT', _chain())
+        self.assertIn('8 of 9 rules inlined', source)
+
+    def test_same_verdicts_as_interpreted(self):
+        rules = _chain()
+        chain = codegen.compile_chain('INPUT', rules)
+        rng = random.Random(3)
+        packets = [_packet(rng) for _ in range(5000)] + [_NoPorts()]
+        for packet in packets:
+            compiled_out, interpreted_out = io.StringIO(), io.StringIO()
+            with contextlib.redirect_stdout(compiled_out):
+                compiled = chain(packet)
+            with contextlib.redirect_stdout(interpreted_out):
+                interpreted = _interpreted(rules, packet)
+            self.assertEqual(compiled, interpreted)
+            self.assertEqual(compiled_out.getvalue(),
+                             interpreted_out.getvalue())
+
+    def test_no_ports_does_not_match_port_65535(self):
+        rules = [PortSetRule(protocol='TCP', src_ports=[65535],
+                             action='DROP')]
+        chain = codegen.compile_chain('INPUT', rules)
+        self.assertFalse(chain(_NoPorts()))
+        self.assertFalse(_interpreted(rules, _NoPorts()))
+
+    def test_chain_name_is_quoted(self):
+        source, _ = codegen.generate_chain("it's", [TCPRule(action='DROP')])
+        compile(source, '<test>', 'exec')
@@ -0,0 +1,124 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import config
+import rules
+from rules import capture_rule
+
+
+class CompiledConfigTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.addCleanup(capture_rule._captures.clear)
+        self.patterns = self.path('patterns.txt')
+        self.write(self.patterns, 'evil\n')
+        self.filename = self.path('defnd.json')
+        self.write_config(dst_port=22)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def write(self, filename, text):
+        with open(filename, 'w') as out:
+            out.write(text)
+
+    def write_config(self, dst_port):
+        self.write(self.filename, json.dumps({
+            'INPUT': [
+                {'name': 'PortRule', 'protocol': 'TCP', 'dst_port': dst_port,
+                 'action': 'ACCEPT'},
+                {'name': 'CaptureRule', 'filename': self.path('c.pcap')},
+                {'name': 'ContentMatchRule',
+                 'patterns_file': self.patterns},
+            ],
+            'default_chain': 'DROP',
+        }))
+
+    def load_stale(self):
+        """Load the compiled configuration, expecting it to be ignored, and
+        return the warning."""
+        with self.assertLogs('defnd.config', 'WARNING') as logs:
+            self.assertIsNone(
+                config.defndConfig(self.filename).load_compiled())
+        return logs.output[0]
+
+    def test_compile_and_load(self):
+        cfg = config.defndConfig(self.filename)
+        self.assertEqual(cfg.compile(), (2, 3))
+        with self.assertNoLogs('defnd.config'):
+            chains = config.defndConfig(self.filename).load_compiled()
+        port_rule, capture, content = chains['INPUT']
+        self.assertEqual(type(port_rule).__name__, 'PortRule')
+        self.assertEqual(port_rule._dst_port, 22)
+        # Not cacheable: built again on load.
+        self.assertIsNone(capture)
+        self.assertEqual(content.inputs(), [self.patterns])
+
+    def test_create_defnd_uses_compiled_rules(self):
+        cfg = config.defndConfig(self.filename)
+        cfg.compile()
+        chains = cfg.load_compiled()
+        the_wall = config.defndConfig(self.filename).create_defnd(None, None)
+        rules_built = the_wall.chains['INPUT']
+        self.assertEqual([type(rule).__name__ for rule in rules_built],
+                         ['PortRule', 'CaptureRule', 'ContentMatchRule'])
+        self.assertEqual(rules_built[0]._dst_port,
+                         chains['INPUT'][0]._dst_port)
+        self.assertEqual(rules_built[1].filename, self.path('c.pcap'))
+
+    def test_stale_after_config_change(self):
+        config.defndConfig(self.filename).compile()
+        self.write_config(dst_port=23)
+        self.assertIn('is older than %s' % self.filename, self.load_stale())
+
+    def test_stale_after_input_change(self):
+        config.defndConfig(self.filename).compile()
+        self.write(self.patterns, 'worse\n')
+        self.assertIn('is older than %s' % self.patterns, self.load_stale())
+
+    def test_stale_after_module_change(self):
+        cfg = config.defndConfig(self.filename)
+        module = self.path('module.py')
+        self.write(module, 'x = 1\n')
+        header = {'format': config.COMPILED_FORMAT,
+                  'python': tuple(config.sys.version_info[:2]),
+                  'config': cfg.digest,
+                  'sources': {'module': (module, config._digest(module))},
+                  'inputs': {}}
+        self.assertIsNone(cfg._stale(header))
+        self.write(module, 'x = 2\n')
+        self.assertEqual(cfg._stale(header), 'is older than module module')
+        header['python'] = (2, 7)
+        self.assertEqual(cfg._stale(header), 'was written by another version')
+
+    def test_unreadable(self):
+        self.write(self.filename + config.COMPILED_SUFFIX, 'not a pickle')
+        self.assertIn('could not be read', self.load_stale())
+
+    def test_missing(self):
+        self.assertIsNone(config.defndConfig(self.filename).load_compiled())
+
+    def test_unknown_chain_target(self):
+        self.write(self.filename, json.dumps({
+            'INPUT': [{'name': 'TCPRule', 'action': 'NOWHERE'}]}))
+        with self.assertRaises(ValueError):
+            config.defndConfig(self.filename).compile()
+
+
+class RuleDiscoveryTest(unittest.TestCase):
+
+    def test_index(self):
+        index = rules.module_index()
+        self.assertEqual(index['PortSetRule'], 'port_filter')
+        self.assertEqual(index['ContentMatchRule'], 'content_match')
+        self.assertNotIn('Rule', index)
+
+    def test_get_rule(self):
+        self.assertEqual(rules.get_rule('TCPRule').__name__, 'TCPRule')
+        with self.assertRaises(ValueError):
+            rules.get_rule('NoSuchRule')
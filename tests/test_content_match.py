@@ -0,0 +1,109 @@
+import os
+import random
+import struct
+import tempfile
+import unittest
+
+from packets import IPPacket
+from rules.content_match import Automaton, ContentMatchRule, parse_pattern
+
+
+def _packet(proto, body):
+    ip = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 40 + len(body), 0, 0, 64,
+                     proto, 0, bytes([10, 0, 0, 1]), bytes([192, 0, 2, 1]))
+    if proto == 6:
+        transport = struct.pack('!HHIIBBHHH', 1234, 80, 0, 0, 0x50, 0x18,
+                                0, 0, 0)
+    else:
+        transport = struct.pack('!HHHH', 1234, 53, 8 + len(body), 0) + \
+            bytes(12)
+    return IPPacket(ip + transport + body)
+
+
+class AutomatonTest(unittest.TestCase):
+
+    def check(self, automaton, data):
+        found = automaton.search(data)
+        expected = any(pattern in data for pattern in automaton.patterns)
+        self.assertEqual(found >= 0, expected, data)
+        if found >= 0:
+            self.assertIn(automaton.patterns[found], data)
+
+    def test_overlapping_patterns(self):
+        automaton = Automaton([b'he', b'she', b'his', b'hers'])
+        for data in (b'ushers', b'xhix', b'hi', b'h', b'', b'ahishers'):
+            self.check(automaton, data)
+        self.assertEqual(automaton.search(b'ahis'), 2)
+
+    def test_failure_link_to_suffix(self):
+        # After "abcd" fails at "x", "bcd" must still be followed.
+        automaton = Automaton([b'abcdy', b'bcdx'])
+        self.assertEqual(automaton.search(b'abcdx'), 1)
+
+    def test_random_against_brute_force(self):
+        rng = random.Random(6)
+        for fanout in (3, 256):
+            # With few distinct first bytes the skip-ahead search is used.
+            alphabet = bytes(range(fanout))
+            patterns = [bytes(rng.choice(alphabet)
+                              for _ in range(rng.randrange(1, 6)))
+                        for _ in range(40)]
+            automaton = Automaton(patterns)
+            self.assertEqual(automaton._skip is not None, fanout == 3)
+            for _ in range(500):
+                data = bytes(rng.choice(alphabet + b'xyz')
+                             for _ in range(rng.randrange(30)))
+                self.check(automaton, data)
+
+    def test_nocase(self):
+        automaton = Automaton([b'Select', b'union'], nocase=True)
+        self.assertEqual(automaton.search(b'1 UNION all'), 1)
+        self.assertEqual(automaton.search(b'sElEcT *'), 0)
+        self.assertEqual(Automaton([b'union']).search(b'UNION'), -1)
+
+    def test_memoryview(self):
+        automaton = Automaton([b'needle'])
+        data = memoryview(b'haystack needle haystack')
+        self.assertEqual(automaton.search(data[9:]), 0)
+        self.assertEqual(automaton.search(data[10:]), -1)
+
+
+class ContentMatchRuleTest(unittest.TestCase):
+
+    def test_parse_pattern(self):
+        self.assertEqual(parse_pattern('GET /|2e 2e|/'), b'GET /../')
+        self.assertEqual(parse_pattern('|00|a|FF|'), b'\x00a\xff')
+        with self.assertRaises(ValueError):
+            parse_pattern('')
+
+    def test_protocols(self):
+        rule = ContentMatchRule(patterns=['evil'], protocol='UDP')
+        self.assertEqual(rule(_packet(17, b'an evil query')), 'DROP')
+        self.assertFalse(rule(_packet(6, b'an evil query')))
+        self.assertFalse(rule(_packet(17, b'a good query')))
+
+    def test_offset_and_depth(self):
+        rule = ContentMatchRule(patterns=['abc'], offset=2, depth=5,
+                                action='ACCEPT')
+        self.assertEqual(rule(_packet(6, b'xxabcxx')), 'ACCEPT')
+        self.assertFalse(rule(_packet(6, b'xabcxxx')))
+        self.assertFalse(rule(_packet(6, b'xxxxxabc')))
+
+    def test_patterns_file(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.txt',
+                                         delete=False) as patterns_file:
+            patterns_file.write('# signatures\n\n/etc/passwd\n|de ad|\n')
+        self.addCleanup(os.unlink, patterns_file.name)
+        rule = ContentMatchRule(patterns=['cmd.exe'],
+                                patterns_file=patterns_file.name)
+        self.assertEqual(rule.inputs(), [patterns_file.name])
+        for body in (b'GET /etc/passwd', b'\x00\xde\xad', b'cmd.exe'):
+            self.assertEqual(rule(_packet(6, body)), 'DROP', body)
+        self.assertFalse(rule(_packet(6, b'# signatures')))
+
+    def test_invalid(self):
+        for kwargs in [{}, dict(patterns=['a'], protocol='ICMP'),
+                       dict(patterns=['a'], offset=-1),
+                       dict(patterns=['a'], depth=-1)]:
+            with self.assertRaises(ValueError, msg=kwargs):
+                ContentMatchRule(**kwargs)
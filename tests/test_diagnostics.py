@@ -0,0 +1,108 @@
+import os
+import queue
+import shutil
+import tempfile
+import tracemalloc
+import unittest
+
+import control
+import diagnostics
+from defnd import DefNd
+from rules.port_filter import PortSetRule
+
+
+class EstimateTest(unittest.TestCase):
+
+    def test_containers(self):
+        table = dict((n, ('10.0.0.1', n)) for n in range(1000))
+        entries, size = diagnostics.estimate(table)
+        self.assertEqual(entries, 1000)
+        self.assertGreater(size, 1000 * 64)
+        self.assertEqual(diagnostics.estimate([])[0], 0)
+        self.assertEqual(diagnostics.estimate(bytearray(100))[0], 100)
+        backlog = queue.Queue()
+        backlog.put(1)
+        self.assertEqual(diagnostics.estimate(backlog), (1, None))
+
+    def test_memory(self):
+        self.addCleanup(diagnostics.subsystems.pop, 'test.table', None)
+        self.addCleanup(diagnostics.subsystems.pop, 'test.lazy', None)
+        diagnostics.register_subsystem('test.table', {1: 2})
+        diagnostics.register_subsystem('test.lazy', lambda: [1, 2, 3])
+        diagnostics.register_subsystem('test.none', None)
+        report = diagnostics.memory()
+        self.assertEqual(report['subsystems']['test.table']['entries'], 1)
+        self.assertEqual(report['subsystems']['test.lazy']['entries'], 3)
+        self.assertNotIn('test.none', report['subsystems'])
+
+    def test_rule_containers(self):
+        name = 'rules.INPUT[0].Stateful.seen'
+        self.addCleanup(diagnostics.subsystems.pop, name, None)
+        self.addCleanup(diagnostics.subsystems.pop, 'defnd.ingress_queue',
+                        None)
+        the_wall = DefNd(None, None)
+
+        class Stateful(PortSetRule):
+            def containers(self):
+                return {'seen': {}}
+
+        the_wall.add_rule('INPUT', Stateful(protocol='TCP', dst_ports=[1]))
+        the_wall.register_diagnostics()
+        self.assertIn(name, diagnostics.subsystems)
+
+    def test_tracemalloc(self):
+        self.addCleanup(tracemalloc.stop)
+        with self.assertRaises(ValueError):
+            diagnostics.trace('snapshot')
+        self.assertEqual(diagnostics.trace('start'), {'tracing': True})
+        self.assertIn('top', diagnostics.trace('snapshot', limit=5))
+        keep = [bytearray(1000) for _ in range(100)]
+        diff = diagnostics.trace('diff', limit=5)
+        self.assertLessEqual(len(diff['diff']), 5)
+        del keep
+        self.assertEqual(diagnostics.trace('stop'), {'tracing': False})
+
+
+class ControlServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.server = control.start_server(self.directory, 'test')
+        self.path = os.path.join(self.directory, 'test.sock')
+
+        def countdown(n):
+            for value in range(int(n), 0, -1):
+                yield value
+
+        control.register_command('test_add', lambda a, b: a + b)
+        control.register_command('test_countdown', countdown)
+        self.addCleanup(control.commands.pop, 'test_add')
+        self.addCleanup(control.commands.pop, 'test_countdown')
+
+    def test_no_directory(self):
+        self.assertIsNone(control.start_server(None, 'test'))
+
+    def test_result(self):
+        self.assertEqual(list(control.request(self.path, 'test_add', a=2,
+                                              b=3)),
+                         [{'ok': True, 'result': 5}])
+        self.assertIn('test_add',
+                      list(control.request(self.path, 'help'))[0]['result'])
+
+    def test_stream(self):
+        replies = list(control.request(self.path, 'test_countdown', n=3))
+        self.assertEqual([reply.get('chunk') for reply in replies[:-1]],
+                         [3, 2, 1])
+        self.assertEqual(replies[-1], {'ok': True, 'end': True})
+
+    def test_errors(self):
+        for command, args in (('nope', {}), ('test_add', {'a': 1})):
+            reply, = control.request(self.path, command, **args)
+            self.assertFalse(reply['ok'])
+            self.assertIn('Error', reply['error'])
+
+    def test_parse_value(self):
+        self.assertEqual(control._parse_value('3'), 3)
+        self.assertEqual(control._parse_value('true'), True)
+        self.assertEqual(control._parse_value('web'), 'web')
@@ -0,0 +1,148 @@
+import queue
+import unittest
+
+import connection
+import flows
+
+
+def _tuple(n):
+    return ('10.%d.%d.%d' % (n >> 16 & 255, n >> 8 & 255, n & 255),
+            1024 + n % 60000, '192.0.2.1', 80)
+
+
+class CountingFilter(object):
+    """Matches every entry, counting the calls."""
+
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, tup, state):
+        self.calls += 1
+        return True
+
+
+class FlowsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tracker = connection.DefndTracker(queue.Queue(), queue.Queue(),
+                                               None)
+        self.listings = flows.Listings(self.tracker)
+
+    def fill(self, count, state='ESTABLISHED'):
+        for n in range(count):
+            self.tracker.set_state(_tuple(n), state)
+
+    def listed(self, chunks):
+        result = []
+        for chunk in chunks:
+            if chunk is not None:
+                result.extend(tuple(flow[:4]) for flow in chunk['flows'])
+        return result
+
+    def merge(self):
+        while self.tracker._merge_timeout() is not None:
+            self.tracker._merge()
+
+    def test_budget_bounds_each_step(self):
+        self.fill(200000)
+        counting = CountingFilter()
+        listing = self.listings.start(counting)
+        steps = 0
+        seen = 0
+        for chunk in flows.scan(listing, limit=10 ** 9, budget=1000,
+                                chunk=500):
+            steps += 1
+            self.assertLessEqual(counting.calls - seen, 1000)
+            seen = counting.calls
+        self.assertEqual(counting.calls, 200000)
+        self.assertEqual(steps, 201)
+        self.assertEqual(self.listings.open, {})
+
+    def test_filters(self):
+        self.fill(100)
+        self.tracker.set_state(_tuple(7), 'SYN_RCVD1')
+        listing = self.listings.start(flows.FlowFilter(state='SYN_*'))
+        self.assertEqual(self.listed(flows.scan(listing)), [_tuple(7)])
+        listing = self.listings.start(flows.FlowFilter(
+            remote_cidr='10.0.0.0/28', local_port=80))
+        self.assertEqual(sorted(self.listed(flows.scan(listing))),
+                         sorted(_tuple(n) for n in range(16)))
+
+    def test_listing_survives_changes(self):
+        self.fill(5000)
+        listing = self.listings.start(flows.FlowFilter())
+        listed = []
+        opened = 5000
+        for step, chunk in enumerate(flows.scan(listing, limit=10 ** 9,
+                                                budget=100, chunk=50)):
+            if chunk is not None:
+                listed.extend(tuple(flow[:4]) for flow in chunk['flows'])
+            # Close some of the first thousand, open new ones.
+            self.tracker.set_state(_tuple(step), 'CLOSED')
+            for _ in range(3):
+                self.tracker.set_state(_tuple(opened), 'ESTABLISHED')
+                opened += 1
+        kept = set(_tuple(n) for n in range(step + 1, 5000))
+        self.assertTrue(kept <= set(listed))
+        self.assertEqual(len(listed), len(set(listed)))
+        self.assertFalse(set(listed) - set(_tuple(n) for n in range(5000)))
+        self.merge()
+        live = set(_tuple(n) for n in range(step + 1, opened))
+        self.assertEqual(set(self.tracker.connections), live)
+        self.assertEqual(self.tracker.stats()['connections'], len(live))
+        self.assertIsNone(self.tracker.added)
+
+    def test_state_while_frozen(self):
+        self.fill(3)
+        self.tracker.freeze()
+        self.tracker.set_state(_tuple(0), 'CLOSED')
+        self.tracker.set_state(_tuple(5), 'SYN_SENT1')
+        self.assertEqual(len(self.tracker.connections), 3)
+        self.assertEqual(self.tracker.state_of(_tuple(0), 'CLOSED'),
+                         'CLOSED')
+        self.assertEqual(self.tracker.state_of(_tuple(5), 'CLOSED'),
+                         'SYN_SENT1')
+        self.tracker.set_state(_tuple(0), 'SYN_SENT1')
+        self.assertEqual(sorted(self.tracker.items()),
+                         sorted([(_tuple(0), 'SYN_SENT1'),
+                                 (_tuple(1), 'ESTABLISHED'),
+                                 (_tuple(2), 'ESTABLISHED'),
+                                 (_tuple(5), 'SYN_SENT1')]))
+        self.tracker.thaw()
+        self.merge()
+        self.assertEqual(len(self.tracker.connections), 4)
+
+    def test_pages_resume_with_the_cursor(self):
+        self.fill(2500)
+        listing = self.listings.start(flows.FlowFilter())
+        chunks = list(flows.scan(listing, limit=1000, budget=300))
+        cursor = chunks[-1]['cursor']
+        self.assertNotIn('done', chunks[-1])
+        listed = self.listed(chunks)
+        while not chunks[-1].get('done'):
+            chunks = list(flows.scan(self.listings.resume(cursor),
+                                     limit=1000, budget=300))
+            listed.extend(self.listed(chunks))
+        self.assertEqual(sorted(listed), sorted(_tuple(n)
+                                                for n in range(2500)))
+        self.assertRaises(ValueError, self.listings.resume, cursor)
+
+    def test_dropped_stream_closes_the_listing(self):
+        self.fill(1000)
+        chunks = flows.scan(self.listings.start(flows.FlowFilter()),
+                            budget=100)
+        next(chunks)
+        chunks.close()
+        self.assertEqual(self.listings.open, {})
+        self.assertEqual(self.tracker._frozen, 0)
+
+    def test_idle_listings_expire(self):
+        listing = self.listings.start(flows.FlowFilter())
+        listing.used -= flows.IDLE_TIMEOUT
+        self.listings.expire()
+        self.assertEqual(self.listings.open, {})
+        self.assertEqual(self.tracker._frozen, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
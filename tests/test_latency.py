@@ -0,0 +1,74 @@
+import random
+import unittest
+
+import latency
+
+
+class HistogramTest(unittest.TestCase):
+
+    def test_buckets_cover_every_value_once(self):
+        previous_high = -1
+        for index in range(latency._bucket(1 << 40) + 1):
+            low, high = latency._bucket_range(index)
+            self.assertEqual(low, previous_high + 1)
+            self.assertEqual(latency._bucket(low), index)
+            self.assertEqual(latency._bucket(high), index)
+            previous_high = high
+
+    def test_relative_error(self):
+        rng = random.Random(7)
+        for _ in range(10000):
+            value = rng.randrange(1 << rng.randrange(1, 50))
+            low, high = latency._bucket_range(latency._bucket(value))
+            self.assertTrue(low <= value <= high)
+            self.assertLessEqual(high - low, max(low, 1) / 32.0)
+
+    def test_percentiles(self):
+        histogram = latency.Histogram()
+        for value in range(1, 1001):
+            histogram.record(value * 1000)
+        summary = histogram.export()
+        self.assertEqual(summary['count'], 1000)
+        self.assertEqual((summary['min'], summary['max']), (1000, 1000000))
+        self.assertEqual(summary['mean'], 500500)
+        for percent, exact in ((50, 500000), (90, 900000), (99, 990000),
+                               (99.9, 999000)):
+            self.assertAlmostEqual(summary['p%s' % percent], exact,
+                                   delta=exact / 32.0)
+        self.assertLessEqual(summary['p99.9'], summary['max'])
+
+    def test_empty_and_negative(self):
+        histogram = latency.Histogram()
+        self.assertIsNone(histogram.percentile(50))
+        self.assertIsNone(histogram.export()['mean'])
+        histogram.record(-5)
+        self.assertEqual(histogram.export(buckets=True)['buckets'],
+                         [[0, 0, 1]])
+
+
+class TracerTest(unittest.TestCase):
+
+    def test_sampling(self):
+        tracer = latency.Tracer(4)
+        sampled = [tracer.start() is not None for _ in range(12)]
+        self.assertEqual(sampled, [False, False, False, True] * 3)
+        self.assertIsNone(latency.Tracer().start())
+
+    def test_stages(self):
+        tracer = latency.Tracer(1)
+        trace = tracer.start()
+        trace.mark('parse')
+        trace.mark('rules')
+        trace.finish()
+        stages = tracer.export()['stages']
+        self.assertEqual(sorted(stages), ['parse', 'rules', 'total'])
+        self.assertGreaterEqual(stages['total']['max'],
+                                stages['rules']['max'])
+        tracer.reset()
+        self.assertEqual(tracer.export()['stages'], {})
+
+    def test_command(self):
+        self.assertEqual(latency._command('reset'), {'reset': True})
+        self.assertEqual(latency._command()['stages'], {})
+        with self.assertRaises(ValueError):
+            latency._command('pause')
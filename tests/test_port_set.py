@@ -0,0 +1,93 @@
+import socket
+import struct
+import unittest
+
+from packets import IPPacket
+from rules.port_filter import PortSetRule, port_mask
+
+
+def _packet(proto, src_port, dst_port):
+    ip = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 40, 0, 0, 64, proto, 0,
+                     bytes([10, 0, 0, 1]), bytes([192, 0, 2, 1]))
+    if proto == 6:
+        transport = struct.pack('!HHIIBBHHH', src_port, dst_port, 0, 0,
+                                0x50, 0x02, 0, 0, 0)
+    else:
+        transport = struct.pack('!HHHH', src_port, dst_port, 20, 0) + \
+            bytes(12)
+    return IPPacket(ip + transport)
+
+
+class PortSetRuleTest(unittest.TestCase):
+
+    def matches(self, rule, proto, src_port, dst_port):
+        return rule(_packet(proto, src_port, dst_port)) == rule.action
+
+    def test_ports_ranges_and_groups(self):
+        rule = PortSetRule(protocol='TCP',
+                           dst_ports=[22, '1000-2000', [3000, 3001], 'web'])
+        for port in (22, 1000, 1500, 2000, 3000, 3001, 443, 8080):
+            self.assertTrue(self.matches(rule, 6, 1, port), port)
+        for port in (0, 21, 999, 2001, 2999, 3002, 65535):
+            self.assertFalse(self.matches(rule, 6, 1, port), port)
+        self.assertFalse(self.matches(rule, 17, 1, 22))
+
+    def test_range_edges(self):
+        rule = PortSetRule(protocol='UDP', src_ports=['0-7', '65528-65535'])
+        for port in (0, 7, 65528, 65535):
+            self.assertTrue(self.matches(rule, 17, port, 1), port)
+        for port in (8, 65527):
+            self.assertFalse(self.matches(rule, 17, port, 1), port)
+
+    def test_both_sides_must_match(self):
+        rule = PortSetRule(protocol='TCP', src_ports=['ephemeral'],
+                           dst_ports=['ssh'], action='ACCEPT')
+        self.assertTrue(self.matches(rule, 6, 50000, 22))
+        self.assertFalse(self.matches(rule, 6, 1000, 22))
+        self.assertFalse(self.matches(rule, 6, 50000, 23))
+
+    def test_per_protocol_lists(self):
+        rule = PortSetRule(protocol=['TCP', 'UDP'],
+                           dst_ports={'TCP': [80], 'UDP': ['dns']})
+        self.assertTrue(self.matches(rule, 6, 1, 80))
+        self.assertFalse(self.matches(rule, 6, 1, 53))
+        self.assertTrue(self.matches(rule, 17, 1, 53))
+        self.assertFalse(self.matches(rule, 17, 1, 80))
+
+    def test_custom_groups(self):
+        rule = PortSetRule(protocol='TCP', dst_ports=['app'],
+                           groups={'app': [9000, 'admin'],
+                                   'admin': ['9100-9101']})
+        for port in (9000, 9100, 9101):
+            self.assertTrue(self.matches(rule, 6, 1, port), port)
+
+    def test_service_name(self):
+        try:
+            socket.getservbyname('https', 'tcp')
+        except OSError:
+            self.skipTest('no services database')
+        rule = PortSetRule(protocol='TCP', dst_ports=['https'])
+        self.assertTrue(self.matches(rule, 6, 1, 443))
+
+    def test_invalid(self):
+        for kwargs in [dict(protocol='TCP'),
+                       dict(protocol='ICMP', dst_ports=[1]),
+                       dict(protocol='TCP', dst_ports=['2000-1000']),
+                       dict(protocol='TCP', dst_ports=[70000]),
+                       dict(protocol='TCP', dst_ports=['no-such-service']),
+                       dict(protocol='TCP', dst_ports=[1.5]),
+                       dict(protocol='TCP', dst_ports=['loop'],
+                            groups={'loop': ['loop']}),
+                       dict(protocol=['TCP', 'UDP'],
+                            dst_ports={'SCTP': [1]})]:
+            with self.assertRaises(ValueError, msg=kwargs):
+                PortSetRule(**kwargs)
+
+    def test_match_space(self):
+        rule = PortSetRule(protocol=['TCP', 'UDP'],
+                           dst_ports={'TCP': [80], 'UDP': [53]})
+        space = rule.match_space()
+        self.assertEqual(space['protocol'], frozenset([6, 17]))
+        self.assertEqual(space['dst_port'],
+                         port_mask(80, 80) | port_mask(53, 53))
+        self.assertNotIn('src_port', space)
@@ -0,0 +1,129 @@
+import contextlib
+import io
+import random
+import struct
+import unittest
+
+import profiler
+from packets import IPPacket
+from rules import capture_rule
+from rules.ip_rules import SourceIPRule
+from rules.port_filter import PortRangeRule, PortRule, PortSetRule
+from rules.tcp_rules import TCPRule
+
+
+def _packet(proto, src_port, dst_port, last_octet=1):
+    ip = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 40, 0, 0, 64, proto, 0,
+                     bytes([10, 0, 0, last_octet]), bytes([192, 0, 2, 1]))
+    if proto == 6:
+        transport = struct.pack('!HHIIBBHHH', src_port, dst_port, 0, 0,
+                                0x50, 0x02, 0, 0, 0)
+    else:
+        transport = struct.pack('!HHHH', src_port, dst_port, 20, 0) + \
+            bytes(12)
+    return IPPacket(ip + transport)
+
+
+def _run(rules, packet):
+    for rule in rules:
+        result = rule(packet)
+        if result:
+            return result
+    return False
+
+
+class CommutesTest(unittest.TestCase):
+
+    def test_same_action(self):
+        self.assertTrue(profiler.commutes(
+            PortRule(protocol='TCP', dst_port=80, action='DROP'),
+            PortRangeRule(protocol='TCP', dst_lo=1, dst_hi=100,
+                          action='DROP')))
+
+    def test_overlapping_with_different_actions(self):
+        self.assertFalse(profiler.commutes(
+            PortRule(protocol='TCP', dst_port=80, action='DROP'),
+            PortRangeRule(protocol='TCP', dst_lo=1, dst_hi=100,
+                          action='ACCEPT')))
+
+    def test_disjoint(self):
+        drop = PortRule(protocol='TCP', dst_port=80, action='DROP')
+        for other in [PortRule(protocol='UDP', dst_port=80, action='ACCEPT'),
+                      PortSetRule(protocol='TCP', dst_ports=[22, '8000-9000'],
+                                  action='ACCEPT'),
+                      TCPRule(action='ACCEPT')]:
+            self.assertEqual(profiler.commutes(drop, other),
+                             not isinstance(other, TCPRule))
+
+    def test_disjoint_addresses(self):
+        self.assertTrue(profiler.commutes(
+            SourceIPRule(cidr_range='10.0.0.0/24', action='DROP'),
+            SourceIPRule(cidr_range='10.0.1.0/24', action='ACCEPT')))
+        self.assertFalse(profiler.commutes(
+            SourceIPRule(cidr_range='10.0.0.0/16', action='DROP'),
+            SourceIPRule(cidr_range='10.0.1.0/24', action='ACCEPT')))
+
+    def test_rule_without_match_space(self):
+        self.addCleanup(capture_rule._captures.clear)
+        port_rule = PortRule(protocol='TCP', dst_port=80, action='DROP')
+        self.assertFalse(profiler.commutes(capture_rule.CaptureRule(),
+                                           port_rule))
+
+
+class OptimizeOrderTest(unittest.TestCase):
+
+    def chain(self):
+        return [
+            PortRule(protocol='TCP', dst_port=22, action='ACCEPT'),
+            PortRangeRule(protocol='TCP', dst_lo=1, dst_hi=1023,
+                          action='DROP'),
+            PortSetRule(protocol='UDP', dst_ports=['dns', 'ntp'],
+                        action='ACCEPT'),
+            SourceIPRule(cidr_range='10.0.0.0/28', action='DROP'),
+            PortRule(protocol='TCP', dst_port=80, action='ACCEPT'),
+            PortSetRule(protocol='TCP', dst_ports=['web'], action='DROP'),
+        ]
+
+    def test_hot_rules_move_forward(self):
+        order = profiler.optimize_order(self.chain(), [0, 0, 5, 0, 0, 0])
+        self.assertEqual(order[0], 2)
+
+    def test_never_passes_a_conflicting_rule(self):
+        # Rule 4 accepts port 80, which rule 1 drops first.
+        order = profiler.optimize_order(self.chain(), [0, 0, 0, 0, 9, 0])
+        self.assertLess(order.index(1), order.index(4))
+
+    def test_same_verdicts(self):
+        rules = self.chain()
+        rng = random.Random(4)
+        for _ in range(20):
+            hits = [rng.randrange(100) for _ in rules]
+            reordered = [rules[i] for i in
+                         profiler.optimize_order(rules, hits)]
+            for _ in range(300):
+                packet = _packet(rng.choice([6, 17]),
+                                 rng.randrange(65536),
+                                 rng.choice([22, 53, 80, 123, 443, 8080,
+                                             rng.randrange(65536)]),
+                                 rng.randrange(32))
+                with contextlib.redirect_stdout(io.StringIO()):
+                    self.assertEqual(_run(reordered, packet),
+                                     _run(rules, packet))
+
+
+class ChainProfilerTest(unittest.TestCase):
+
+    def test_counts(self):
+        rules = [PortRule(protocol='UDP', dst_port=53, action='ACCEPT'),
+                 TCPRule(action='DROP')]
+        chain_profiler = profiler.ChainProfiler()
+        packets = [_packet(6, 1, 80)] * 3 + [_packet(17, 1, 53)] * 2 + \
+            [_packet(17, 1, 54)]
+        with contextlib.redirect_stdout(io.StringIO()):
+            verdicts = [chain_profiler.run_chain('INPUT', rules, packet)
+                        for packet in packets]
+        self.assertEqual(verdicts, ['DROP'] * 3 + ['ACCEPT'] * 2 + [False])
+        self.assertEqual(chain_profiler.match_counts('INPUT'), [2, 3])
+        evals = [stats.evals for _, stats in chain_profiler.stats['INPUT']]
+        self.assertEqual(evals, [6, 4])
+        self.assertEqual(len(chain_profiler.report().splitlines()), 3)
@@ -0,0 +1,109 @@
+import json
+import os
+import tempfile
+import time
+import unittest
+
+import loadtest
+import queue_backend
+
+
+def _drain(verdicts, count):
+    return [verdicts.get(timeout=5) for _ in range(count)]
+
+
+class LocalBackendTest(unittest.TestCase):
+
+    def setUp(self):
+        self.channel = queue_backend.create_channel(41)
+        self.addCleanup(queue_backend._channels.pop, 41)
+        self.backend = queue_backend.get_backend('local')
+
+    def bind(self, callback):
+        nfqueue_instance = self.backend.NetFilterQueue()
+        nfqueue_instance.bind(41, callback)
+        return nfqueue_instance
+
+    def test_run_delivers_and_reports_verdicts(self):
+        payloads = []
+
+        def callback(packet):
+            payloads.append(packet.get_payload())
+            if packet.get_payload_len() > 1:
+                packet.drop()
+            else:
+                packet.accept()
+
+        nfqueue_instance = self.bind(callback)
+        self.channel.inject(1, b'a')
+        self.channel.inject(2, b'bb')
+        self.channel.close()
+        nfqueue_instance.run()
+        self.assertEqual(payloads, [b'a', b'bb'])
+        verdicts = _drain(self.channel.verdicts, 2)
+        self.assertEqual([verdict[:3] for verdict in verdicts],
+                         [(41, 1, 'ACCEPT'), (41, 2, 'DROP')])
+        for _, _, _, injected, decided in verdicts:
+            self.assertLessEqual(injected, decided)
+
+    def test_run_without_blocking(self):
+        nfqueue_instance = self.bind(lambda packet: packet.accept())
+        nfqueue_instance.run(block=False)
+        self.assertTrue(self.channel.verdicts.empty())
+
+    def test_run_socket(self):
+        packets = []
+        nfqueue_instance = self.bind(packets.append)
+        sock = self.backend.socket(nfqueue_instance)
+        sock.setblocking(False)
+        for seq in range(3):
+            self.channel.inject(seq, b'x')
+        # Wait for the queue's feeder thread.
+        deadline = time.monotonic() + 5
+        while len(packets) < 3 and time.monotonic() < deadline:
+            nfqueue_instance.run_socket(sock)
+        self.assertEqual(len(packets), 3)
+        self.channel.close()
+        with self.assertRaises(EOFError):
+            while True:
+                nfqueue_instance.run_socket(sock)
+
+    def test_single_verdict(self):
+        packets = []
+        nfqueue_instance = self.bind(packets.append)
+        self.channel.inject(1, b'x')
+        self.channel.close()
+        nfqueue_instance.run()
+        packets[0].accept()
+        with self.assertRaises(RuntimeError):
+            packets[0].drop()
+
+    def test_errors(self):
+        with self.assertRaises(OSError):
+            self.backend.NetFilterQueue().bind(99, None)
+        with self.assertRaises(ValueError):
+            queue_backend.get_backend('dpdk')
+
+
+class LoadTestTest(unittest.TestCase):
+    """Runs the whole process topology on local channels."""
+
+    def test_every_packet_gets_a_verdict(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.json',
+                                         delete=False) as conf:
+            json.dump({'default_chain': 'ACCEPT', 'INPUT': [
+                {'name': 'PortSetRule', 'protocol': 'TCP',
+                 'dst_ports': [8080], 'action': 'DROP'}]}, conf)
+        self.addCleanup(os.unlink, conf.name)
+        self.addCleanup(queue_backend._channels.clear)
+        test = loadtest.LoadTest(conf.name, loglevel='CRITICAL')
+        test.start()
+        try:
+            results = test.run(loadtest.synthetic_traffic(50))
+        finally:
+            test.stop()
+        self.assertEqual(sum(results['verdicts'].values()),
+                         results['packets'])
+        self.assertGreater(results['verdicts'].get('DROP', 0), 0)
+        self.assertEqual(results['ingress']['count'] +
+                         results['egress']['count'], results['packets'])
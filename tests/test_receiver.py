@@ -0,0 +1,81 @@
+import errno
+import unittest
+
+import queue_backend
+import receiver
+
+
+class SettingsTest(unittest.TestCase):
+
+    def test_defaults(self):
+        self.assertEqual(receiver.settings({}), receiver.DEFAULTS)
+        self.assertEqual(receiver.settings({'batch_size': 8})['batch_size'],
+                         8)
+
+    def test_errors(self):
+        with self.assertRaises(ValueError):
+            receiver.settings({'batchsize': 8})
+        with self.assertRaises(ValueError):
+            receiver.settings({'batch_size': 0})
+
+
+class _FailingSocket(object):
+    """Fails once with ENOBUFS, then returns data."""
+
+    def __init__(self):
+        self.failed = False
+
+    def recv(self, bufsize, flags=0):
+        if not self.failed:
+            self.failed = True
+            raise OSError(errno.ENOBUFS, 'No buffer space available')
+        return b'message'
+
+
+class BatchSocketTest(unittest.TestCase):
+
+    def test_ends_pass_when_full(self):
+        sock = receiver._BatchSocket(_FailingSocket(), 2)
+        with self.assertRaises(OSError):
+            sock.recv(100)
+        self.assertEqual(sock.enobufs, 1)
+        self.assertEqual(sock.recv(100), b'message')
+        self.assertEqual(sock.recv(100), b'message')
+        with self.assertRaises(BlockingIOError):
+            sock.recv(100)
+
+
+class ReceiverTest(unittest.TestCase):
+
+    def test_batches(self):
+        channel = queue_backend.create_channel(42)
+        self.addCleanup(queue_backend._channels.pop, 42)
+        batches = []
+
+        def handle_batch(packets):
+            batches.append(len(packets))
+            for packet in packets:
+                packet.accept()
+
+        worker = receiver.Receiver(queue_backend.get_backend('local'), 42,
+                                   handle_batch, batch_size=4)
+        for seq in range(10):
+            channel.inject(seq, b'x')
+        channel.close()
+        worker.run()
+        self.assertEqual(sum(batches), 10)
+        self.assertLessEqual(max(batches), 4)
+        stats = worker.stats()
+        self.assertEqual(stats['packets'], 10)
+        self.assertEqual(stats['batches'], len(batches))
+        self.assertEqual(stats['largest_batch'], max(batches))
+        verdicts = [channel.verdicts.get(timeout=5) for _ in range(10)]
+        self.assertEqual(sorted(verdict[1] for verdict in verdicts),
+                         list(range(10)))
+
+    def test_fail_open(self):
+        local = queue_backend.get_backend('local')
+        fail_open = receiver.Receiver(local, 1, None, fail_open=True)
+        self.assertEqual(fail_open.iptables_options(), ' --queue-bypass')
+        self.assertEqual(receiver.Receiver(local, 1, None).iptables_options(),
+                         '')
@@ -0,0 +1,125 @@
+import queue
+import select
+import socket
+import time
+import unittest
+
+import connection
+import replication
+
+_A = ('10.0.0.1', 1234, '192.0.2.1', 80)
+_B = ('10.0.0.2', 4321, '192.0.2.1', 443)
+
+
+def _tracker():
+    return connection.DefndTracker(queue.Queue(), queue.Queue(), None)
+
+
+class RecordTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        for state in replication.STATES:
+            record = replication.encode(_A, state)
+            self.assertEqual(len(record), 13)
+            self.assertEqual(replication.decode(b'xx' + record, 2),
+                             (_A, state))
+
+    def test_message(self):
+        records = [replication.encode(_A, 'ESTABLISHED'),
+                   replication.encode(_B, 'CLOSED')]
+        data = replication.message(replication.DELTAS, records, 12.5)
+        self.assertEqual(replication._HEADER.unpack_from(data),
+                         (replication.DELTAS, 2, 12.5))
+        self.assertEqual(len(data), replication._HEADER.size + 26)
+
+    def test_parse_address(self):
+        self.assertEqual(replication.parse_address('10.0.0.1:7400', 2),
+                         ('10.0.0.1', 7402))
+        self.assertEqual(replication.parse_address(':7400'),
+                         ('127.0.0.1', 7400))
+
+
+class ReplicationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.active = _tracker()
+        self.standby = _tracker()
+        self.receiver = replication.ReplicationReceiver(self.standby,
+                                                        '127.0.0.1', 0)
+        self.addCleanup(self.receiver._listener.close)
+        port = self.receiver._listener.getsockname()[1]
+        self.sender = replication.ReplicationSender(
+            self.active, '127.0.0.1', port, interval=0)
+        self.addCleanup(self.close)
+
+    def close(self):
+        for sock in (self.sender._sock, self.receiver._conn):
+            if sock is not None:
+                sock.close()
+
+    def pump(self, until):
+        """Run both trackers' timers and readers until a condition holds."""
+        deadline = time.monotonic() + 5
+        while not until():
+            self.assertLess(time.monotonic(), deadline)
+            for tracker in (self.active, self.standby):
+                for tick, _ in tracker.timers:
+                    tick()
+                ready, _, _ = select.select(list(tracker.readers), [], [],
+                                            0.01)
+                for ready_fd in ready:
+                    if ready_fd in tracker.readers:
+                        tracker.readers[ready_fd]()
+
+    def test_snapshot_then_deltas(self):
+        self.active.set_state(_A, 'ESTABLISHED')
+        self.pump(lambda: self.receiver.counters['snapshots'] == 1)
+        self.assertEqual(self.standby.connections, {_A: 'ESTABLISHED'})
+
+        self.active.set_state(_B, 'SYN_RCVD1')
+        self.active.set_state(_A, 'CLOSED')
+        self.pump(lambda: self.standby.state_of(_B) == 'SYN_RCVD1' and
+                  _A not in self.standby.connections)
+        self.assertEqual(self.sender.counters['created'], 1)
+        self.assertEqual(self.sender.counters['expired'], 1)
+        self.assertEqual(self.receiver.replicated, {_B: 1})
+        self.assertIsNotNone(self.receiver.last_lag)
+
+    def test_resynchronize_on_reconnect(self):
+        self.active.set_state(_A, 'ESTABLISHED')
+        self.active.set_state(_B, 'ESTABLISHED')
+        self.pump(lambda: self.receiver.counters['snapshots'] == 1)
+        # Changes made while disconnected are not sent; the next snapshot
+        # covers them.
+        with self.assertLogs('defnd.replication', 'WARNING'):
+            self.sender._disconnect('test')
+        self.active.set_state(_B, 'CLOSED')
+        self.sender._next_attempt = 0
+        self.pump(lambda: self.receiver.counters['snapshots'] == 2)
+        self.assertEqual(self.standby.connections, {_A: 'ESTABLISHED'})
+        self.assertEqual(self.receiver.replicated, {_A: 2})
+
+    def test_partial_messages(self):
+        records = [replication.encode(_A, 'ESTABLISHED'),
+                   replication.encode(_B, 'SYN_SENT1')]
+        data = replication.message(replication.DELTAS, records, time.time())
+        sender_end, receiver_end = socket.socketpair()
+        self.addCleanup(sender_end.close)
+        receiver_end.setblocking(False)
+        self.receiver._conn = receiver_end
+        sender_end.sendall(data[:-5])
+        self.receiver._readable()
+        self.assertEqual(self.standby.connections, {})
+        sender_end.sendall(data[-5:])
+        self.receiver._readable()
+        self.assertEqual(self.standby.connections,
+                         {_A: 'ESTABLISHED', _B: 'SYN_SENT1'})
+        self.assertEqual(len(self.receiver._in), 0)
+        sender_end.close()
+        self.receiver._readable()
+        self.assertIsNone(self.receiver._conn)
+
+    def test_refuses_other_peers(self):
+        receiver = self.receiver
+        self.assertTrue(receiver._accepts('127.0.0.1'))
+        self.assertFalse(receiver._accepts('192.0.2.7'))
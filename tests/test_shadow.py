@@ -0,0 +1,55 @@
+import queue
+import socket
+import struct
+import unittest
+
+import shadow
+from defnd import DefNd
+from rules.port_filter import PortSetRule
+
+
+def _packet(dst_port):
+    ip = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 28, 0, 0, 64, 17, 0,
+                     socket.inet_aton('10.0.0.1'),
+                     socket.inet_aton('192.0.2.1'))
+    return ip + struct.pack('!HHHH', 1234, dst_port, 8, 0)
+
+
+class ShadowTapTest(unittest.TestCase):
+
+    def test_sampling(self):
+        tap = shadow.ShadowTap(queue.Queue(), sample_rate=3)
+        self.assertEqual([tap.sample() for _ in range(6)],
+                         [False, False, True] * 2)
+
+    def test_drops_when_full(self):
+        tap = shadow.ShadowTap(queue.Queue(maxsize=2))
+        for _ in range(5):
+            tap.submit(memoryview(_packet(53)), 'ACCEPT', 1000)
+        self.assertEqual(tap.stats(), {'sampled': 2, 'dropped': 3,
+                                       'sample_rate': 100})
+        payload, verdict, cost = tap.queue.get_nowait()
+        self.assertEqual((payload, verdict, cost),
+                         (_packet(53), 'ACCEPT', 1000))
+
+
+class ShadowEvaluatorTest(unittest.TestCase):
+
+    def test_disagreements(self):
+        candidate = DefNd(None, None, default='ACCEPT')
+        candidate.add_rule('INPUT', PortSetRule(protocol='UDP',
+                                                dst_ports=['dns'],
+                                                action='DROP'))
+        evaluator = shadow.ShadowEvaluator(candidate)
+        for port, live in ((53, 'ACCEPT'), (53, 'DROP'), (80, 'ACCEPT'),
+                           (80, 'DROP')):
+            evaluator.handle((_packet(port), live, 1000))
+        stats = evaluator.stats(reset=True)
+        self.assertEqual(stats['compared'], 4)
+        self.assertEqual(stats['disagreements'],
+                         {'ACCEPT->DROP': 1, 'DROP->ACCEPT': 1})
+        self.assertEqual(stats['disagreement_rate'], 0.5)
+        self.assertEqual([entry['candidate'] for entry in stats['recent']],
+                         ['DROP', 'ACCEPT'])
+        self.assertEqual(stats['cost']['live']['count'], 4)
+        self.assertEqual(evaluator.stats()['compared'], 0)
@@ -0,0 +1,64 @@
+import queue
+import unittest
+
+import control
+import sharding
+
+
+class ShardOfTest(unittest.TestCase):
+
+    def test_both_directions_on_the_same_shard(self):
+        for n in range(500):
+            tup = ('10.0.%d.%d' % (n // 256, n % 256), 1024 + n,
+                   '192.0.2.1', 443)
+            flipped = (tup[2], tup[3], tup[0], tup[1])
+            for shards in (2, 3, 8):
+                shard = sharding.shard_of(tup, shards)
+                self.assertEqual(shard, sharding.shard_of(flipped, shards))
+                self.assertTrue(0 <= shard < shards)
+
+    def test_spread(self):
+        counts = [0] * 4
+        for n in range(4000):
+            counts[sharding.shard_of(('10.0.0.1', n, '192.0.2.1', 80),
+                                     4)] += 1
+        self.assertTrue(all(800 < count < 1200 for count in counts))
+
+    def test_sharded_queue_splits_batches(self):
+        queues = [queue.Queue() for _ in range(3)]
+        sharded = sharding.ShardedQueue(queues)
+        reports = [(('10.0.0.1', n, '192.0.2.1', 80), True, False, False)
+                   for n in range(30)]
+        sharded.put(reports)
+        received = []
+        for shard, shard_queue in enumerate(queues):
+            while not shard_queue.empty():
+                batch = shard_queue.get()
+                for report in batch:
+                    self.assertEqual(sharding.shard_of(report[0], 3), shard)
+                received.extend(batch)
+        self.assertEqual(sorted(received), sorted(reports))
+
+
+class MergeResultsTest(unittest.TestCase):
+
+    def test_stats(self):
+        merged = control.merge_results([
+            {'connections': 3, 'states': {'ESTABLISHED': 2, 'SYN_SENT1': 1}},
+            {'connections': 2, 'states': {'ESTABLISHED': 1, 'LAST_ACK': 1}},
+        ])
+        self.assertEqual(merged, {'connections': 5, 'states': {
+            'ESTABLISHED': 3, 'SYN_SENT1': 1, 'LAST_ACK': 1}})
+
+    def test_other_values(self):
+        merged = control.merge_results([
+            {'role': 'sender', 'under_attack': False, 'peer': 'a'},
+            {'role': 'sender', 'under_attack': True, 'peer': 'b'},
+        ])
+        self.assertEqual(merged, {'role': 'sender',
+                                  'under_attack': [False, True],
+                                  'peer': ['a', 'b']})
+
+
+if __name__ == '__main__':
+    unittest.main()
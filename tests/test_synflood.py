@@ -0,0 +1,93 @@
+import queue
+import struct
+import unittest
+from unittest import mock
+
+import connection
+import synflood
+
+
+def _syn(source, flags=0x02):
+    """A raw IPv4/TCP header with the given flags."""
+    ip = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 40, 0, 0, 64, 6, 0,
+                     bytes(source), bytes([192, 0, 2, 1]))
+    tcp = struct.pack('!HHIIBBHHH', 1234, 80, 0, 0, 0x50, flags, 0, 0, 0)
+    return ip + tcp
+
+
+class HalfOpenLimiterTest(unittest.TestCase):
+
+    def tracker(self, **protection):
+        return connection.DefndTracker(queue.Queue(), queue.Queue(), None,
+                                       protection, synflood.attack_flag())
+
+    def syn(self, tracker, source, port):
+        tracker.handle_ingress(((source, port, '192.0.2.1', 80),
+                                True, False, False))
+
+    def test_per_source_cap(self):
+        tracker = self.tracker(max_half_open_per_source=3)
+        for port in range(5):
+            self.syn(tracker, '10.0.0.1', port)
+        self.syn(tracker, '10.0.0.2', 1)
+        limiter = tracker.limiter
+        self.assertEqual(len(limiter.half_open), 4)
+        self.assertEqual(limiter.counters['refused_source'], 2)
+        self.assertTrue(limiter.under_attack)
+        self.assertEqual(limiter.flag.value, 1)
+
+    def test_global_cap(self):
+        tracker = self.tracker(max_half_open=10)
+        for port in range(15):
+            self.syn(tracker, '10.0.0.%d' % port, port)
+        self.assertEqual(len(tracker.connections), 10)
+        self.assertEqual(tracker.limiter.counters['refused_global'], 5)
+
+    def test_leaving_half_open(self):
+        tracker = self.tracker()
+        tup = ('10.0.0.1', 1, '192.0.2.1', 80)
+        self.syn(tracker, '10.0.0.1', 1)
+        tracker.set_state(tup, 'ESTABLISHED')
+        self.assertEqual(len(tracker.limiter.half_open), 0)
+        self.assertEqual(tracker.limiter.by_source, {})
+
+    def test_expiry(self):
+        tracker = self.tracker(half_open_timeout=0)
+        self.syn(tracker, '10.0.0.1', 1)
+        tracker.limiter.expire()
+        self.assertEqual(tracker.connections, {})
+        self.assertEqual(tracker.limiter.counters['expired'], 1)
+
+    def test_per_shard(self):
+        options = synflood.settings({'max_half_open': 10000,
+                                     'max_half_open_per_source': 64})
+        shard = synflood.per_shard(options, 3)
+        self.assertEqual(shard['max_half_open'], 3334)
+        self.assertEqual(shard['max_half_open_per_source'], 22)
+        self.assertEqual(shard['syn_rate'], options['syn_rate'])
+        self.assertEqual(synflood.per_shard(options, 1), options)
+
+    def test_unknown_setting(self):
+        self.assertRaises(ValueError, synflood.settings, {'max_syn': 1})
+
+
+class SynGuardTest(unittest.TestCase):
+
+    @mock.patch('time.monotonic', lambda: 1000.0)
+    def test_budget_under_attack_only(self):
+        flag = synflood.attack_flag()
+        guard = synflood.SynGuard(flag, syn_rate=5, syn_per_source=2)
+        source = [10, 0, 0, 1]
+        self.assertTrue(all(guard.check(_syn(source)) for _ in range(10)))
+        flag.value = 1
+        results = [guard.check(_syn(source)) for _ in range(4)]
+        self.assertEqual(results, [True, True, False, False])
+        self.assertTrue(guard.check(_syn(source, flags=0x12)))
+        for last in range(2, 6):
+            guard.check(_syn([10, 0, 0, last]))
+        self.assertEqual(guard.counters['dropped_global'], 1)
+        self.assertEqual(guard.counters['dropped_source'], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()